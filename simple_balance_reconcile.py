@@ -0,0 +1,35 @@
+"""
+Упрощенная сверка балансов пользователей с журналом операций (balance_ledger)
+Запуск с --fix дописывает в журнал корректирующие строки для найденных расхождений
+"""
+import sys
+import os
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
+
+
+def main():
+    print("🔄 Сверка балансов с журналом операций...")
+    from shop_bot.data_manager import database
+
+    if not database.DB_FILE.exists():
+        print(f"❌ База данных не найдена: {database.DB_FILE}")
+        return 1
+
+    database.run_migration()
+    mismatches = database.reconcile_balance_ledger(fix="--fix" in sys.argv)
+    if not mismatches:
+        print("✅ Расхождений нет")
+        return 0
+
+    print(f"⚠️ Расхождений: {len(mismatches)}")
+    for m in mismatches[:50]:
+        print(f"  - {m['user_id']}: баланс {m['balance']:.2f} RUB, по журналу {m['ledger_balance']:.2f} RUB")
+    if "--fix" in sys.argv:
+        print("✅ Корректировки записаны в журнал")
+    return 0 if "--fix" in sys.argv else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""
+Упрощенный бенчмарк слоя БД на синтетической базе (по умолчанию 100k пользователей, 1M транзакций)
+"""
+import sys
+import os
+import json
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
+
+USERS = int(os.environ.get("BENCH_USERS", "100000"))
+QUERIES = int(os.environ.get("BENCH_QUERIES", "20000"))
+KEYS = int(os.environ.get("BENCH_KEYS", "60000"))
+TRANSACTIONS = int(os.environ.get("BENCH_TRANSACTIONS", "1000000"))
+
+
+def build_synthetic_db(db_path: Path, users: int) -> None:
+    """Создаём схему через initialize_db и заполняем пользователями, ключами и транзакциями"""
+    from shop_bot.data_manager import database
+
+    database.DB_FILE = db_path
+    database.initialize_db()
+    rnd = random.Random(7)
+    metas = [json.dumps(m) for m in ({"action": "new", "plan_id": 1}, {"action": "extend", "months": 1}, {"action": "topup"}, {})]
+    with sqlite3.connect(db_path) as conn:
+        conn.executemany(
+            "INSERT INTO users (telegram_id, username, balance, registration_date) VALUES (?, ?, ?, datetime('now', ?))",
+            ((100000 + i, f"user_{i}", float(i % 500), f"-{i % 365} days") for i in range(users)),
+        )
+        conn.executemany(
+            "INSERT INTO vpn_keys (user_id, host_name, email, key_email, expire_at) VALUES (?, 'bench', ?, ?, datetime('now', ?))",
+            ((100000 + rnd.randrange(users), f"k{i}@bench", ("trial_" if i % 3 == 0 else "key_") + str(i), f"{rnd.randrange(-60, 60)} days") for i in range(KEYS)),
+        )
+        conn.executemany(
+            "INSERT INTO transactions (payment_id, user_id, status, amount_rub, payment_method, metadata, created_date) VALUES (?, ?, 'paid', 100, 'YooKassa', ?, datetime('now', ?))",
+            ((f"bench_{i}", 100000 + rnd.randrange(users), metas[i % len(metas)], f"-{i % 500} days") for i in range(TRANSACTIONS)),
+        )
+        conn.commit()
+
+
+def legacy_fetch_row(db_path: Path, sql: str, params: tuple) -> dict | None:
+    """Поведение до пула: новое соединение на каждый запрос"""
+    with sqlite3.connect(db_path, timeout=30.0) as conn:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute(sql, params).fetchone()
+        return dict(row) if row else None
+
+
+def run(label: str, fn) -> float:
+    rnd = random.Random(42)
+    started = time.perf_counter()
+    for _ in range(QUERIES):
+        fn(100000 + rnd.randrange(USERS))
+    elapsed = time.perf_counter() - started
+    qps = QUERIES / elapsed if elapsed else 0.0
+    print(f"  - {label}: {qps:,.0f} запросов/с ({elapsed * 1000 / QUERIES:.3f} мс/запрос)")
+    return qps
+
+
+def timed(label: str, fn) -> None:
+    started = time.perf_counter()
+    fn()
+    print(f"  - {label}: {(time.perf_counter() - started) * 1000:.0f} мс")
+
+
+def main():
+    print(f"🔍 Бенчмарк БД: {USERS} пользователей, {KEYS} ключей, {TRANSACTIONS} транзакций, {QUERIES} запросов на сценарий")
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "users.db"
+        build_synthetic_db(db_path, USERS)
+
+        from shop_bot.data_manager import database
+
+        sql = "SELECT * FROM users WHERE telegram_id = ?"
+        print("📊 Результаты:")
+        before = run("до (connect на запрос)", lambda uid: legacy_fetch_row(db_path, sql, (uid,)))
+        after = run("после (пул соединений)", lambda uid: database._fetch_row(sql, (uid,)))
+        print(f"✅ Ускорение: x{after / before:.1f}" if before else "✅ Готово")
+
+        print("📊 Дашборд:")
+        timed("группы пользователей (только количества)", database.get_dashboard_user_group_counts)
+        timed("группы пользователей (списки)", database.get_dashboard_user_groups)
+        timed("финансовая сводка", database.get_admin_financial_stats)
+
+        print("📊 Пагинация транзакций:")
+        deep_page = max(1, TRANSACTIONS // 8 // 2)
+        _, _, cursor = database.get_paginated_transactions(page=deep_page - 1, per_page=8)
+        timed(f"страница {deep_page} по номеру (OFFSET по индексу)", lambda: database.get_paginated_transactions(page=deep_page, per_page=8))
+        timed(f"страница {deep_page} по курсору", lambda: database.get_paginated_transactions(page=deep_page, per_page=8, cursor=cursor))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Упрощенная проверка задержки event loop: тяжёлый аналитический запрос в loop и в пуле чтения БД
+"""
+import sys
+import os
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
+
+os.environ.setdefault("BENCH_TRANSACTIONS", "300000")
+
+from simple_db_benchmark import build_synthetic_db, USERS
+
+HEAVY_QUERY = """
+    SELECT user_id, COUNT(*) AS cnt, SUM(amount_rub) AS total,
+           MAX(json_extract(metadata, '$.action')) AS last_action
+    FROM transactions
+    GROUP BY user_id
+    ORDER BY total DESC
+"""
+ROUNDS = 3
+
+
+async def measure(label: str, heavy) -> None:
+    from shop_bot.data_manager import async_repository as arepo
+
+    arepo.reset_loop_lag_stats()
+    monitor = asyncio.create_task(arepo.monitor_loop_lag(interval=0.05, warn_ms=10_000))
+    await asyncio.sleep(0.2)
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        await heavy()
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0.2)
+    monitor.cancel()
+    stats = arepo.get_loop_lag_stats()
+    print(f"   {label:<28} запросы {elapsed:6.2f} с | макс. задержка loop {stats['max_ms']:8.1f} мс ({stats['samples']} замеров)")
+
+
+async def run_checks() -> None:
+    from shop_bot.data_manager import database
+    from shop_bot.data_manager import async_repository as arepo
+
+    def heavy_query():
+        return database._fetch_list(HEAVY_QUERY, (), "Ошибка тяжёлого запроса")
+
+    async def blocking():
+        heavy_query()
+
+    async def offloaded():
+        await arepo.run_read(heavy_query)
+
+    async def hot_path_during_heavy():
+        heavy = asyncio.ensure_future(arepo.run_read(heavy_query))
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        await arepo.get_user(100001)
+        print(f"   get_user во время тяжёлого запроса: {(time.perf_counter() - started) * 1000:.1f} мс")
+        await heavy
+
+    await measure("синхронно в event loop", blocking)
+    await measure("через пул чтения БД", offloaded)
+    await hot_path_during_heavy()
+    arepo.shutdown()
+
+
+def main():
+    print("🔄 Создаю синтетическую базу...")
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "loop_lag.db"
+        build_synthetic_db(db_path, USERS)
+        print(f"✅ База готова. Тяжёлый запрос выполняется {ROUNDS} раз(а)")
+        asyncio.run(run_checks())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Упрощенная проверка идемпотентности платежей: один и тот же вебхук пополнения приходит параллельно N раз
+Баланс должен увеличиться ровно один раз, в базе — одна транзакция и один захват платежа
+Отдельно: обработка, отменённая по таймауту до зачисления, снимает захват, и повторный вызов проводит платёж
+"""
+import sys
+import os
+import asyncio
+import tempfile
+import threading
+import uuid
+from pathlib import Path
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
+
+PARALLEL = int(os.environ.get("PAYMENT_CHECK_PARALLEL", "50"))
+USER_ID = 700001
+AMOUNT = 150.0
+
+
+class SlowBot:
+    """Бот, у которого удаление сообщения зависает: обработка платежа отменяется до зачисления"""
+
+    async def delete_message(self, **kwargs):
+        await asyncio.sleep(10)
+
+
+def check_cancelled(database, handlers):
+    pay_id = f"check-cancel-{uuid.uuid4()}"
+    meta = {
+        "user_id": USER_ID, "price": AMOUNT, "action": "top_up",
+        "payment_method": "Check", "payment_id": pay_id, "months": 0,
+        "chat_id": USER_ID, "message_id": 1,
+    }
+    print(f"🔄 Платёж {pay_id}: первая обработка прерывается таймаутом...")
+    before = database.get_balance(USER_ID)
+
+    async def run():
+        try:
+            await asyncio.wait_for(handlers.process_successful_payment(SlowBot(), dict(meta)), timeout=0.2)
+            return False
+        except asyncio.TimeoutError:
+            return True
+
+    timed_out = asyncio.run(run())
+    released = database.get_payment_claim(pay_id) is None
+    retried = asyncio.run(handlers.process_successful_payment(None, dict(meta)))
+    database.flush_write_batches()
+
+    delta = database.get_balance(USER_ID) - before
+    claim = database.get_payment_claim(pay_id) or {}
+    print(f"  - Таймаут: {timed_out}, захват снят: {released}")
+    print(f"  - Повторная обработка: {retried}, зачислено: {delta:.2f} RUB, статус захвата: {claim.get('status')}")
+    return timed_out and released and retried is True and abs(delta - AMOUNT) < 0.001 and claim.get('status') == 'done'
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["METRICS_DB_FILE"] = str(Path(tmp) / "check-metrics.db")
+        from shop_bot.data_manager import database
+
+        database.DB_FILE = Path(tmp) / "check.db"
+        database.initialize_db()
+        database.register_user_if_not_exists(USER_ID, "idempotency_check", None)
+
+        from shop_bot.bot import handlers
+
+        pay_id = f"check-{uuid.uuid4()}"
+        meta = {
+            "user_id": USER_ID, "price": AMOUNT, "action": "top_up",
+            "payment_method": "Check", "payment_id": pay_id, "months": 0,
+        }
+        print(f"🔄 Отправляю платёж {pay_id} {PARALLEL} раз параллельно...")
+
+        barrier = threading.Barrier(PARALLEL)
+        results, errors = [], []
+
+        def worker():
+            barrier.wait()
+            try:
+                results.append(asyncio.run(handlers.process_successful_payment(None, dict(meta))))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(PARALLEL)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        database.flush_write_batches()
+
+        balance = database.get_balance(USER_ID)
+        tx_count = database._fetch_val(
+            "SELECT COUNT(*) FROM transactions WHERE payment_id = ?", (pay_id,), 0, "Ошибка подсчёта транзакций"
+        )
+        claim = database.get_payment_claim(pay_id) or {}
+        ledger = database.get_balance_ledger(USER_ID)
+
+        print(f"  - Ответов: {len(results)}, исключений: {len(errors)}")
+        print(f"  - Баланс: {balance:.2f} RUB (ожидается {AMOUNT:.2f})")
+        print(f"  - Транзакций с payment_id: {tx_count}")
+        print(f"  - Записей журнала баланса: {len(ledger)}")
+        print(f"  - Статус захвата: {claim.get('status')}")
+
+        ok = (
+            not errors
+            and abs(balance - AMOUNT) < 0.001
+            and tx_count == 1
+            and len([r for r in ledger if r.get('ref') == pay_id]) == 1
+            and claim.get('status') == 'done'
+        )
+        print("✅ Платёж зачислен ровно один раз" if ok else "❌ Обнаружена повторная обработка платежа")
+
+        cancel_ok = check_cancelled(database, handlers)
+        database.stop_write_batcher()
+        print("✅ Прерванный платёж проведён повторной обработкой" if cancel_ok else "❌ Прерванный платёж не проведён")
+        return 0 if ok and cancel_ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,36 @@
+"""
+Упрощенный скрипт пересборки сводки транзакций (transaction_rollups) по всей истории и поискового индекса админки
+"""
+import sys
+import os
+import time
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
+
+
+def main():
+    print("🔄 Пересборка сводки транзакций...")
+    from shop_bot.data_manager import database
+
+    if not database.DB_FILE.exists():
+        print(f"❌ База данных не найдена: {database.DB_FILE}")
+        return 1
+
+    database.run_migration()
+    started = time.perf_counter()
+    rows = database.rebuild_transaction_rollups()
+    elapsed = time.perf_counter() - started
+    print(f"✅ Готово: {rows} строк сводки за {elapsed * 1000:.0f} мс")
+    print(f"  - Доход всего: {database.get_total_spent_sum():.2f} RUB")
+
+    print("🔄 Пересборка поискового индекса...")
+    started = time.perf_counter()
+    docs = database.rebuild_admin_search_index()
+    elapsed = time.perf_counter() - started
+    print(f"✅ Готово: {docs} документов за {elapsed * 1000:.0f} мс")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
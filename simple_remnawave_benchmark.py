@@ -0,0 +1,509 @@
+"""
+Упрощенный бенчмарк клиента Remnawave против локальной фейковой панели
+pool  — новый HTTP-клиент на каждый вызов (прежнее поведение) против пула keep-alive соединений
+cache — повторные открытия экрана ключа без кэша чтений и с кэшем + singleflight, доля попаданий
+breaker — панель начинает отвечать ошибками/зависать: предохранитель, быстрый отказ, Retry-After, восстановление
+list  — list_users на 50k пользователей: последовательные страницы против окна параллельных, фильтр сквада на панели
+Запуск: python simple_remnawave_benchmark.py [pool|cache|breaker|list]
+"""
+import sys
+import os
+import asyncio
+import json
+import random
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
+
+# Короткие таймаут и пауза предохранителя, чтобы сценарий breaker укладывался в секунды
+os.environ.setdefault("REMNAWAVE_HTTP_TIMEOUT", "1")
+os.environ.setdefault("REMNAWAVE_BREAKER_OPEN_SECONDS", "2")
+
+CALLS = int(os.environ.get("BENCH_RW_CALLS", "200"))
+PARALLEL = int(os.environ.get("BENCH_RW_PARALLEL", "20"))
+# Фейковая панель работает по обычному HTTP; стоимость TLS-рукопожатия и RTT до панели
+# имитируется задержкой на каждое новое TCP-соединение
+HANDSHAKE_MS = float(os.environ.get("BENCH_RW_HANDSHAKE_MS", "30"))
+LATENCY_MS = float(os.environ.get("BENCH_RW_LATENCY_MS", "2"))
+HOST = "bench-host"
+SCREENS = int(os.environ.get("BENCH_RW_SCREENS", "300"))
+SCREEN_USERS = int(os.environ.get("BENCH_RW_SCREEN_USERS", "40"))
+LIST_USERS = int(os.environ.get("BENCH_RW_LIST_USERS", "50000"))
+PAGE_LATENCY_MS = float(os.environ.get("BENCH_RW_PAGE_LATENCY_MS", "150"))
+LIST_SQUADS = ("squad-a", "squad-b")
+
+
+def _user(user_id: int) -> dict:
+    return {
+        "id": user_id, "email": f"user{user_id}@bot.local", "hwidDeviceLimit": 3,
+        "subscriptionUrl": f"https://sub.local/{user_id}", "expireAt": "2030-01-01T00:00:00Z",
+    }
+
+
+class _PanelServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakePanel:
+    """Минимальная панель Remnawave: пользователи, подписки и устройства; считает соединения и запросы."""
+
+    def __init__(self, handshake_ms: float = HANDSHAKE_MS, latency_ms: float = LATENCY_MS):
+        self.handshake_ms = handshake_ms
+        self.latency_ms = latency_ms
+        self.connections = 0
+        self.requests = 0
+        # Внедрение отказов: None, "503", "hang" или "429:<секунды Retry-After>"; fail_times — сколько ответов испортить
+        self.fail_mode: str | None = None
+        self.fail_times = -1
+        # Список пользователей для GET /api/users: задержка страницы, фильтр squadUuid на стороне панели, сбойная страница
+        self.users: list[dict] = []
+        self.users_by_squad: dict[str, list[dict]] = {}
+        self.page_latency_ms = PAGE_LATENCY_MS
+        self.server_filter = True
+        self.fail_page: int | None = None
+        # Сколько пользователей добавить сразу после выдачи первой страницы: total в ней устаревает
+        self.grow_after_first_page = 0
+        self.pages_served = 0
+        self._lock = threading.Lock()
+        panel = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with panel._lock:
+                    panel.connections += 1
+                time.sleep(panel.handshake_ms / 1000)
+
+            def log_message(self, *args):
+                pass
+
+            def _inject_failure(self) -> bool:
+                with panel._lock:
+                    mode = panel.fail_mode
+                    if mode is None or panel.fail_times == 0:
+                        return False
+                    panel.fail_times -= 1
+                if mode == "hang":
+                    time.sleep(3)
+                    return True
+                if mode.startswith("429:"):
+                    self._reply(429, {"message": "rate limited"}, {"Retry-After": mode[4:]})
+                else:
+                    self._reply(503, {"message": "panel is down"})
+                return True
+
+            def do_GET(self):
+                with panel._lock:
+                    panel.requests += 1
+                if self._inject_failure():
+                    return
+                time.sleep(panel.latency_ms / 1000)
+                path, _, query = self.path.partition("?")
+                if path == "/api/users":
+                    self._list_users(parse_qs(query))
+                    return
+                if path == "/api/users/stream":
+                    match = re.search(r"email=user(\d+)%40bot\.local", query)
+                    users = [_user(int(match.group(1)))] if match else []
+                    self._reply(200, {"response": {"users": users}})
+                    return
+                match = re.match(r"^/api/(users|subscriptions/by-id|hwid/devices)/(\d+)$", path)
+                if not match:
+                    self._reply(404, {"message": "not found"})
+                    return
+                kind, user_id = match.group(1), int(match.group(2))
+                if kind == "users":
+                    self._reply(200, {"response": _user(user_id)})
+                elif kind == "subscriptions/by-id":
+                    self._reply(200, {"response": {"user": {"trafficLimitBytes": 0, "usedTrafficBytes": user_id}}})
+                else:
+                    self._reply(200, {"response": {"total": 1, "devices": [{"hwid": f"hw-{user_id}"}]}})
+
+            def _list_users(self, query: dict) -> None:
+                page = int(query.get("page", ["0"])[0])
+                size = int(query.get("size", ["100"])[0])
+                squad = query.get("squadUuid", [None])[0]
+                if page == panel.fail_page:
+                    self._reply(503, {"message": "page failed"})
+                    return
+                users = panel.users_by_squad.get(squad, []) if squad and panel.server_filter else panel.users
+                time.sleep(panel.page_latency_ms / 1000)
+                with panel._lock:
+                    panel.pages_served += 1
+                body = {"users": users[page * size:(page + 1) * size], "total": len(users)}
+                if page == 0 and panel.grow_after_first_page:
+                    panel.grow(panel.grow_after_first_page)
+                    panel.grow_after_first_page = 0
+                self._reply(200, {"response": body})
+
+            def do_POST(self):
+                with panel._lock:
+                    panel.requests += 1
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if self._inject_failure():
+                    return
+                time.sleep(panel.latency_ms / 1000)
+                self._reply(200, {"response": {"isDeleted": True}})
+
+            def _reply(self, status: int, payload: dict, headers: dict | None = None):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = _PanelServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.connections = 0
+            self.requests = 0
+
+    def populate(self, count: int) -> None:
+        self.users = []
+        self.grow(count)
+
+    def grow(self, count: int) -> None:
+        for user_id in range(len(self.users) + 1, len(self.users) + count + 1):
+            user = _user(user_id)
+            user["activeInternalSquads"] = [{"uuid": LIST_SQUADS[user_id % len(LIST_SQUADS)]}]
+            self.users.append(user)
+        self.users_by_squad = {
+            squad: [user for user in self.users if user["activeInternalSquads"][0]["uuid"] == squad] for squad in LIST_SQUADS
+        }
+
+    def inject(self, mode: str | None, times: int = -1) -> None:
+        with self._lock:
+            self.fail_mode = mode
+            self.fail_times = times
+
+
+def setup_host(tmp: str, base_url: str) -> None:
+    os.environ["METRICS_DB_FILE"] = str(Path(tmp) / "bench-metrics.db")
+    from shop_bot.data_manager import database
+
+    database.DB_FILE = Path(tmp) / "bench.db"
+    database.initialize_db()
+    database.create_host(HOST, base_url, "", "", 0)
+    database.update_host_remnawave_settings(HOST, remnawave_base_url=base_url, remnawave_api_token="bench-token")
+
+
+async def run_scenario(panel: FakePanel, pooled: bool, parallel: int) -> dict:
+    import httpx
+    from shop_bot.modules import remnawave_api
+
+    semaphore = asyncio.Semaphore(parallel)
+    latencies: list[float] = []
+
+    async def one_call(i: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            if pooled:
+                user = await remnawave_api.get_user_by_id(i + 1, host_name=HOST)
+            else:
+                # Прежнее поведение: клиент создаётся и закрывается на каждый запрос
+                async with httpx.AsyncClient(timeout=30.0) as client:
+                    response = await client.get(
+                        f"{panel.base_url}/api/users/{i + 1}", headers={"Authorization": "Bearer bench-token"}
+                    )
+                    user = response.json()["response"]
+            latencies.append((time.perf_counter() - started) * 1000)
+            assert user and user["id"] == i + 1
+
+    panel.reset_counters()
+    started = time.perf_counter()
+    if parallel == 1:
+        for i in range(CALLS):
+            await one_call(i)
+    else:
+        await asyncio.gather(*(one_call(i) for i in range(CALLS)))
+    elapsed = time.perf_counter() - started
+    await remnawave_api.close_http_clients()
+    latencies.sort()
+    return {
+        "elapsed": elapsed,
+        "avg_ms": sum(latencies) / len(latencies),
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1],
+        "connections": panel.connections,
+        "requests": panel.requests,
+    }
+
+
+async def run_screens(panel: FakePanel) -> dict:
+    """Открытия экрана ключа как в боте: детали ключа, подписка и устройства; часть — двойные нажатия."""
+    from shop_bot.modules import remnawave_api
+
+    rng = random.Random(42)
+
+    async def open_screen(user_id: int) -> None:
+        key = {"key_id": user_id, "key_email": f"user{user_id}@bot.local", "host_name": HOST}
+        details, sub = await asyncio.gather(
+            remnawave_api.get_key_details_from_host(key),
+            remnawave_api.get_subscription_info(user_id, host_name=HOST),
+        )
+        assert details and details["user"]["id"] == user_id and sub
+        devices = await remnawave_api.get_connected_devices_count(user_id, host_name=HOST)
+        assert devices and devices["total"] == 1
+
+    panel.reset_counters()
+    remnawave_api.reset_cache_stats()
+    started = time.perf_counter()
+    for _ in range(SCREENS // 10):
+        batch = [rng.randint(1, SCREEN_USERS) for _ in range(10)]
+        # Двойное нажатие: тот же экран открывается повторно, пока первый ещё грузится
+        batch += batch[:2]
+        await asyncio.gather(*(open_screen(user_id) for user_id in batch))
+    elapsed = time.perf_counter() - started
+
+    # Наша запись сбрасывает кэш: после удаления устройства список читается из панели
+    before = panel.requests
+    await remnawave_api.delete_user_device(1, "hw-1", host_name=HOST)
+    await remnawave_api.get_user_devices(1, host_name=HOST)
+    refetched = panel.requests - before == 2
+
+    await remnawave_api.close_http_clients()
+    return {"elapsed": elapsed, "requests": panel.requests, "cache": remnawave_api.get_cache_stats(), "refetched": refetched}
+
+
+def check_cache(panel: FakePanel) -> bool:
+    from shop_bot.modules import remnawave_api
+
+    screens = SCREENS // 10 * 12
+    print(f"🔄 {screens} открытий экрана ключа для {SCREEN_USERS} пользователей, ответ панели {LATENCY_MS:g} мс")
+    ttl = remnawave_api._CACHE_TTL
+    remnawave_api._CACHE_TTL = 0
+    try:
+        uncached = asyncio.run(run_screens(panel))
+    finally:
+        remnawave_api._CACHE_TTL = ttl
+    cached = asyncio.run(run_screens(panel))
+
+    stats = cached["cache"]
+    print(f"   {'без кэша':<34} {uncached['elapsed']:6.2f} с | запросов в панель {uncached['requests']}")
+    print(f"   {'кэш + singleflight':<34} {cached['elapsed']:6.2f} с | запросов в панель {cached['requests']}")
+    print(
+        f"📊 Попадания {stats['hit_rate']}% ({stats['hits']} из кэша, {stats['coalesced']} объединено,"
+        f" {stats['misses']} в панель), сброшено записей {stats['invalidated']}"
+    )
+    ok = cached["refetched"] and cached["requests"] < uncached["requests"] and stats["hit_rate"] > 0
+    print("✅ Кэш и сброс после записи работают" if ok else "❌ Кэш работает неверно")
+    return ok
+
+
+def print_row(label: str, stats: dict) -> None:
+    print(
+        f"   {label:<34} {stats['elapsed']:6.2f} с | ср. {stats['avg_ms']:7.1f} мс | p95 {stats['p95_ms']:7.1f} мс"
+        f" | соединений {stats['connections']:4d} на {stats['requests']} запросов"
+    )
+
+
+def check_pool(panel: FakePanel) -> bool:
+    from shop_bot.modules import remnawave_api
+
+    print(f"🔄 {CALLS} вызовов get_user_by_id, рукопожатие {HANDSHAKE_MS:g} мс, ответ панели {LATENCY_MS:g} мс")
+    # Одинаковые ID попадали бы в кэш чтений — здесь меряется только транспорт
+    ttl = remnawave_api._CACHE_TTL
+    remnawave_api._CACHE_TTL = 0
+    results = {}
+    try:
+        for parallel in (1, PARALLEL):
+            mode = "последовательно" if parallel == 1 else f"параллельно x{parallel}"
+            fresh = asyncio.run(run_scenario(panel, pooled=False, parallel=parallel))
+            pooled = asyncio.run(run_scenario(panel, pooled=True, parallel=parallel))
+            print_row(f"новый клиент на вызов, {mode}", fresh)
+            print_row(f"пул соединений, {mode}", pooled)
+            results[parallel] = (fresh, pooled)
+    finally:
+        remnawave_api._CACHE_TTL = ttl
+
+    fresh_seq, pooled_seq = results[1]
+    ok = pooled_seq["connections"] <= 1 and pooled_seq["avg_ms"] < fresh_seq["avg_ms"]
+    print(f"📊 Ускорение последовательных вызовов: x{fresh_seq['avg_ms'] / pooled_seq['avg_ms']:.1f}")
+    print("✅ Соединения переиспользуются" if ok else "❌ Пул не переиспользует соединения")
+    return ok
+
+
+async def run_outage(panel: FakePanel) -> list[str]:
+    from shop_bot.modules import remnawave_api
+
+    problems: list[str] = []
+
+    async def timed_lookup(user_id: int) -> tuple[float, str]:
+        requests_before = panel.requests
+        started = time.perf_counter()
+        try:
+            await remnawave_api.get_user_by_id(user_id, host_name=HOST)
+            outcome = "ok"
+        except remnawave_api.RemnawavePanelUnavailable:
+            # Отказ без обращения к панели — быстрый; если до открытия предохранителя были попытки — это ожидание
+            outcome = "fast-fail" if panel.requests == requests_before else "error"
+        except remnawave_api.RemnawaveAPIError:
+            outcome = "error"
+        return (time.perf_counter() - started) * 1000, outcome
+
+    for mode in ("503", "hang"):
+        panel.reset_counters()
+        panel.inject(mode)
+        results = [await timed_lookup(i + 1) for i in range(20)]
+        slow = [ms for ms, outcome in results if outcome != "fast-fail"]
+        fast = [ms for ms, outcome in results if outcome == "fast-fail"]
+        print(
+            f"   отказ «{mode}»: 20 вызовов, в панель ушло {panel.requests} запросов;"
+            f" {len(slow)} ждали ({sum(slow) / 1000:.1f} с), {len(fast)} отклонены сразу"
+            f" (макс. {max(fast, default=0):.1f} мс)"
+        )
+        message = remnawave_api.host_unavailable_message(HOST)
+        if mode == "503":
+            print(f"   сообщение пользователю: {message}")
+        if not fast or max(fast) > 50 or not message:
+            problems.append(f"нет быстрого отказа при «{mode}»")
+
+        panel.inject(None)
+        await asyncio.sleep(float(os.environ["REMNAWAVE_BREAKER_OPEN_SECONDS"]) * 2 + 0.2)
+        ms, outcome = await timed_lookup(100)
+        print(f"   восстановление после «{mode}»: пробный запрос {outcome} за {ms:.1f} мс, сообщение: {remnawave_api.host_unavailable_message(HOST)}")
+        if outcome != "ok" or remnawave_api.host_unavailable_message(HOST):
+            problems.append(f"предохранитель не закрылся после «{mode}»")
+
+    panel.inject("429:1", times=1)
+    ms, outcome = await timed_lookup(200)
+    print(f"   429 с Retry-After: 1 — {outcome} за {ms:.0f} мс")
+    if outcome != "ok" or ms < 900:
+        problems.append("Retry-After не соблюдён")
+
+    panel.inject("429:120", times=1)
+    ms, outcome = await timed_lookup(201)
+    next_ms, next_outcome = await timed_lookup(202)
+    print(f"   429 с Retry-After: 120 — {outcome} за {ms:.1f} мс, следующий вызов {next_outcome} за {next_ms:.1f} мс")
+    print(f"   сообщение пользователю: {remnawave_api.host_unavailable_message(HOST)}")
+    if ms > 500 or next_outcome != "fast-fail":
+        problems.append("длинный Retry-After не открыл предохранитель")
+
+    await remnawave_api.close_http_clients()
+    return problems
+
+
+def check_breaker(panel: FakePanel) -> bool:
+    from shop_bot.modules import remnawave_api
+
+    print(f"🔄 Отказы панели: таймаут {os.environ['REMNAWAVE_HTTP_TIMEOUT']} с, пауза предохранителя {os.environ['REMNAWAVE_BREAKER_OPEN_SECONDS']} с")
+    ttl = remnawave_api._CACHE_TTL
+    remnawave_api._CACHE_TTL = 0
+    try:
+        problems = asyncio.run(run_outage(panel))
+    finally:
+        remnawave_api._CACHE_TTL = ttl
+        panel.inject(None)
+        # Предохранитель остался открыт после Retry-After: 120 — следующие сценарии начинают с чистого листа
+        remnawave_api._breakers.clear()
+    print("✅ Предохранитель работает" if not problems else f"❌ {'; '.join(problems)}")
+    return not problems
+
+
+async def run_list(panel: FakePanel, concurrency: int, squad_uuid: str | None = LIST_SQUADS[0]) -> tuple[float, int, int]:
+    from shop_bot.modules import remnawave_api
+
+    with panel._lock:
+        panel.pages_served = 0
+    started = time.perf_counter()
+    users = await remnawave_api.list_users(HOST, squad_uuid=squad_uuid, concurrency=concurrency)
+    elapsed = time.perf_counter() - started
+    await remnawave_api.close_http_clients()
+    return elapsed, panel.pages_served, len(users)
+
+
+def check_list(panel: FakePanel) -> bool:
+    from shop_bot.modules import remnawave_api
+
+    panel.populate(LIST_USERS)
+    expected = len(panel.users_by_squad[LIST_SQUADS[0]])
+    window = remnawave_api._LIST_CONCURRENCY
+    print(f"🔄 list_users: {LIST_USERS} пользователей в {len(LIST_SQUADS)} сквадах, страница 1000, задержка страницы {PAGE_LATENCY_MS:g} мс")
+    ok = True
+    timings = {}
+    for server_filter in (False, True):
+        panel.server_filter = server_filter
+        for concurrency in (1, window):
+            elapsed, pages, count = asyncio.run(run_list(panel, concurrency))
+            mode = "по очереди" if concurrency == 1 else f"окно {concurrency}"
+            where = "фильтр на панели" if server_filter else "панель без фильтра"
+            print(f"   {mode + ', ' + where:<34} {elapsed:6.2f} с | страниц {pages:3d} | пользователей сквада {count}")
+            ok = ok and count == expected
+            timings[(server_filter, concurrency)] = elapsed
+
+    panel.fail_page = 7
+    try:
+        asyncio.run(run_list(panel, window))
+        print("   сбой страницы 7: возвращён неполный список")
+        ok = False
+    except remnawave_api.RemnawaveAPIError:
+        print("   сбой страницы 7: список целиком отклонён, синхронизация сквада будет пропущена")
+    finally:
+        panel.fail_page = None
+        remnawave_api._breakers.clear()
+
+    # Пользователи добавлены, пока страницы читались: полная последняя страница — сигнал дочитать хвост
+    panel.populate(10 * 1000)
+    panel.grow_after_first_page = 2500
+    _, pages, count = asyncio.run(run_list(panel, window, squad_uuid=None))
+    print(f"   +2500 пользователей во время чтения: страниц {pages}, получено {count} из {len(panel.users)}")
+    ok = ok and count == len(panel.users)
+
+    print(
+        f"📊 Ускорение окна {window} относительно обхода по очереди: x{timings[(False, 1)] / timings[(False, window)]:.1f}"
+        f" без фильтра на панели, x{timings[(True, 1)] / timings[(True, window)]:.1f} с фильтром"
+    )
+    print("✅ Список пользователей полный" if ok else "❌ Список пользователей неверный")
+    return ok
+
+
+SCENARIOS = {"pool": check_pool, "cache": check_cache, "breaker": check_breaker, "list": check_list}
+
+
+def main():
+    import logging
+
+    logging.disable(logging.WARNING)
+    selected = sys.argv[1:] or list(SCENARIOS)
+    unknown = [name for name in selected if name not in SCENARIOS]
+    if unknown:
+        print(f"❌ Неизвестные сценарии: {', '.join(unknown)}; доступны: {', '.join(SCENARIOS)}")
+        return 2
+
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp, FakePanel() as panel:
+        setup_host(tmp, panel.base_url)
+        for name in selected:
+            ok = SCENARIOS[name](panel) and ok
+            print()
+
+        from shop_bot.data_manager import database
+        database.stop_write_batcher()
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
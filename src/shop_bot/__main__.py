@@ -1,3 +1,6 @@
+import time
+_process_started = time.perf_counter()
+
 import logging
 import threading
 from logging.handlers import RotatingFileHandler
@@ -15,8 +18,13 @@ except Exception:
 from shop_bot.webhook_server.app import create_webhook_app, _support_bot_controller
 from shop_bot.data_manager.scheduler import periodic_subscription_check
 from shop_bot.data_manager import remnawave_repository as rw_repo
+from shop_bot.data_manager import async_repository as arepo
+from shop_bot.modules import remnawave_api
 from shop_bot.bot_controller import BotController
 
+_imports_done = time.perf_counter()
+
+
 def main():
     if colorama_available:
         try:
@@ -127,12 +135,26 @@ def main():
     aio_event_logger.addFilter(RussianizeAiogramFilter())
     logger = logging.getLogger(__name__)
 
+    startup_phases = [("импорт модулей", _imports_done - _process_started)]
+
+    def mark_phase(name: str, started: float) -> None:
+        startup_phases.append((name, time.perf_counter() - started))
+
+    def log_startup_report() -> None:
+        total = sum(duration for _, duration in startup_phases)
+        details = ", ".join(f"{name} {duration * 1000:.0f} мс" for name, duration in startup_phases)
+        logger.info(f"Время запуска: {total * 1000:.0f} мс ({details})")
+
     logger.info("Инициализация базы данных...")
+    phase_started = time.perf_counter()
     rw_repo.initialize_db()
+    mark_phase("база данных", phase_started)
     logger.info("Инициализация базы данных завершена.")
 
+    phase_started = time.perf_counter()
     bot_controller = BotController()
     flask_app = create_webhook_app(bot_controller)
+    mark_phase("веб-приложение", phase_started)
     
     async def shutdown(sig: signal.Signals, loop: asyncio.AbstractEventLoop):
         logger.info(f"Получен сигнал: {sig.name}. Запускаю завершение работы...")
@@ -143,9 +165,13 @@ def main():
         if tasks:
             [task.cancel() for task in tasks]
             await asyncio.gather(*tasks, return_exceptions=True)
+        await remnawave_api.close_http_clients()
+        arepo.shutdown(wait=False)
+        rw_repo.stop_write_batcher()
         loop.stop()
 
     async def start_services():
+        phase_started = time.perf_counter()
         loop = asyncio.get_running_loop()
         bot_controller.set_loop(loop)
         flask_app.config['EVENT_LOOP'] = loop
@@ -160,10 +186,13 @@ def main():
         flask_thread.start()
         
         logger.info("Flask-сервер запущен: http://0.0.0.0:1488")
+        mark_phase("запуск сервисов", phase_started)
+        log_startup_report()
             
         logger.info("Приложение запущено. Бота можно стартовать из веб-панели.")
         
         asyncio.create_task(periodic_subscription_check(bot_controller))
+        asyncio.create_task(arepo.monitor_loop_lag())
         async def delayed_auto_start():
             logger.info("Ожидание 2 секунд перед автозапуском...")
             await asyncio.sleep(2)
@@ -2726,7 +2726,7 @@ def get_admin_router() -> Router:
             await message.answer("❌ Сумма должна быть положительной")
             return
         try:
-            ok = add_to_balance(user_id, amount)
+            ok = add_to_balance(user_id, amount, "admin_topup")
             if ok:
                 await message.answer(f"✅ Начислено {amount:.2f} RUB на баланс пользователю {user_id}")
                 try:
@@ -2877,7 +2877,7 @@ def get_admin_router() -> Router:
             await message.answer("❌ Сумма должна быть положительной")
             return
         try:
-            ok = deduct_from_balance(user_id, amount)
+            ok = deduct_from_balance(user_id, amount, "admin_deduct")
             if ok:
                 await message.answer(f"✅ Списано {amount:.2f} RUB с баланса пользователя {user_id}")
                 try:
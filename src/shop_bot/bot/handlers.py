@@ -56,7 +56,7 @@ from shop_bot.data_manager.remnawave_repository import (
     add_to_referral_balance_all,
     get_referral_balance_all,
     get_referral_balance,
-    get_all_users,
+    get_admin_users,
     set_terms_agreed,
     set_referral_start_bonus_received,
     set_trial_used,
@@ -64,7 +64,6 @@ from shop_bot.data_manager.remnawave_repository import (
     log_transaction,
     is_admin,
     get_host,
-    check_transaction_exists,
     get_device_tiers,
     get_device_tier_by_id,
     redeem_universal_promo,
@@ -82,6 +81,7 @@ from shop_bot.config import (
     get_msk_time
 )
 from shop_bot.data_manager import remnawave_repository as rw_repo
+from shop_bot.data_manager import async_repository as arepo
 from shop_bot.modules import remnawave_api
 
 TELEGRAM_BOT_USERNAME = None
@@ -860,7 +860,7 @@ def get_user_router() -> Router:
     async def profile_handler_callback(callback: types.CallbackQuery):
         await callback.answer()
         user_id = callback.from_user.id
-        user_db_data, user_keys = get_user(user_id), get_user_keys(user_id)
+        user_db_data, user_keys = await asyncio.gather(arepo.get_user(user_id), arepo.get_user_keys(user_id))
         if not user_db_data:
             await callback.answer("⚠️ Не удалось загрузить данные профиля.", show_alert=True)
             return
@@ -894,18 +894,22 @@ def get_user_router() -> Router:
             vpn_status = "Нет ключей"
             vpn_remaining = "-"
         
-        try: main_balance = get_balance(user_id)
+        main_balance, referral_count, total_ref_earned = await asyncio.gather(
+            arepo.get_balance(user_id), arepo.get_referral_count(user_id), arepo.get_referral_balance_all(user_id),
+            return_exceptions=True,
+        )
+        try: main_balance = float(main_balance)
         except Exception: main_balance = 0.0
 
-        try: referral_count = get_referral_count(user_id)
+        try: referral_count = int(referral_count)
         except Exception: referral_count = 0
         
-        try: total_ref_earned = float(get_referral_balance_all(user_id))
+        try: total_ref_earned = float(total_ref_earned)
         except Exception: total_ref_earned = 0.0
 
         seller_info_dict = None
         if user_db_data.get('seller_active'):
-             s_info = get_seller_user(user_id)
+             s_info = await arepo.get_seller_user(user_id)
              if s_info:
                  seller_info_dict = {
                      'sale': s_info.get('seller_sale', 0),
@@ -2139,7 +2143,8 @@ def get_user_router() -> Router:
             result = await remnawave_api.create_or_update_key_on_host(host_name=host_name, email=candidate_email, days_to_add=int(get_setting("trial_duration_days")), telegram_id=user_id, traffic_limit_gb=trial_traffic if trial_traffic > 0 else None, hwid_limit=trial_hwid if trial_hwid > 0 else None, internal_squad_uuid=trial_internal_squad_uuid)
             
             if not result:
-                await smart_edit_message(message, "❌ <b>Ошибка сервера</b>\nНе удалось сгенерировать конфигурацию. Попробуйте выбрать другой сервер.")
+                reason = remnawave_api.host_unavailable_message(host_name) or "Не удалось сгенерировать конфигурацию."
+                await smart_edit_message(message, f"❌ <b>Ошибка сервера</b>\n{reason} Попробуйте выбрать другой сервер.")
                 return
 
             set_trial_used(user_id)
@@ -2279,7 +2284,8 @@ def get_user_router() -> Router:
             
             res = await remnawave_api.create_or_update_key_on_host(new_host, key.get('key_email'), expiry_timestamp_ms=expiry_ms, telegram_id=callback.from_user.id, hwid_limit=hw_lim, traffic_limit_gb=tr_lim_gb)
             if not res:
-                await smart_edit_message(callback.message, f"❌ <b>Ошибка миграции</b>\nНе удалось активировать ключ на сервере «{new_host}».")
+                reason = remnawave_api.host_unavailable_message(new_host) or f"Не удалось активировать ключ на сервере «{new_host}»."
+                await smart_edit_message(callback.message, f"❌ <b>Ошибка миграции</b>\n{reason}")
                 return
 
             try: await remnawave_api.delete_client_on_host(old_host, key.get('key_email'))
@@ -3036,7 +3042,7 @@ def get_user_router() -> Router:
 
         price = float(data.get('final_price', plan['price']))
         logger.info(f"Оплата (Баланс): пользователь {callback.from_user.id}, план {plan['plan_id']}, сумма {price} RUB")
-        if not deduct_from_balance(callback.from_user.id, price): return await callback.answer("⚖️ Недостаточно средств на балансе.", show_alert=True)
+        if not deduct_from_balance(callback.from_user.id, price, "purchase"): return await callback.answer("⚖️ Недостаточно средств на балансе.", show_alert=True)
 
         meta = {"user_id": callback.from_user.id, "months": int(plan['months']), "price": price, "action": data.get('action'), "key_id": data.get('key_id'), "host_name": data.get('host_name'), "plan_id": data.get('plan_id'), "customer_email": data.get('customer_email'), "payment_method": "Balance", "chat_id": callback.message.chat.id, "message_id": callback.message.message_id, "promo_code": (data.get('promo_code') or '').strip(), "promo_discount": float(data.get('promo_discount', 0)), "tier_device_count": data.get('tier_device_count'), "tier_price": data.get('tier_price', 0)}
         logger.info(f"Оплата Баланс: Успешное списание {price} RUB с баланса пользователя {callback.from_user.id}")
@@ -3300,7 +3306,8 @@ def get_user_router() -> Router:
                 telegram_id=uid
             )
             if not res:
-                await _edit("🎁 <b>Активация бонусного промокода</b>\n\n❌ Ошибка на стороне VPN-сервера.", InlineKeyboardBuilder().button(text="⬅️ Назад", callback_data="show_profile").as_markup())
+                reason = remnawave_api.host_unavailable_message(host) or "Ошибка на стороне VPN-сервера."
+                await _edit(f"🎁 <b>Активация бонусного промокода</b>\n\n❌ {reason}", InlineKeyboardBuilder().button(text="⬅️ Назад", callback_data="show_profile").as_markup())
                 return
                 
             if not rw_repo.update_key(key_id, remnawave_user_uuid=res['client_uuid'], expire_at_ms=res['expiry_timestamp_ms']):
@@ -3377,10 +3384,33 @@ async def process_successful_payment(bot: Bot | None, metadata: dict) -> bool:
     logger.info(f"💳 Обработка платежа: {metadata.get('user_id')} | {metadata.get('action')}")
     
     pay_id = metadata.get('payment_id')
-    if pay_id and check_transaction_exists(pay_id):
-        logger.warning(f"Повторная попытка обработки платежа {pay_id}. Операция отклонена.")
-        return True
+    if pay_id:
+        claimed = rw_repo.claim_payment(pay_id, metadata.get('user_id'), metadata.get('action'))
+        if claimed is None:
+            logger.error(f"Не удалось зарегистрировать платёж {pay_id}, обработка остановлена.")
+            return False
+        if not claimed:
+            logger.warning(f"Повторная попытка обработки платежа {pay_id}. Операция отклонена.")
+            return True
 
+    ok = False
+    progress = {"applied": False}
+    try:
+        ok = await _process_claimed_payment(bot, metadata, progress)
+        return ok
+    except BaseException:
+        # Отмена (например, таймаут вызывающего) до первого изменения: захват снимается, платёж можно повторить
+        if pay_id and not progress["applied"] and rw_repo.release_payment_claim(pay_id):
+            logger.warning(f"Обработка платежа {pay_id} прервана до изменений, захват снят.")
+            pay_id = None
+        raise
+    finally:
+        if pay_id:
+            rw_repo.finish_payment_claim(pay_id, 'done' if ok else 'failed')
+
+
+async def _process_claimed_payment(bot: Bot | None, metadata: dict, progress: dict) -> bool:
+    pay_id = metadata.get('payment_id')
     try:
         action, uid, price = metadata.get('action'), int(metadata.get('user_id')), float(metadata.get('price'))
         def _to_int(v, d=0):
@@ -3393,17 +3423,18 @@ async def process_successful_payment(bot: Bot | None, metadata: dict) -> bool:
         if metadata.get('chat_id') and metadata.get('message_id'):
             try:
                 if bot: await bot.delete_message(chat_id=metadata['chat_id'], message_id=metadata['message_id'])
-            except: pass
+            except Exception: pass
 
         # --- ПОПОЛНЕНИЕ БАЛАНСА ---
         if action == "top_up":
-            old_balance = get_balance(uid)
-            if not add_to_balance(uid, float(price)):
+            progress["applied"] = True
+            balance = rw_repo.change_balance(uid, float(price), "top_up", pay_id)
+            if balance is None:
                 logger.error(f"Ошибка баланса: Не удалось пополнить счет для {uid} на сумму {price}")
                 return False
+            old_balance = balance - float(price)
             
             user_info = get_user(uid); username = (user_info.get('username') if user_info else '') or f"@{uid}"
-            balance = get_balance(uid)
             topup_meta = dict(metadata or {})
             topup_meta.update({
                 "action": "top_up",
@@ -3435,9 +3466,9 @@ async def process_successful_payment(bot: Bot | None, metadata: dict) -> bool:
                         elif rtype == "percent_purchase": reward = (Decimal(str(price)) * Decimal(get_setting("referral_percentage") or "0") / 100).quantize(Decimal("0.01"))
                     
                     if float(reward) > 0:
-                        ref_old_balance = get_balance(int(ref_id))
-                        if add_to_balance(int(ref_id), float(reward)):
-                            ref_new_balance = get_balance(int(ref_id))
+                        ref_new_balance = rw_repo.change_balance(int(ref_id), float(reward), "referral_bonus", pay_id)
+                        if ref_new_balance is not None:
+                            ref_old_balance = ref_new_balance - float(reward)
                             add_to_referral_balance_all(int(ref_id), float(reward))
                             ref_user = get_user(int(ref_id)) or {}
                             ref_meta = {
@@ -3464,7 +3495,7 @@ async def process_successful_payment(bot: Bot | None, metadata: dict) -> bool:
                     if bot: await bot.send_message(uid, f"✅ <b>Баланс пополнен!</b>\nСумма: <code>{float(price):.2f} RUB</code>\nТекущий баланс: <code>{balance:.2f} RUB</code>", reply_markup=keyboards.create_profile_keyboard())
                 except Exception: pass
             
-            admins = [u for u in (get_all_users() or []) if is_admin(u.get('telegram_id') or 0)]
+            admins = get_admin_users()
             
             # Получаем чистый username для уведомления
             raw_username = user_info.get('username') if user_info else None
@@ -3521,6 +3552,7 @@ async def process_successful_payment(bot: Bot | None, metadata: dict) -> bool:
             # Получаем внешний сквад для seller (если пользователь - seller)
             external_squad = get_seller_external_squad(uid)
             
+            progress["applied"] = True
             res = await remnawave_api.create_or_update_key_on_host(
                 host_name=host, 
                 email=c_email, 
@@ -3531,21 +3563,23 @@ async def process_successful_payment(bot: Bot | None, metadata: dict) -> bool:
                 external_squad_uuid=external_squad
             )
             if not res:
-                add_to_balance(uid, float(price))
+                add_to_balance(uid, float(price), "refund", pay_id)
                 logger.error(f"Возврат средств: {price} RUB возвращено пользователю {uid} (ошибка API VPN на хосте {host})")
-                if proc_msg and bot: await proc_msg.edit_text("❌ <b>Ошибка на стороне VPN-сервера</b>\nКлюч не был выдан. Средства возвращены на ваш баланс в боте.")
+                reason = remnawave_api.host_unavailable_message(host)
+                reason_line = f"{reason}\n" if reason else ""
+                if proc_msg and bot: await proc_msg.edit_text(f"❌ <b>Ошибка на стороне VPN-сервера</b>\n{reason_line}Ключ не был выдан. Средства возвращены на ваш баланс в боте.")
                 return False
 
             if action == "new":
                 kid = rw_repo.record_key_from_payload(user_id=uid, payload=res, host_name=host)
                 if not kid: 
-                    add_to_balance(uid, float(price))
+                    add_to_balance(uid, float(price), "refund", pay_id)
                     logger.error(f"Возврат средств: {price} RUB возвращено пользователю {uid} (ошибка БД нового ключа)")
                     if proc_msg and bot: await proc_msg.edit_text("❌ При сохранении ключа произошла системная ошибка. Средства возвращены на баланс.")
                     return False
             else:
                 if not rw_repo.update_key(kid, remnawave_user_uuid=res['client_uuid'], expire_at_ms=res['expiry_timestamp_ms']): 
-                    add_to_balance(uid, float(price))
+                    add_to_balance(uid, float(price), "refund", pay_id)
                     logger.error(f"Возврат средств: {price} RUB возвращено пользователю {uid} (ошибка обновления БД)")
                     if proc_msg and bot: await proc_msg.edit_text("❌ Ошибка обновления данных ключа в системе. Средства возвращены на баланс.")
                     return False
@@ -3571,9 +3605,9 @@ async def process_successful_payment(bot: Bot | None, metadata: dict) -> bool:
                         elif rtype == "percent_purchase": reward = (Decimal(str(price)) * Decimal(get_setting("referral_percentage") or "0") / 100).quantize(Decimal("0.01"))
                     
                     if float(reward) > 0:
-                        ref_old_balance = get_balance(int(ref_id))
-                        if add_to_balance(int(ref_id), float(reward)):
-                            ref_new_balance = get_balance(int(ref_id))
+                        ref_new_balance = rw_repo.change_balance(int(ref_id), float(reward), "referral_bonus", p_log_id)
+                        if ref_new_balance is not None:
+                            ref_old_balance = ref_new_balance - float(reward)
                             add_to_referral_balance_all(int(ref_id), float(reward))
                             buyer_username = (u_data.get('username') if u_data else None) or f"@{uid}"
                             ref_user = get_user(int(ref_id)) or {}
@@ -2,7 +2,8 @@ from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Message, CallbackQuery, Chat
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from shop_bot.data_manager.remnawave_repository import get_user, get_setting
+from shop_bot.data_manager import async_repository as arepo
+from shop_bot.data_manager.remnawave_repository import get_setting
 
 class BanMiddleware(BaseMiddleware):
     async def __call__(
@@ -17,7 +18,7 @@ class BanMiddleware(BaseMiddleware):
         if user.is_bot:
             return
 
-        user_data = get_user(user.id)
+        user_data = await arepo.get_user(user.id)
         if user_data and user_data.get('is_banned'):
             ban_message_text = "🚫 Вы заблокированы и не можете использовать этого бота."
 
@@ -0,0 +1,126 @@
+"""Асинхронный доступ к репозиторию для кода, работающего в event loop (хендлеры бота, веб-приложение).
+
+Синхронные функции remnawave_repository выполняются в отдельных пулах потоков: чтение — в пуле
+ограниченного размера (DB_READ_WORKERS), запись — в единственном потоке-писателе, поэтому
+медленный запрос или ожидание блокировки SQLite не останавливают обработку обновлений.
+
+    from shop_bot.data_manager import async_repository as arepo
+    user = await arepo.get_user(user_id)
+"""
+import asyncio
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from shop_bot.data_manager import database
+from shop_bot.data_manager import remnawave_repository as rw_repo
+
+logger = logging.getLogger(__name__)
+
+READ_WORKERS = max(1, int(os.environ.get("DB_READ_WORKERS", "4") or 4))
+
+_read_executor = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix="db-read")
+_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+
+async def run_read(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_read_executor, functools.partial(func, *args, **kwargs))
+
+
+async def run_write(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_write_executor, functools.partial(func, *args, **kwargs))
+
+
+def shutdown(wait: bool = True) -> None:
+    _read_executor.shutdown(wait=wait, cancel_futures=not wait)
+    _write_executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+# ===== АСИНХРОННЫЕ ВЕРСИИ ФУНКЦИЙ РЕПОЗИТОРИЯ =====
+_ASYNC_READS = (
+    "get_user",
+    "get_user_keys",
+    "get_balance",
+    "get_key_by_id",
+    "get_key_by_email",
+    "get_plan_by_id",
+    "get_plans_for_host",
+    "get_all_hosts",
+    "list_squads",
+    "get_host",
+    "get_device_tiers",
+    "get_referral_count",
+    "get_referral_balance_all",
+    "get_seller_user",
+    "get_webapp_settings",
+    "get_admin_stats",
+    "get_admin_financial_stats",
+    "get_dashboard_user_group_counts",
+    "get_users_paginated",
+    "get_keys_paginated",
+)
+
+_ASYNC_WRITES = (
+    "register_user_if_not_exists",
+    "add_to_balance",
+    "deduct_from_balance",
+    "adjust_user_balance",
+    "change_balance",
+    "set_trial_used",
+    "set_terms_agreed",
+    "update_user_stats",
+    "update_key",
+    "log_transaction",
+    "add_support_message",
+)
+
+
+def _make_async(name: str, runner: Callable[..., Any]) -> Callable[..., Any]:
+    func = getattr(rw_repo, name, None) or getattr(database, name)
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        return await runner(func, *args, **kwargs)
+
+    return wrapper
+
+
+for _name in _ASYNC_READS:
+    globals()[_name] = _make_async(_name, run_read)
+for _name in _ASYNC_WRITES:
+    globals()[_name] = _make_async(_name, run_write)
+# ==================================================
+
+
+# ===== ЗАДЕРЖКА EVENT LOOP =====
+# Фоновая задача просыпается каждые interval секунд; опоздание пробуждения — время,
+# на которое loop был занят синхронной работой.
+_loop_lag = {"last_ms": 0.0, "max_ms": 0.0, "samples": 0, "updated_at": 0.0}
+
+
+async def monitor_loop_lag(interval: float = 0.5, warn_ms: float = 250.0) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag_ms = max(0.0, (loop.time() - started - interval) * 1000.0)
+        _loop_lag["last_ms"] = lag_ms
+        _loop_lag["max_ms"] = max(_loop_lag["max_ms"], lag_ms)
+        _loop_lag["samples"] += 1
+        _loop_lag["updated_at"] = time.time()
+        if lag_ms >= warn_ms:
+            logger.warning(f"Event loop был заблокирован на {lag_ms:.0f} мс")
+
+
+def get_loop_lag_stats() -> dict:
+    return dict(_loop_lag)
+
+
+def reset_loop_lag_stats() -> None:
+    _loop_lag.update(last_ms=0.0, max_ms=0.0, samples=0)
+# ===============================
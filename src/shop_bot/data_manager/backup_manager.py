@@ -20,6 +20,7 @@ BACKUPS_DIR.mkdir(parents=True, exist_ok=True)
 DB_FILE: Path = rw_repo.DB_FILE
 ZIP_COMPRESSION = getattr(zipfile, "ZIP_LZMA", zipfile.ZIP_DEFLATED)
 ZIP_COMPRESSLEVEL = 9
+METRICS_BACKUP_PREFIX = "metrics-"
 
 
 def get_msk_time() -> datetime:
@@ -30,18 +31,31 @@ def _timestamp() -> str:
     return get_msk_time().strftime("%Y%m%d-%H%M%S")
 
 
-def _write_compressed_backup(zip_path: Path, db_path: Path) -> None:
+def _write_compressed_backup(zip_path: Path, *db_paths: Path) -> None:
     try:
         with zipfile.ZipFile(zip_path, 'w', compression=ZIP_COMPRESSION) as zf:
-            zf.write(db_path, arcname=db_path.name)
+            for db_path in db_paths:
+                zf.write(db_path, arcname=db_path.name)
     except RuntimeError:
         with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zf:
-            zf.write(db_path, arcname=db_path.name)
+            for db_path in db_paths:
+                zf.write(db_path, arcname=db_path.name)
+
+
+def _copy_sqlite(src_path: Path, dst_path: Path) -> None:
+    with sqlite3.connect(src_path) as src:
+        with sqlite3.connect(dst_path) as dst:
+            src.backup(dst)
+
+
+def _include_metrics_in_backup() -> bool:
+    return (rw_repo.get_setting("backup_include_metrics") or "false").strip().lower() == "true"
 
 
 def create_backup_file() -> Path | None:
     """
     Создаёт zip-архив с консистентной копией SQLite-БД.
+    База метрик (замеры ресурсов, speedtest) добавляется только при backup_include_metrics=true.
     Возвращает путь к архиву или None при ошибке.
     """
     try:
@@ -51,20 +65,25 @@ def create_backup_file() -> Path | None:
         ts = _timestamp()
         tmp_db_copy = BACKUPS_DIR / f"users-{ts}.db"
         zip_path = BACKUPS_DIR / f"db-backup-{ts}.zip"
+        copies = [tmp_db_copy]
 
+        rw_repo.flush_write_batches()
+        _copy_sqlite(DB_FILE, tmp_db_copy)
 
-        with sqlite3.connect(DB_FILE) as src:
-            with sqlite3.connect(tmp_db_copy) as dst:
-                src.backup(dst)
+        metrics_db = rw_repo.get_metrics_db_file()
+        if _include_metrics_in_backup() and metrics_db.exists():
+            copies.append(BACKUPS_DIR / f"{METRICS_BACKUP_PREFIX}{ts}.db")
+            _copy_sqlite(metrics_db, copies[-1])
 
 
-        _write_compressed_backup(zip_path, tmp_db_copy)
+        _write_compressed_backup(zip_path, *copies)
 
 
-        try:
-            tmp_db_copy.unlink(missing_ok=True)
-        except Exception:
-            pass
+        for copy in copies:
+            try:
+                copy.unlink(missing_ok=True)
+            except Exception:
+                pass
 
         logger.info(f"Бэкап: создан файл {zip_path}")
         return zip_path
@@ -150,15 +169,21 @@ def restore_from_file(uploaded_path: Path) -> bool:
         tmp_dir = BACKUPS_DIR / f"restore-{_timestamp()}"
         tmp_dir.mkdir(parents=True, exist_ok=True)
         candidate_db: Path | None = None
+        candidate_metrics_db: Path | None = None
 
         if uploaded_path.suffix.lower() == '.zip':
             try:
                 with zipfile.ZipFile(uploaded_path, 'r') as zf:
                     for n in zf.namelist():
-                        if n.lower().endswith('.db'):
+                        if not n.lower().endswith('.db'):
+                            continue
+                        if Path(n).name.startswith(METRICS_BACKUP_PREFIX):
+                            if candidate_metrics_db is None:
+                                zf.extract(n, path=tmp_dir)
+                                candidate_metrics_db = tmp_dir / n
+                        elif candidate_db is None:
                             zf.extract(n, path=tmp_dir)
                             candidate_db = tmp_dir / n
-                            break
             except Exception as e:
                 logger.error(f"Восстановление: не удалось распаковать архив: {e}")
                 return False
@@ -185,15 +210,19 @@ def restore_from_file(uploaded_path: Path) -> bool:
                 pass
 
 
-        with sqlite3.connect(candidate_db) as src:
-            with sqlite3.connect(DB_FILE) as dst:
-                src.backup(dst)
+        _copy_sqlite(candidate_db, DB_FILE)
+        if candidate_metrics_db and candidate_metrics_db.exists():
+            rw_repo.flush_write_batches()
+            _copy_sqlite(candidate_metrics_db, rw_repo.get_metrics_db_file())
+            logger.info("Восстановление: база метрик восстановлена из архива")
         
 
         try:
             rw_repo.run_migration()
         except Exception:
             pass
+        rw_repo.invalidate_settings_cache()
+        rw_repo.invalidate_hosts_cache()
 
         logger.info("Восстановление: база данных успешно заменена")
         return True
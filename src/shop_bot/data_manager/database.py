@@ -1,9 +1,17 @@
 import sqlite3
+import threading
+import queue
+import atexit
+import base64
+import time
 from datetime import datetime, timezone, timedelta
 import logging
 from pathlib import Path
 import json
 import re
+import sys
+from collections import deque
+from functools import lru_cache
 from typing import Any
 
 logger = logging.getLogger(__name__)
@@ -36,6 +44,12 @@ def _now_str() -> str:
 # ======================
 
 
+# ===== _NOW_MS =====
+def _now_ms() -> int:
+    return int(get_msk_time().timestamp() * 1000)
+# =====================
+
+
 # ===== _TO_DATETIME_STR =====
 def _to_datetime_str(ts_ms: int | None) -> str | None:
     if ts_ms is None:
@@ -81,7 +95,7 @@ def _normalize_key_row(row: sqlite3.Row | dict | None) -> dict | None:
 
 # ===== _GET_TABLE_COLUMNS =====
 def _get_table_columns(cursor: sqlite3.Cursor, table: str) -> set[str]:
-    cursor.execute(f"PRAGMA table_info({table})"); return {row[1] for row in cursor.fetchall()}
+    cursor.execute(f"PRAGMA table_xinfo({table})"); return {row[1] for row in cursor.fetchall()}
 # ==============================
 
 
@@ -112,24 +126,322 @@ def normalize_host_name(name: str | None) -> str:
 # ===============================
 
 
+# ===== ОТДЕЛЬНАЯ БАЗА МЕТРИК =====
+# Замеры ресурсов, их сводки и история speedtest живут в отдельном файле (по умолчанию <имя БД>-metrics.db
+# рядом с основной, путь задаётся переменной METRICS_DB_FILE). Файл подключается к каждому соединению
+# через ATTACH как схема metrics, поэтому запросы обращаются к таблицам по прежним именам.
+# Запись метрик блокирует только этот файл и не конкурирует с платежами; в бэкап он попадает
+# только при включённой настройке backup_include_metrics.
+METRICS_SCHEMA = "metrics"
+_METRICS_TABLES = ("host_speedtests", "resource_metrics", "resource_metrics_rollup")
+
+
+def get_metrics_db_file() -> Path:
+    override = (os.environ.get("METRICS_DB_FILE") or "").strip()
+    if override: return Path(override)
+    db_file = Path(DB_FILE)
+    return db_file.with_name(f"{db_file.stem}-metrics{db_file.suffix or '.db'}")
+
+
+def _file_size(path: Path) -> int:
+    try: return path.stat().st_size
+    except OSError: return 0
+
+
+def _ensure_metrics_schema(cursor: sqlite3.Cursor, backfill: bool = True) -> None:
+    _ensure_host_speedtests_table(cursor, METRICS_SCHEMA)
+    _ensure_resource_metrics_rollups(cursor, METRICS_SCHEMA, backfill)
+
+
+def _attach_metrics_db(conn: sqlite3.Connection) -> None:
+    metrics_file = get_metrics_db_file()
+    is_new = _file_size(metrics_file) == 0
+    conn.execute(f"ATTACH DATABASE ? AS {METRICS_SCHEMA}", (str(metrics_file),))
+    if is_new:
+        # auto_vacuum задаётся до первой записи в файл (в том числе до перевода в WAL)
+        conn.execute(f"PRAGMA {METRICS_SCHEMA}.auto_vacuum=INCREMENTAL")
+    for pragma in ("journal_mode=WAL", "synchronous=NORMAL"):
+        try:
+            conn.execute(f"PRAGMA {METRICS_SCHEMA}.{pragma}")
+        except sqlite3.Error as e:
+            logging.warning(f"Не удалось применить PRAGMA {pragma} к базе метрик: {e}")
+    query = "SELECT 1 FROM {}.sqlite_master WHERE type='table' AND name='resource_metrics'"
+    if conn.execute(query.format(METRICS_SCHEMA)).fetchone() or conn.execute(query.format("main")).fetchone(): return
+    # Файл метрик новый или был удалён: создаём пустые таблицы, чтобы запись и чтение метрик не падали
+    with conn:
+        _ensure_metrics_schema(conn.cursor())
+
+
+def _migrate_metrics_database(cursor: sqlite3.Cursor) -> None:
+    """Переносит таблицы метрик из основной БД в подключённую базу метрик."""
+    _ensure_metrics_schema(cursor, backfill=False)
+    cursor.execute(f"DROP TRIGGER IF EXISTS {METRICS_SCHEMA}.trg_resource_metrics_rollup_insert")
+    for table in _METRICS_TABLES:
+        cursor.execute("SELECT 1 FROM main.sqlite_master WHERE type='table' AND name=?", (table,))
+        if not cursor.fetchone(): continue
+        target_columns = {row[1] for row in cursor.execute(f"PRAGMA {METRICS_SCHEMA}.table_info({table})").fetchall()}
+        columns = ", ".join(row[1] for row in cursor.execute(f"PRAGMA main.table_info({table})").fetchall() if row[1] in target_columns)
+        cursor.execute(f"INSERT OR IGNORE INTO {METRICS_SCHEMA}.{table} ({columns}) SELECT {columns} FROM main.{table}")
+        logging.info(f"Таблица {table} перенесена в базу метрик: {max(0, cursor.rowcount)} строк")
+        cursor.execute(f"DROP TABLE main.{table}")
+    _ensure_metrics_schema(cursor)
+
+
+def clear_monitoring_data() -> tuple[int, int]:
+    """Удаляет все замеры ресурсов (со сводками) и результаты speedtest, сжимает файл метрик."""
+    # Замеры из очереди отложенной записи иначе попадут в базу уже после очистки
+    flush_write_batches()
+    deleted_metrics = _exec("DELETE FROM resource_metrics", (), "Не удалось очистить resource_metrics")
+    _exec("DELETE FROM resource_metrics_rollup", (), "Не удалось очистить resource_metrics_rollup")
+    deleted_speedtests = _exec("DELETE FROM host_speedtests", (), "Не удалось очистить host_speedtests")
+    try:
+        get_db_connection().execute(f"VACUUM {METRICS_SCHEMA}")
+    except sqlite3.Error as e:
+        logging.warning(f"Не удалось сжать базу метрик: {e}")
+    return (deleted_metrics.rowcount if deleted_metrics else 0), (deleted_speedtests.rowcount if deleted_speedtests else 0)
+# =================================
+
+
+# ===== СТАТИСТИКА SQL-ЗАПРОСОВ =====
+# При включённой настройке db_query_stats_enabled (или переменной DB_QUERY_STATS=1) соединения открываются
+# классом _ProfiledConnection: время каждого выражения (выполнение и выборка строк) копится по нормализованному
+# тексту SQL — число вызовов, сумма, максимум и p95 по последним замерам. Выражения дольше db_slow_query_ms
+# (по умолчанию 200 мс) пишутся в лог вместе с местом вызова. Выключенная статистика ничего не стоит:
+# соединения открываются обычным sqlite3.Connection.
+_QUERY_STATS_SAMPLES = 256
+_QUERY_STATS_MAX_STATEMENTS = 1000
+# Обёртки, которые пропускаются при поиске места вызова медленного запроса
+_QUERY_STATS_SKIP_FRAMES = frozenset({
+    "_exec", "_fetch_row", "_fetch_list", "_fetch_val", "_record_query", "_timed_fetch",
+    "execute", "executemany", "executescript", "fetchone", "fetchmany", "fetchall", "__next__", "commit", "__exit__",
+})
+_query_stats: dict[str, dict] = {}
+_query_stats_lock = threading.Lock()
+_query_stats_since: str | None = None
+_query_stats_config: tuple[bool, float] | None = None
+
+
+@lru_cache(maxsize=4096)
+def _normalize_sql(sql: str) -> str:
+    text = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    text = re.sub(r"\b\d+(?:\.\d+)?\b", "?", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    text = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?, ...)", text)
+    return text[:500]
+
+
+def _query_call_site() -> str:
+    """Первая функция вне обёрток БД и её вызывающий: 'get_user (database.py:120) ← handlers.py:45'."""
+    frame = sys._getframe(1)
+    sites = []
+    while frame is not None and len(sites) < 2:
+        code = frame.f_code
+        if code.co_filename != __file__ or code.co_name not in _QUERY_STATS_SKIP_FRAMES:
+            sites.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return " ← ".join(sites) or "?"
+
+
+def _get_query_stats_config() -> tuple[bool, float]:
+    global _query_stats_config
+    if _query_stats_config is None:
+        enabled = os.environ.get("DB_QUERY_STATS", "").strip() == "1"
+        slow_ms = 200.0
+        try:
+            conn = sqlite3.connect(DB_FILE, timeout=30.0)
+            try:
+                rows = dict(conn.execute(
+                    "SELECT key, value FROM bot_settings WHERE key IN ('db_query_stats_enabled', 'db_slow_query_ms')"
+                ).fetchall())
+            finally:
+                conn.close()
+            enabled = enabled or str(rows.get("db_query_stats_enabled") or "").lower() in ("1", "true")
+            slow_ms = float(rows.get("db_slow_query_ms") or slow_ms)
+        except (sqlite3.Error, ValueError):
+            pass
+        _query_stats_config = (enabled, slow_ms)
+    return _query_stats_config
+
+
+def _record_query(sql: str, elapsed: float, sample: list | None = None) -> list:
+    """Добавляет время к замеру выражения; sample — замер текущего вызова (для времени выборки строк)."""
+    with _query_stats_lock:
+        if sample is None:
+            key = _normalize_sql(sql)
+            stat = _query_stats.get(key)
+            if stat is None:
+                if len(_query_stats) >= _QUERY_STATS_MAX_STATEMENTS: key = "<прочие выражения>"
+                stat = _query_stats.setdefault(key, {
+                    "count": 0, "total": 0.0, "max": 0.0, "slow": 0, "samples": deque(maxlen=_QUERY_STATS_SAMPLES),
+                })
+            stat["count"] += 1
+            sample = [elapsed, False, key]
+            stat["samples"].append(sample)
+        else:
+            stat = _query_stats.get(sample[2])
+            if stat is None: return sample
+            sample[0] += elapsed
+        stat["total"] += elapsed
+        if sample[0] > stat["max"]: stat["max"] = sample[0]
+        slow_ms = _get_query_stats_config()[1]
+        slow = not sample[1] and sample[0] * 1000 >= slow_ms
+        if slow:
+            sample[1] = True
+            stat["slow"] += 1
+    if slow:
+        logging.warning(f"Медленный SQL (дольше {slow_ms:.0f} мс) из {_query_call_site()}: {sample[2]}")
+    return sample
+
+
+class _ProfiledCursor(sqlite3.Cursor):
+    _sample: list | None = None
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try: return super().execute(sql, parameters)
+        finally: self._sample = _record_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try: return super().executemany(sql, seq_of_parameters)
+        finally: self._sample = _record_query(sql, time.perf_counter() - started)
+
+    def executescript(self, sql_script):
+        started = time.perf_counter()
+        try: return super().executescript(sql_script)
+        finally: self._sample = _record_query(sql_script, time.perf_counter() - started)
+
+    def _timed_fetch(self, fetch, *args):
+        started = time.perf_counter()
+        try: return fetch(*args)
+        finally:
+            if self._sample is not None: _record_query("", time.perf_counter() - started, self._sample)
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+    def __next__(self):
+        return self._timed_fetch(super().__next__)
+
+
+class _ProfiledConnection(sqlite3.Connection):
+    def cursor(self, factory=None):
+        return super().cursor(factory or _ProfiledCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        started = time.perf_counter()
+        try: return super().commit()
+        finally: _record_query("COMMIT", time.perf_counter() - started)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        started = time.perf_counter()
+        try: return super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            if exc_type is None: _record_query("COMMIT", time.perf_counter() - started)
+
+
+def get_query_stats(limit: int = 20, order_by: str = "total") -> dict:
+    """Топ выражений по сумме (total), p95 или числу вызовов (count); время в миллисекундах."""
+    enabled, slow_ms = _get_query_stats_config()
+    items = []
+    with _query_stats_lock:
+        snapshot = [(sql, dict(stat), sorted(sample[0] for sample in stat["samples"])) for sql, stat in _query_stats.items()]
+    for sql, stat, durations in snapshot:
+        p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))] if durations else 0.0
+        items.append({
+            "sql": sql,
+            "count": stat["count"],
+            "total_ms": round(stat["total"] * 1000, 1),
+            "avg_ms": round(stat["total"] * 1000 / stat["count"], 2) if stat["count"] else 0.0,
+            "p95_ms": round(p95 * 1000, 2),
+            "max_ms": round(stat["max"] * 1000, 1),
+            "slow": stat["slow"],
+        })
+    sort_key = {"p95": "p95_ms", "count": "count"}.get(order_by, "total_ms")
+    items.sort(key=lambda item: item[sort_key], reverse=True)
+    return {"enabled": enabled, "slow_ms": slow_ms, "since": _query_stats_since, "statements": items[:limit]}
+
+
+def reset_query_stats() -> None:
+    global _query_stats_since
+    with _query_stats_lock:
+        _query_stats.clear()
+        _query_stats_since = _now_str()
+# ===================================
+
+
 # ===== GET_DB_CONNECTION =====
-def get_db_connection():
-    conn = sqlite3.connect(DB_FILE, timeout=30.0)
+# Долгоживущие соединения: одно на поток, PRAGMA применяются один раз при открытии.
+# reset_db_connections() повышает поколение — каждый поток переоткроет соединение при следующем обращении.
+_db_local = threading.local()
+_db_generation = 0
+_db_generation_lock = threading.Lock()
+
+
+def _apply_journal_mode(conn: sqlite3.Connection, wal_enabled: bool) -> None:
+    try:
+        conn.execute("PRAGMA journal_mode=WAL" if wal_enabled else "PRAGMA journal_mode=DELETE")
+    except sqlite3.Error as e:
+        logging.warning(f"Не удалось переключить journal_mode: {e}")
+
+
+def _open_db_connection() -> sqlite3.Connection:
+    profiled = _get_query_stats_config()[0]
+    conn = sqlite3.connect(DB_FILE, timeout=30.0, factory=_ProfiledConnection if profiled else sqlite3.Connection)
+    conn.row_factory = sqlite3.Row
     wal_enabled = False
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM bot_settings WHERE key='enable_wal_mode'")
-        row = cursor.fetchone()
-        if row and row[0] == '1':
-            wal_enabled = True
-    except Exception:
+        row = conn.execute("SELECT value FROM bot_settings WHERE key='enable_wal_mode'").fetchone()
+        wal_enabled = bool(row and row[0] == '1')
+    except sqlite3.Error:
         pass
-    if wal_enabled:
-        conn.execute("PRAGMA journal_mode=WAL")
-        conn.execute("PRAGMA busy_timeout=30000")
-    else:
-        conn.execute("PRAGMA journal_mode=DELETE")
+    _apply_journal_mode(conn, wal_enabled)
+    conn.execute("PRAGMA busy_timeout=30000")
+    _attach_metrics_db(conn)
+    return conn
+
+
+def get_db_connection() -> sqlite3.Connection:
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None and getattr(_db_local, "generation", None) == _db_generation:
+        return conn
+    if conn is not None:
+        try: conn.close()
+        except sqlite3.Error: pass
+    conn = _open_db_connection()
+    _db_local.conn = conn
+    _db_local.generation = _db_generation
     return conn
+
+
+def close_db_connection() -> None:
+    conn = getattr(_db_local, "conn", None)
+    _db_local.conn = None
+    if conn is not None:
+        try: conn.close()
+        except sqlite3.Error: pass
+
+
+def reset_db_connections() -> None:
+    global _db_generation
+    with _db_generation_lock:
+        _db_generation += 1
+    close_db_connection()
 # ==============================
 
 
@@ -143,11 +455,12 @@ class DbExecResult:
 # ===== _EXEC =====
 def _exec(sql: str, params: tuple | list = (), error_msg: str = "", commit: bool = True) -> DbExecResult | None:
     try:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-            cursor = conn.cursor()
-            cursor.execute(sql, params)
-            if commit: conn.commit()
-            return DbExecResult(cursor)
+        conn = get_db_connection()
+        with conn:
+            cursor = conn.execute(sql, params)
+            result = DbExecResult(cursor)
+            cursor.close()
+            return result
     except sqlite3.Error as e:
         if error_msg: logging.error(f"{error_msg}: {e}")
         return None
@@ -157,12 +470,10 @@ def _exec(sql: str, params: tuple | list = (), error_msg: str = "", commit: bool
 # ===== _FETCH_ROW =====
 def _fetch_row(sql: str, params: tuple | list = (), error_msg: str = "") -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(sql, params)
-            row = cursor.fetchone()
-            return dict(row) if row else None
+        cursor = get_db_connection().execute(sql, params)
+        row = cursor.fetchone()
+        cursor.close()
+        return dict(row) if row else None
     except sqlite3.Error as e:
         if error_msg: logging.error(f"{error_msg}: {e}")
         return None
@@ -172,11 +483,10 @@ def _fetch_row(sql: str, params: tuple | list = (), error_msg: str = "") -> dict
 # ===== _FETCH_LIST =====
 def _fetch_list(sql: str, params: tuple | list = (), error_msg: str = "") -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(sql, params)
-            return [dict(row) for row in cursor.fetchall()]
+        cursor = get_db_connection().execute(sql, params)
+        rows = cursor.fetchall()
+        cursor.close()
+        return [dict(row) for row in rows]
     except sqlite3.Error as e:
         if error_msg: logging.error(f"{error_msg}: {e}")
         return []
@@ -189,6 +499,170 @@ def _fetch_val(sql: str, params: tuple | list = (), default: Any = None, error_m
     return list(row.values())[0] if row else default
 # ======================
 
+
+# ===== ПАКЕТНАЯ ЗАПИСЬ (GROUP COMMIT) =====
+# Частые вставки (метрики, speedtest, сообщения поддержки) ставятся в очередь и записываются
+# фоновым потоком одной транзакцией: по _WRITE_BATCH_MAX_ROWS строк или раз в _WRITE_BATCH_MAX_DELAY секунд.
+# Режим надёжности задаётся для каждой таблицы (переопределяется переменной DB_WRITE_MODE_<ТАБЛИЦА>):
+#   sync     — запись сразу в вызывающем потоке, как раньше;
+#   group    — вызывающий ждёт коммита, но коммит общий для всех записей, накопившихся в очереди;
+#   deferred — вызов возвращается сразу, строка попадёт в БД со следующим пакетом.
+# Платежи (transactions) остаются синхронными.
+_WRITE_BATCH_MODES = {
+    "resource_metrics": "deferred",
+    "host_speedtests": "deferred",
+    "support_messages": "group",
+    "transactions": "sync",
+}
+_WRITE_BATCH_MAX_ROWS = int(os.environ.get("DB_WRITE_BATCH_ROWS", "500") or 500)
+_WRITE_BATCH_MAX_DELAY = float(os.environ.get("DB_WRITE_BATCH_DELAY", "1.0") or 1.0)
+_WRITE_GROUP_TIMEOUT = 30.0
+
+
+def _write_mode(table: str) -> str:
+    mode = (os.environ.get(f"DB_WRITE_MODE_{table.upper()}") or _WRITE_BATCH_MODES.get(table, "sync")).strip().lower()
+    return mode if mode in ("sync", "group", "deferred") else "sync"
+
+
+class _WriteItem:
+    __slots__ = ("table", "statements", "error_msg", "done", "result")
+
+    def __init__(self, table: str | None, statements: list, error_msg: str = "", wait: bool = False):
+        self.table = table; self.statements = statements; self.error_msg = error_msg
+        self.done = threading.Event() if wait else None
+        self.result = None
+
+
+class _WriteBatcher:
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self.stats = {"batches": 0, "rows": 0, "max_batch": 0, "errors": 0}
+
+    def submit(self, item: _WriteItem) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="db-write-batch", daemon=True)
+                    self._thread.start()
+        self._queue.put(item)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        if self._thread is None or not self._thread.is_alive(): return True
+        marker = _WriteItem(None, [], wait=True)
+        self._queue.put(marker)
+        return marker.done.wait(timeout)
+
+    def stop(self, timeout: float | None = 10.0) -> None:
+        thread = self._thread
+        if thread is None or not thread.is_alive(): return
+        self._queue.put(None)
+        thread.join(timeout)
+
+    def _collect(self, first: _WriteItem) -> tuple[list, bool]:
+        batch = [first]
+        urgent = first.done is not None
+        deadline = time.monotonic() + _WRITE_BATCH_MAX_DELAY
+        while len(batch) < _WRITE_BATCH_MAX_ROWS:
+            remaining = 0.0 if urgent else deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None: return batch, True
+            batch.append(item)
+            urgent = urgent or item.done is not None
+        return batch, False
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None: break
+            batch, stopping = self._collect(first)
+            self._commit(batch)
+        while True:
+            try: item = self._queue.get_nowait()
+            except queue.Empty: break
+            if item is not None: self._commit([item])
+        close_db_connection()
+
+    def _commit(self, batch: list) -> None:
+        rows = [item for item in batch if item.statements]
+        if rows:
+            try:
+                conn = get_db_connection()
+                with conn:
+                    for item in rows: item.result = self._apply(conn, item)
+            except sqlite3.Error as e:
+                logging.warning(f"Пакетная запись ({len(rows)} строк) не удалась, повторяю по одной: {e}")
+                for item in rows: item.result = self._apply_single(item)
+            self.stats["batches"] += 1
+            self.stats["rows"] += len(rows)
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(rows))
+        for item in batch:
+            if item.done is not None: item.done.set()
+
+    @staticmethod
+    def _apply(conn: sqlite3.Connection, item: _WriteItem) -> int | None:
+        result = None
+        for i, (sql, params) in enumerate(item.statements):
+            cursor = conn.execute(sql, params)
+            if i == 0: result = cursor.lastrowid
+            cursor.close()
+        return result
+
+    def _apply_single(self, item: _WriteItem) -> int | None:
+        try:
+            conn = get_db_connection()
+            with conn:
+                return self._apply(conn, item)
+        except sqlite3.Error as e:
+            self.stats["errors"] += 1
+            if item.error_msg: logging.error(f"{item.error_msg}: {e}")
+            return None
+
+
+_write_batcher = _WriteBatcher()
+atexit.register(lambda: _write_batcher.stop())
+
+
+def _append_row(table: str, statements: list, error_msg: str = "") -> int | None:
+    """Вставка через пакетную запись; возвращает lastrowid первого выражения (в режиме deferred — None)."""
+    mode = _write_mode(table)
+    if mode == "sync":
+        result = None
+        try:
+            conn = get_db_connection()
+            with conn:
+                result = _WriteBatcher._apply(conn, _WriteItem(table, statements))
+        except sqlite3.Error as e:
+            if error_msg: logging.error(f"{error_msg}: {e}")
+        return result
+    item = _WriteItem(table, statements, error_msg, wait=(mode == "group"))
+    _write_batcher.submit(item)
+    if item.done is None: return None
+    if not item.done.wait(_WRITE_GROUP_TIMEOUT):
+        logging.warning(f"Пакетная запись в {table} не подтверждена за {_WRITE_GROUP_TIMEOUT:.0f} с")
+    return item.result
+
+
+def flush_write_batches(timeout: float | None = 10.0) -> bool:
+    return _write_batcher.flush(timeout)
+
+
+def stop_write_batcher(timeout: float | None = 10.0) -> None:
+    _write_batcher.stop(timeout)
+
+
+def get_write_batch_stats() -> dict:
+    stats = dict(_write_batcher.stats)
+    stats["queued"] = _write_batcher._queue.qsize()
+    stats["modes"] = {table: _write_mode(table) for table in _WRITE_BATCH_MODES}
+    return stats
+# ==========================================
+
 # ===== УНИВЕРСАЛЬНЫЕ ХЕЛПЕРЫ DRY =====
 
 def _check_rowcount(cursor, entity_name: str, context: str = "") -> bool:
@@ -215,9 +689,16 @@ def _get_count_stat(query: str, default=0) -> int:
 
 # ===== INITIALIZE_DB =====
 def initialize_db():
+    started = time.perf_counter()
+    version = get_schema_version()
+    if version >= SCHEMA_VERSION:
+        logging.info(f"Схема базы данных актуальна (версия {version}), проверка заняла {(time.perf_counter() - started) * 1000:.1f} мс")
+        return
     try:
         with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
             cursor = conn.cursor()
+            # Для новой базы: освобождённые страницы можно возвращать частями (run_db_maintenance)
+            cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     telegram_id INTEGER PRIMARY KEY,
@@ -630,6 +1111,7 @@ def initialize_db():
                 "demo_mode_enabled": "0",
             }
             _ensure_default_values(cursor, "bot_settings", default_settings)
+            _ensure_settings_version_table(cursor)
             conn.commit()
             
 
@@ -655,7 +1137,7 @@ def initialize_db():
             except sqlite3.OperationalError:
                 pass
             
-            logging.info("База данных инициализирована")
+            logging.info(f"База данных инициализирована за {(time.perf_counter() - started) * 1000:.0f} мс")
         
         run_migration()
         
@@ -664,6 +1146,49 @@ def initialize_db():
 # =========================
 
 
+# ===== _ENSURE_SETTINGS_VERSION_TABLE =====
+# Счётчик изменений bot_settings: триггеры увеличивают его при любой записи,
+# что позволяет кэшу настроек замечать изменения из других процессов.
+def _ensure_settings_version_table(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_settings_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO bot_settings_version (id, version) VALUES (1, 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_bot_settings_version_{event.lower()}
+            AFTER {event} ON bot_settings
+            BEGIN
+                UPDATE bot_settings_version SET version = version + 1 WHERE id = 1;
+            END
+        """)
+# ===========================================
+
+
+# ===== _ENSURE_HOSTS_VERSION_TABLE =====
+# Счётчик изменений xui_hosts для кэша хостов (см. get_host_cached)
+def _ensure_hosts_version_table(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS xui_hosts_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO xui_hosts_version (id, version) VALUES (1, 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_xui_hosts_version_{event.lower()}
+            AFTER {event} ON xui_hosts
+            BEGIN
+                UPDATE xui_hosts_version SET version = version + 1 WHERE id = 1;
+            END
+        """)
+# ========================================
+
+
 # ===== _ENSURE_DEFAULT_VALUES =====
 def _ensure_default_values(cursor: sqlite3.Cursor, table: str, defaults: dict) -> None:
     for key, value in defaults.items():
@@ -700,13 +1225,30 @@ def _ensure_users_columns(cursor: sqlite3.Cursor) -> None:
 
 # =================================
 
+
+# ===== _ENSURE_USERS_LIST_ORDER =====
+# list_order — ключ сортировки списка пользователей в админке (закреплённые сверху, затем по дате регистрации);
+# индекс (list_order, telegram_id) позволяет листать список курсором.
+_USER_LIST_ORDER = "TEXT GENERATED ALWAYS AS (COALESCE(is_pinned, 0) || ' ' || COALESCE(registration_date, '')) VIRTUAL"
+
+
+def _ensure_users_list_order(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
+    if not cursor.fetchone(): return
+    _ensure_table_column(cursor, "users", "list_order", _USER_LIST_ORDER)
+    _ensure_index(cursor, "idx_users_list_order", "users", "list_order")
+
+
+# ====================================
+
 # ===== DELETE_USER =====
 def delete_user(telegram_id: int) -> bool:
     try:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+        with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
+            invalidate_page_totals("users")
             return cursor.rowcount > 0
     except sqlite3.Error as e:
         logger.error(f"Ошибка удаления пользователя {telegram_id}: {e}")
@@ -802,6 +1344,63 @@ def _ensure_support_tickets_columns(cursor: sqlite3.Cursor) -> None:
 # ===========================================
 
 
+# ===== _ENSURE_SUPPORT_TICKETS_QUEUE =====
+# last_sender — отправитель последнего сообщения тикета, поддерживается триггерами на support_messages.
+# queue_weight — позиция в очереди поддержки (3 — ждёт ответа админа, 2 — открыт, 1 — закрыт),
+# индекс по (queue_weight, updated_at) позволяет листать тикеты курсором без сортировки.
+_SUPPORT_TICKET_QUEUE_WEIGHT = """INTEGER GENERATED ALWAYS AS (CASE
+        WHEN status = 'open' AND last_sender != 'admin' THEN 3
+        WHEN status = 'open' THEN 2
+        ELSE 1
+    END) VIRTUAL"""
+
+_SUPPORT_LAST_SENDER_SQL = """
+    UPDATE support_tickets SET last_sender = (
+        SELECT sender FROM support_messages
+        WHERE ticket_id = {ref}.ticket_id
+        ORDER BY created_at DESC, message_id DESC LIMIT 1
+    ) WHERE ticket_id = {ref}.ticket_id;"""
+
+
+def _ensure_support_tickets_queue(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name IN ('support_tickets', 'support_messages')")
+    if cursor.fetchone()[0] < 2: return
+    backfill = "last_sender" not in _get_table_columns(cursor, "support_tickets")
+    _ensure_table_column(cursor, "support_tickets", "last_sender", "TEXT")
+    _ensure_table_column(cursor, "support_tickets", "queue_weight", _SUPPORT_TICKET_QUEUE_WEIGHT)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_support_messages_last_sender_insert
+        AFTER INSERT ON support_messages
+        BEGIN{_SUPPORT_LAST_SENDER_SQL.format(ref='NEW')}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_support_messages_last_sender_delete
+        AFTER DELETE ON support_messages
+        BEGIN{_SUPPORT_LAST_SENDER_SQL.format(ref='OLD')}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_support_messages_last_sender_update
+        AFTER UPDATE OF ticket_id, sender, created_at ON support_messages
+        BEGIN{_SUPPORT_LAST_SENDER_SQL.format(ref='OLD')}{_SUPPORT_LAST_SENDER_SQL.format(ref='NEW')}
+        END
+    """)
+    if backfill:
+        cursor.execute("""
+            UPDATE support_tickets SET last_sender = (
+                SELECT sender FROM support_messages m
+                WHERE m.ticket_id = support_tickets.ticket_id
+                ORDER BY m.created_at DESC, m.message_id DESC LIMIT 1
+            )
+        """)
+    _ensure_index(cursor, "idx_support_tickets_queue", "support_tickets", "queue_weight, updated_at")
+    _ensure_index(cursor, "idx_support_tickets_status_queue", "support_tickets", "status, queue_weight, updated_at")
+
+
+# =========================================
+
+
 # ===== _ENSURE_SUPPORT_MESSAGES_COLUMNS =====
 def _ensure_support_messages_columns(cursor: sqlite3.Cursor) -> None:
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='support_messages'")
@@ -812,6 +1411,208 @@ def _ensure_support_messages_columns(cursor: sqlite3.Cursor) -> None:
 # ============================================
 
 
+# ===== _ENSURE_TRANSACTIONS_COLUMNS =====
+# Поля metadata, по которым фильтруют дашборд и статистика, вынесены в виртуальные
+# генерируемые колонки: значения считаются из metadata при записи индекса, поэтому
+# существующие строки попадают в индексы при их создании, а новые — автоматически.
+_TX_META_JSON = "CASE WHEN json_valid(metadata) THEN json_extract(metadata, '{path}') END"
+_TRANSACTIONS_GENERATED_COLUMNS = {
+    "status_norm": "TEXT GENERATED ALWAYS AS (LOWER(COALESCE(status, ''))) VIRTUAL",
+    "method_norm": "TEXT GENERATED ALWAYS AS (LOWER(COALESCE(payment_method, ''))) VIRTUAL",
+    "meta_action": f"TEXT GENERATED ALWAYS AS (LOWER(COALESCE({_TX_META_JSON.format(path='$.action')}, ''))) VIRTUAL",
+    "meta_reason": f"TEXT GENERATED ALWAYS AS (LOWER(COALESCE({_TX_META_JSON.format(path='$.reason')}, ''))) VIRTUAL",
+    "meta_plan_id": f"INTEGER GENERATED ALWAYS AS (CAST({_TX_META_JSON.format(path='$.plan_id')} AS INTEGER)) VIRTUAL",
+    "meta_key_id": f"INTEGER GENERATED ALWAYS AS (CAST({_TX_META_JSON.format(path='$.key_id')} AS INTEGER)) VIRTUAL",
+    "meta_host_name": f"TEXT GENERATED ALWAYS AS (COALESCE({_TX_META_JSON.format(path='$.host_name')}, {_TX_META_JSON.format(path='$.host')})) VIRTUAL",
+    "meta_months": f"INTEGER GENERATED ALWAYS AS (CAST({_TX_META_JSON.format(path='$.months')} AS INTEGER)) VIRTUAL",
+    "meta_customer_email": f"TEXT GENERATED ALWAYS AS ({_TX_META_JSON.format(path='$.customer_email')}) VIRTUAL",
+}
+
+
+def _ensure_transactions_columns(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transactions'")
+    if not cursor.fetchone(): return
+    for column, definition in _TRANSACTIONS_GENERATED_COLUMNS.items():
+        _ensure_table_column(cursor, "transactions", column, definition)
+    _ensure_index(cursor, "idx_transactions_user_id", "transactions", "user_id")
+    _ensure_index(cursor, "idx_transactions_created_date", "transactions", "created_date")
+    _ensure_index(cursor, "idx_transactions_status_created", "transactions", "status_norm, created_date")
+    _ensure_index(cursor, "idx_transactions_method_created", "transactions", "method_norm, created_date")
+    _ensure_index(cursor, "idx_transactions_action_created", "transactions", "meta_action, created_date")
+    _ensure_index(cursor, "idx_transactions_plan_id", "transactions", "meta_plan_id")
+    _ensure_index(cursor, "idx_transactions_key_id", "transactions", "meta_key_id")
+    _ensure_index(cursor, "idx_transactions_host_name", "transactions", "meta_host_name")
+
+
+# ========================================
+
+
+# ===== _ENSURE_TRANSACTION_ROLLUPS_TABLE =====
+# Сводка transactions по часам (день × час × статус × метод × действие → количество, суммы).
+# Поддерживается триггерами в той же транзакции, что и запись в transactions, поэтому
+# финансовые страницы читают только её. rebuild_transaction_rollups() пересобирает историю.
+_TX_ROLLUP_ACTION = """CASE
+        WHEN {p}meta_action IN ('topup', 'top_up') OR {p}meta_reason = 'external_balance_top_up' THEN 'topup'
+        WHEN {p}meta_action IN ('new', 'extend') THEN {p}meta_action
+        WHEN {p}meta_reason = 'subscription_purchase_or_extend' THEN 'subscription'
+        ELSE {p}meta_action
+    END"""
+_TX_ROLLUP_KEYS = """
+    COALESCE(date({p}created_date), ''),
+    COALESCE(CAST(strftime('%H', {p}created_date) AS INTEGER), 0),
+    {p}status_norm,
+    COALESCE({p}payment_method, ''),
+    """ + _TX_ROLLUP_ACTION
+_TX_ROLLUP_COLUMNS = "day, hour, status, payment_method, action, tx_count, amount_sum, amount_abs_sum"
+
+
+def _tx_rollup_apply_sql(prefix: str, sign: int) -> str:
+    return f"""
+        INSERT INTO transaction_rollups ({_TX_ROLLUP_COLUMNS})
+        VALUES ({_TX_ROLLUP_KEYS.format(p=prefix)},
+            {sign}, {sign} * COALESCE({prefix}amount_rub, 0), {sign} * ABS(COALESCE({prefix}amount_rub, 0)))
+        ON CONFLICT (day, hour, status, payment_method, action) DO UPDATE SET
+            tx_count = tx_count + excluded.tx_count,
+            amount_sum = amount_sum + excluded.amount_sum,
+            amount_abs_sum = amount_abs_sum + excluded.amount_abs_sum;
+    """
+
+
+def _rebuild_transaction_rollups(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("DELETE FROM transaction_rollups")
+    cursor.execute(f"""
+        INSERT INTO transaction_rollups ({_TX_ROLLUP_COLUMNS})
+        SELECT {_TX_ROLLUP_KEYS.format(p='')},
+               COUNT(*), SUM(COALESCE(amount_rub, 0)), SUM(ABS(COALESCE(amount_rub, 0)))
+        FROM transactions
+        GROUP BY 1, 2, 3, 4, 5
+    """)
+
+
+def _ensure_transaction_rollups_table(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transactions'")
+    if not cursor.fetchone(): return
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transaction_rollups'")
+    created = cursor.fetchone() is None
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS transaction_rollups (
+            day TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            payment_method TEXT NOT NULL,
+            action TEXT NOT NULL,
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            amount_sum REAL NOT NULL DEFAULT 0,
+            amount_abs_sum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, hour, status, payment_method, action)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_transaction_rollups_insert
+        AFTER INSERT ON transactions
+        BEGIN
+            {_tx_rollup_apply_sql('NEW.', 1)}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_transaction_rollups_delete
+        AFTER DELETE ON transactions
+        BEGIN
+            {_tx_rollup_apply_sql('OLD.', -1)}
+            DELETE FROM transaction_rollups WHERE tx_count = 0;
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_transaction_rollups_update
+        AFTER UPDATE OF status, payment_method, amount_rub, metadata, created_date ON transactions
+        BEGIN
+            {_tx_rollup_apply_sql('OLD.', -1)}
+            {_tx_rollup_apply_sql('NEW.', 1)}
+            DELETE FROM transaction_rollups WHERE tx_count = 0;
+        END
+    """)
+    if created:
+        _rebuild_transaction_rollups(cursor)
+        logging.info("Сводка transaction_rollups создана и заполнена по истории транзакций")
+
+
+# =============================================
+
+
+# ===== _ENSURE_USER_PURCHASE_STATS_TABLE =====
+# Покупки подписок по пользователю (количество, сумма, месяцы) для групп дашборда.
+# Ведётся триггерами так же, как transaction_rollups; месяцы фиксируются на момент записи.
+_TX_PURCHASE_CONDITION = """
+        {p}status_norm IN ('paid', 'completed', 'success', 'succeeded')
+        AND {p}method_norm NOT IN ('admin', 'referral')
+        AND (
+            {p}meta_action IN ('new', 'extend')
+            OR {p}meta_reason = 'subscription_purchase_or_extend'
+            OR {p}meta_plan_id IS NOT NULL
+            OR {p}meta_key_id IS NOT NULL
+            OR {p}meta_host_name IS NOT NULL
+            OR {p}meta_customer_email IS NOT NULL
+        )"""
+_TX_PURCHASE_MONTHS = "COALESCE({p}meta_months, (SELECT p.months FROM plans p WHERE p.plan_id = {p}meta_plan_id), 0)"
+
+
+def _user_purchase_apply_sql(prefix: str, sign: int) -> str:
+    return f"""
+        INSERT INTO user_purchase_stats (user_id, purchase_count, total_spent, months_bought)
+        VALUES ({prefix}user_id, {sign}, {sign} * COALESCE({prefix}amount_rub, 0), {sign} * {_TX_PURCHASE_MONTHS.format(p=prefix)})
+        ON CONFLICT (user_id) DO UPDATE SET
+            purchase_count = purchase_count + excluded.purchase_count,
+            total_spent = total_spent + excluded.total_spent,
+            months_bought = months_bought + excluded.months_bought;
+    """
+
+
+def _rebuild_user_purchase_stats(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("DELETE FROM user_purchase_stats")
+    cursor.execute(f"""
+        INSERT INTO user_purchase_stats (user_id, purchase_count, total_spent, months_bought)
+        SELECT t.user_id, COUNT(*), SUM(COALESCE(t.amount_rub, 0)), SUM({_TX_PURCHASE_MONTHS.format(p='t.')})
+        FROM transactions t
+        WHERE {_TX_PURCHASE_CONDITION.format(p='t.')}
+        GROUP BY t.user_id
+    """)
+
+
+def _ensure_user_purchase_stats_table(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transactions'")
+    if not cursor.fetchone(): return
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user_purchase_stats'")
+    created = cursor.fetchone() is None
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_purchase_stats (
+            user_id INTEGER PRIMARY KEY,
+            purchase_count INTEGER NOT NULL DEFAULT 0,
+            total_spent REAL NOT NULL DEFAULT 0,
+            months_bought INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    watched = "user_id, status, payment_method, amount_rub, metadata"
+    for name, event, prefix, sign in (
+        ("insert", "INSERT", "NEW.", 1),
+        ("delete", "DELETE", "OLD.", -1),
+        ("update_old", f"UPDATE OF {watched}", "OLD.", -1),
+        ("update_new", f"UPDATE OF {watched}", "NEW.", 1),
+    ):
+        cleanup = "DELETE FROM user_purchase_stats WHERE user_id = OLD.user_id AND purchase_count = 0;" if sign < 0 else ""
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_user_purchase_stats_{name}
+            AFTER {event} ON transactions
+            WHEN {_TX_PURCHASE_CONDITION.format(p=prefix)}
+            BEGIN
+                {_user_purchase_apply_sql(prefix, sign)}
+                {cleanup}
+            END
+        """)
+    if created:
+        _rebuild_user_purchase_stats(cursor)
+        logging.info("Таблица user_purchase_stats создана и заполнена по истории транзакций")
+
+
 # ===== _FINALIZE_VPN_KEY_INDEXES =====
 def _finalize_vpn_key_indexes(cursor: sqlite3.Cursor) -> None:
     _ensure_unique_index(cursor, "uq_vpn_keys_email", "vpn_keys", "email")
@@ -819,11 +1620,157 @@ def _finalize_vpn_key_indexes(cursor: sqlite3.Cursor) -> None:
     _ensure_index(cursor, "idx_vpn_keys_user_id", "vpn_keys", "user_id")
     _ensure_index(cursor, "idx_vpn_keys_rem_uuid", "vpn_keys", "remnawave_user_uuid")
     _ensure_index(cursor, "idx_vpn_keys_expire_at", "vpn_keys", "expire_at")
+    _ensure_index(cursor, "idx_vpn_keys_user_segments", "vpn_keys", "user_id, key_email, expire_at")
 
 
 # =====================================
 
 
+# ===== _ENSURE_VPN_KEYS_EXPIRY_COLUMN =====
+# expire_at хранится строкой (МСК без зоны, у старых записей — ISO с Z/смещением).
+# expire_at_ms — канонический момент окончания в epoch ms, вычисляется из expire_at,
+# индекс по нему позволяет выбирать истекающие/истёкшие ключи диапазоном.
+_VPN_KEY_EXPIRE_AT_MS = """INTEGER GENERATED ALWAYS AS (CASE
+        WHEN typeof(expire_at) IN ('integer', 'real') THEN CAST(expire_at AS INTEGER)
+        WHEN julianday(expire_at) IS NULL THEN NULL
+        ELSE CAST(ROUND((julianday(expire_at) - 2440587.5) * 86400000) AS INTEGER)
+            - CASE WHEN expire_at LIKE '%Z' OR substr(expire_at, -6) GLOB '[+-][0-9][0-9]:[0-9][0-9]' THEN 0 ELSE 10800000 END
+    END) VIRTUAL"""
+
+
+def _ensure_vpn_keys_expiry_column(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='vpn_keys'")
+    if not cursor.fetchone(): return
+    _ensure_table_column(cursor, "vpn_keys", "expire_at_ms", _VPN_KEY_EXPIRE_AT_MS)
+    _ensure_index(cursor, "idx_vpn_keys_expire_at_ms", "vpn_keys", "expire_at_ms")
+
+
+# ==========================================
+
+
+# ===== _ENSURE_ADMIN_SEARCH_INDEX =====
+# admin_search — полнотекстовый индекс FTS5 (trigram, поиск по подстроке) для поиска в админке.
+# Документы: пользователь (telegram_id, username), ключ (key_id, user_id, хост, email, UUID, ссылка подписки)
+# и платёж (payment_id). rowid = id * 4 + вид документа: триггеры обновляют документ по rowid,
+# а поиск получает id найденных записей прямо из rowid, не читая содержимое индекса.
+_ADMIN_SEARCH_DOCS = {
+    "users": ("user", 1, "{p}telegram_id",
+              "{p}telegram_id || ' ' || COALESCE({p}username, '')",
+              "telegram_id, username"),
+    "vpn_keys": ("key", 2, "{p}key_id",
+                 "{p}key_id || ' ' || {p}user_id || ' ' || COALESCE({p}host_name, '') || ' ' || COALESCE({p}key_email, {p}email, '')"
+                 " || ' ' || COALESCE({p}remnawave_user_uuid, '') || ' ' || COALESCE({p}subscription_url, '')",
+                 "user_id, host_name, email, key_email, remnawave_user_uuid, subscription_url"),
+    "transactions": ("payment", 3, "{p}transaction_id",
+                     "COALESCE({p}payment_id, '')",
+                     "payment_id"),
+}
+
+
+def _admin_search_values(table: str, prefix: str) -> str:
+    kind, code, ref, body, _ = _ADMIN_SEARCH_DOCS[table]
+    return f"{ref.format(p=prefix)} * 4 + {code}, {body.format(p=prefix)}, '{kind}'"
+
+
+def _admin_search_delete_sql(table: str, prefix: str) -> str:
+    _, code, ref, _, _ = _ADMIN_SEARCH_DOCS[table]
+    return f"DELETE FROM admin_search WHERE rowid = {ref.format(p=prefix)} * 4 + {code}"
+
+
+def _fill_admin_search_index(cursor: sqlite3.Cursor) -> None:
+    for table in _ADMIN_SEARCH_DOCS:
+        cursor.execute(f"INSERT INTO admin_search (rowid, body, kind) SELECT {_admin_search_values(table, '')} FROM {table}")
+
+
+def _ensure_admin_search_index(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='admin_search'")
+    created = cursor.fetchone() is None
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS admin_search USING fts5(
+                body, kind UNINDEXED,
+                tokenize = 'trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logging.warning(f"FTS5 недоступен, поиск в админке не будет проиндексирован: {e}")
+        return
+    for table, (_, _, _, _, watched) in _ADMIN_SEARCH_DOCS.items():
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_admin_search_{table}_insert
+            AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO admin_search (rowid, body, kind) VALUES ({_admin_search_values(table, 'NEW.')});
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_admin_search_{table}_update
+            AFTER UPDATE OF {watched} ON {table}
+            BEGIN
+                {_admin_search_delete_sql(table, 'OLD.')};
+                INSERT INTO admin_search (rowid, body, kind) VALUES ({_admin_search_values(table, 'NEW.')});
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_admin_search_{table}_delete
+            AFTER DELETE ON {table}
+            BEGIN
+                {_admin_search_delete_sql(table, 'OLD.')};
+            END
+        """)
+    if created: _fill_admin_search_index(cursor)
+
+
+_admin_search_state: tuple[tuple, bool] | None = None
+
+
+def _admin_search_available() -> bool:
+    """Есть ли таблица admin_search: без FTS5/trigram миграция её не создаёт. Проверка кэшируется до смены базы."""
+    global _admin_search_state
+    key = (str(DB_FILE), _db_generation)
+    if _admin_search_state is None or _admin_search_state[0] != key:
+        row = _fetch_row("SELECT 1 AS ok FROM sqlite_master WHERE type='table' AND name='admin_search'", (), "Не удалось проверить поисковый индекс")
+        _admin_search_state = (key, row is not None)
+    return _admin_search_state[1]
+
+
+def _admin_search_match(q: str) -> tuple[str, tuple] | None:
+    """Условие MATCH по admin_search (фраза trigram). Для запросов короче 3 символов индекс не работает — None,
+    как и без самого индекса: тогда вызывающий ищет через _admin_search_like."""
+    q = (q or "").strip()
+    if len(q) < 3 or not _admin_search_available(): return None
+    return "admin_search MATCH ?", ('"' + q.replace('"', '""') + '"',)
+
+
+def _admin_search_like(table: str, alias: str) -> str:
+    """Текст документа, собранный по строке таблицы, — для LIKE по коротким запросам."""
+    return f"({_ADMIN_SEARCH_DOCS[table][3].format(p=alias + '.')}) LIKE ?"
+
+
+def _admin_search_ids_sql(match_sql: str, table: str) -> str:
+    """id найденных документов одного вида — из rowid, без чтения содержимого индекса."""
+    code = _ADMIN_SEARCH_DOCS[table][1]
+    return f"SELECT (rowid - {code}) / 4 FROM admin_search WHERE {match_sql} AND (rowid - {code}) % 4 = 0"
+
+
+def rebuild_admin_search_index() -> int:
+    global _admin_search_state
+    try:
+        conn = get_db_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("DROP TABLE IF EXISTS admin_search")
+            _ensure_admin_search_index(cursor)
+            rows = cursor.execute("SELECT COUNT(*) FROM admin_search").fetchone()[0]
+        _admin_search_state = None
+        logging.info(f"Поисковый индекс админки пересобран: {rows} документов")
+        return int(rows)
+    except sqlite3.Error as e: logging.error(f"Не удалось пересобрать поисковый индекс: {e}"); return 0
+
+
+# ======================================
+
+
 # ===== _REBUILD_VPN_KEYS_TABLE =====
 def _rebuild_vpn_keys_table(cursor: sqlite3.Cursor) -> None:
     columns = _get_table_columns(cursor, "vpn_keys")
@@ -1008,88 +1955,179 @@ def _ensure_webapp_settings_table(cursor: sqlite3.Cursor):
 
 
 # ===== RUN_MIGRATION =====
-def run_migration():
-    if not DB_FILE.exists(): logging.error("Файл базы данных отсутствует, миграция пропущена."); return
+# ===== МИГРАЦИИ И ВЕРСИЯ СХЕМЫ =====
+# schema_version хранит номер последней применённой миграции. Миграции упорядочены и применяются по одному разу,
+# поэтому запуск с актуальной базой ограничивается одной проверкой версии.
+# Любое изменение схемы или значений по умолчанию (настройки, кнопки) — новая запись в конце _MIGRATIONS.
+# Шаги идемпотентны: если миграция прервалась, при следующем запуске она выполнится заново.
+def _migrate_base_schema(cursor: sqlite3.Cursor) -> None:
+    _ensure_users_columns(cursor)
+    _ensure_hosts_columns(cursor)
+    _ensure_device_tiers_table(cursor)
+    _ensure_plans_columns(cursor)
+    _ensure_support_tickets_columns(cursor)
+    _ensure_support_messages_columns(cursor)
+    _ensure_transactions_columns(cursor)
+    _ensure_vpn_keys_schema(cursor)
+    _ensure_table_column(cursor, "vpn_keys", "comment_key", "TEXT")
+    _ensure_table_column(cursor, "vpn_keys", "is_pinned", "BOOLEAN DEFAULT 0")
+    _ensure_ssh_targets_table(cursor)
+    _ensure_host_speedtests_table(cursor)
+    _ensure_resource_metrics_table(cursor)
+    _ensure_gift_tokens_table(cursor)
+    _ensure_promo_tables(cursor)
+    _ensure_webapp_settings_table(cursor)
+    try:
+        cursor.execute("ALTER TABLE seller_users RENAME COLUMN sellr_ref TO seller_ref")
+        logging.info("Переименована колонка sellr_ref в seller_ref в таблице seller_users")
+    except Exception:
+        pass
 
-    logging.info("Запуск миграций базы данных: %s", DB_FILE)
+    _ensure_seller_users_table(cursor)
 
     try:
-        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA foreign_keys = OFF")
-            _ensure_users_columns(cursor)
-            _ensure_hosts_columns(cursor)
-            _ensure_device_tiers_table(cursor)
-            _ensure_plans_columns(cursor)
-            _ensure_support_tickets_columns(cursor)
-            _ensure_support_messages_columns(cursor)
-            _ensure_vpn_keys_schema(cursor)
-            _ensure_table_column(cursor, "vpn_keys", "comment_key", "TEXT")
-            _ensure_table_column(cursor, "vpn_keys", "is_pinned", "BOOLEAN DEFAULT 0")
-            _ensure_ssh_targets_table(cursor)
-            _ensure_host_speedtests_table(cursor)
-            _ensure_resource_metrics_table(cursor)
-            _ensure_gift_tokens_table(cursor)
-            _ensure_promo_tables(cursor)
-            _ensure_webapp_settings_table(cursor)
-            try:
-                cursor.execute("ALTER TABLE seller_users RENAME COLUMN sellr_ref TO seller_ref")
-                logging.info("Переименована колонка sellr_ref в seller_ref в таблице seller_users")
-            except Exception:
-                pass
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_tickets_thread ON support_tickets(forum_chat_id, message_thread_id)")
+    except Exception:
+        pass
 
-            _ensure_seller_users_table(cursor)
+    try:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pending_transactions (
+                payment_id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                amount_rub REAL,
+                metadata TEXT,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    except Exception:
+        pass
 
-            try:
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_tickets_thread ON support_tickets(forum_chat_id, message_thread_id)")
-            except Exception:
-                pass
+    _ensure_default_values(cursor, "bot_settings", {
+        "skip_email": "0",
+        "enable_wal_mode": "0",
+        "dashboard_layout": "sidebar",
+        "demo_mode_enabled": "0"
+    })
 
-            try:
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS pending_transactions (
-                        payment_id TEXT PRIMARY KEY,
-                        user_id INTEGER NOT NULL,
-                        amount_rub REAL,
-                        metadata TEXT,
-                        status TEXT DEFAULT 'pending',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            except Exception:
-                pass
-            
-            _ensure_default_values(cursor, "bot_settings", {
-                "skip_email": "0",
-                "enable_wal_mode": "0",
-                "dashboard_layout": "sidebar",
-                "demo_mode_enabled": "0"
-            })
-            
-            _ensure_default_values(cursor, "other", {
-                "theme_newsletter": json.dumps({}),
-                "auto_start_bot": "0"
-            })
-            
-            _ensure_pending_transactions_table(cursor)
-            _ensure_default_button_configs(cursor)
-            
+    _ensure_default_values(cursor, "other", {
+        "theme_newsletter": json.dumps({}),
+        "auto_start_bot": "0"
+    })
+
+    _ensure_settings_version_table(cursor)
+    _ensure_pending_transactions_table(cursor)
+    _ensure_default_button_configs(cursor)
+
+
+    try:
+        wide_buttons = [("trial", 2), ("referral", 2), ("admin", 2)]
+        for button_id, width in wide_buttons:
+            cursor.execute("""
+                UPDATE button_configs 
+                SET button_width = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE menu_type = 'main_menu' AND button_id = ?
+            """, (width, button_id))
+    except Exception:
+        pass
+
+
+def _migrate_transaction_rollups(cursor: sqlite3.Cursor) -> None:
+    _ensure_transaction_rollups_table(cursor)
+    _ensure_user_purchase_stats_table(cursor)
+
+
+def _migrate_admin_list_order(cursor: sqlite3.Cursor) -> None:
+    _ensure_users_list_order(cursor)
+    _ensure_support_tickets_queue(cursor)
+
+
+def _migrate_resource_metrics_rollups(cursor: sqlite3.Cursor) -> None:
+    _ensure_resource_metrics_rollups(cursor)
+
+
+def _migrate_balance_ledger(cursor: sqlite3.Cursor) -> None:
+    _ensure_balance_ledger(cursor)
+
+
+def _migrate_payment_claims(cursor: sqlite3.Cursor) -> None:
+    _ensure_payment_claims_table(cursor)
+
+
+def _migrate_hosts_version(cursor: sqlite3.Cursor) -> None:
+    _ensure_hosts_version_table(cursor)
+
+_MIGRATIONS = [
+    (1, "базовая схема и значения по умолчанию", _migrate_base_schema),
+    (2, "сводки транзакций и покупок", _migrate_transaction_rollups),
+    (3, "срок действия ключей в epoch ms", _ensure_vpn_keys_expiry_column),
+    (4, "ключи сортировки списков админки", _migrate_admin_list_order),
+    (5, "поисковый индекс админки", _ensure_admin_search_index),
+    (6, "сводки метрик ресурсов", _migrate_resource_metrics_rollups),
+    (7, "отдельный файл для метрик и speedtest", _migrate_metrics_database),
+    (8, "журнал операций с балансом", _migrate_balance_ledger),
+    (9, "захват платежей по payment_id", _migrate_payment_claims),
+    (10, "счётчик изменений хостов", _migrate_hosts_version),
+]
+SCHEMA_VERSION = _MIGRATIONS[-1][0]
+
+
+def _read_schema_version(cursor: sqlite3.Cursor | sqlite3.Connection) -> int:
+    try:
+        row = cursor.execute("SELECT version FROM schema_version WHERE id = 1").fetchone()
+        return int(row[0]) if row else 0
+    except sqlite3.Error:
+        return 0
+
+
+def _write_schema_version(cursor: sqlite3.Cursor, version: int) -> None:
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute(
+        "INSERT INTO schema_version (id, version) VALUES (1, ?) "
+        "ON CONFLICT(id) DO UPDATE SET version = excluded.version, updated_at = CURRENT_TIMESTAMP",
+        (version,),
+    )
+
+
+def get_schema_version() -> int:
+    if not DB_FILE.exists(): return 0
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+            return _read_schema_version(conn)
+    except sqlite3.Error:
+        return 0
 
-            try:
-                wide_buttons = [("trial", 2), ("referral", 2), ("admin", 2)]
-                for button_id, width in wide_buttons:
-                    cursor.execute("""
-                        UPDATE button_configs 
-                        SET button_width = ?, updated_at = CURRENT_TIMESTAMP
-                        WHERE menu_type = 'main_menu' AND button_id = ?
-                    """, (width, button_id))
-            except Exception:
-                pass
 
+def run_migration():
+    if not DB_FILE.exists(): logging.error("Файл базы данных отсутствует, миграция пропущена."); return
+
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+            _attach_metrics_db(conn)
+            cursor = conn.cursor()
+            current = _read_schema_version(cursor)
+            if current >= SCHEMA_VERSION:
+                if current > SCHEMA_VERSION: logging.warning(f"Версия схемы БД ({current}) новее кода ({SCHEMA_VERSION}), миграции пропущены")
+                return
 
+            logging.info("Запуск миграций базы данных: %s (версия %s -> %s)", DB_FILE, current, SCHEMA_VERSION)
+            cursor.execute("PRAGMA foreign_keys = OFF")
+            for version, title, migrate in _MIGRATIONS:
+                if version <= current: continue
+                started = time.perf_counter()
+                migrate(cursor)
+                _write_schema_version(cursor, version)
+                conn.commit()
+                logging.info(f"Миграция {version} ({title}) применена за {(time.perf_counter() - started) * 1000:.0f} мс")
             cursor.execute("PRAGMA foreign_keys = ON")
-            conn.commit()
     except sqlite3.Error as e:
         logging.error("Сбой миграции базы данных: %s", e)
 
@@ -1465,9 +2503,9 @@ def _ensure_promo_tables(cursor: sqlite3.Cursor) -> None:
 
 
 # ===== _ENSURE_HOST_SPEEDTESTS_TABLE =====
-def _ensure_host_speedtests_table(cursor: sqlite3.Cursor) -> None:
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS host_speedtests (
+def _ensure_host_speedtests_table(cursor: sqlite3.Cursor, schema: str = "main") -> None:
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.host_speedtests (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             host_name TEXT NOT NULL,
             method TEXT NOT NULL,
@@ -1482,16 +2520,16 @@ def _ensure_host_speedtests_table(cursor: sqlite3.Cursor) -> None:
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_host_speedtests_host_time ON host_speedtests(host_name, created_at DESC)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_host_speedtests_host_time ON host_speedtests(host_name, created_at DESC)")
 
 
 # =========================================
 
 
 # ===== _ENSURE_RESOURCE_METRICS_TABLE =====
-def _ensure_resource_metrics_table(cursor: sqlite3.Cursor) -> None:
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS resource_metrics (
+def _ensure_resource_metrics_table(cursor: sqlite3.Cursor, schema: str = "main") -> None:
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.resource_metrics (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             scope TEXT NOT NULL,                -- 'local' | 'host' | 'target'
             object_name TEXT NOT NULL,          -- 'panel' | host_name | target_name
@@ -1505,7 +2543,7 @@ def _ensure_resource_metrics_table(cursor: sqlite3.Cursor) -> None:
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_resource_metrics_scope_time ON resource_metrics(scope, object_name, created_at DESC)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_resource_metrics_scope_time ON resource_metrics(scope, object_name, created_at DESC)")
 
 
 
@@ -1525,8 +2563,9 @@ def insert_resource_metric(
     net_bytes_recv: int | None = None,
     raw_json: str | None = None
 ) -> int | None:
-    cursor = _exec(
-        """
+    return _append_row(
+        "resource_metrics",
+        [("""
         INSERT INTO resource_metrics (
             scope, object_name, cpu_percent, mem_percent, disk_percent, load1, 
             net_bytes_sent, net_bytes_recv, raw_json
@@ -1536,10 +2575,9 @@ def insert_resource_metric(
             (scope or '').strip(), (object_name or '').strip(),
             cpu_percent, mem_percent, disk_percent, load1, 
             net_bytes_sent, net_bytes_recv, raw_json
-        ),
+        ))],
         f"Не удалось сохранить метрики ресурсов scope={scope} object={object_name}"
     )
-    return cursor.lastrowid if cursor else None
 
 
 # ==================================
@@ -1590,25 +2628,58 @@ def get_metrics_series(scope: str, object_name: str, *, since_hours: int = 24, l
         hours_filter = 2
     else:
         hours_filter = max(1, int(since_hours))
-    
-    rows = _fetch_list(
-        f'''
-        SELECT created_at, cpu_percent, mem_percent, disk_percent, load1
-        FROM resource_metrics
-        WHERE scope = ? AND object_name = ?
-            AND created_at >= datetime('now', '+3 hours', ?)
-        ORDER BY created_at ASC
-        LIMIT ?
-        ''',
-        (
-            (scope or '').strip(),
-            (object_name or '').strip(),
-            f'-{hours_filter} hours',
-            max(10, int(limit)),
-        ),
-        f"Не удалось получить серию метрик для {scope}/{object_name}"
-    )
-    logging.debug(f"get_metrics_series: {scope}/{object_name}, since_hours={since_hours}, found {len(rows)} records")
+    budget = max(10, int(limit))
+    scope_n, name_n = (scope or '').strip(), (object_name or '').strip()
+    retention = _metrics_retention_hours()
+
+    tier = 0
+    raw_hours = retention[0]
+    if raw_hours and hours_filter > raw_hours:
+        tier = None
+    else:
+        raw_count = _fetch_val(
+            "SELECT COUNT(*) FROM resource_metrics WHERE scope = ? AND object_name = ? AND created_at >= datetime('now', '+3 hours', ?)",
+            (scope_n, name_n, f'-{hours_filter} hours'), 0, f"Не удалось посчитать метрики для {scope}/{object_name}"
+        )
+        if raw_count > budget: tier = None
+    if tier is None:
+        tier = max(_METRIC_TIERS)
+        for candidate in _METRIC_TIERS:
+            kept = retention[candidate]
+            if (not kept or hours_filter <= kept) and hours_filter * 3600 // candidate <= budget:
+                tier = candidate
+                break
+
+    if tier == 0:
+        rows = _fetch_list(
+            f'''
+            SELECT created_at, cpu_percent, mem_percent, disk_percent, load1
+            FROM resource_metrics
+            WHERE scope = ? AND object_name = ?
+                AND created_at >= datetime('now', '+3 hours', ?)
+            ORDER BY created_at ASC
+            LIMIT ?
+            ''',
+            (scope_n, name_n, f'-{hours_filter} hours', budget),
+            f"Не удалось получить серию метрик для {scope}/{object_name}"
+        )
+    else:
+        columns = ", ".join(
+            f"{f}_sum / NULLIF({f}_cnt, 0) AS {f}, {f}_min, {f}_max" for f in _METRIC_ROLLUP_FIELDS
+        )
+        rows = _fetch_list(
+            f'''
+            SELECT bucket_start AS created_at, {columns}, samples
+            FROM resource_metrics_rollup
+            WHERE tier = ? AND scope = ? AND object_name = ?
+                AND bucket_start >= strftime(?, datetime('now', '+3 hours', ?))
+            ORDER BY bucket_start ASC
+            LIMIT ?
+            ''',
+            (tier, scope_n, name_n, _METRIC_TIERS[tier], f'-{hours_filter} hours', budget + 2),
+            f"Не удалось получить сводку метрик для {scope}/{object_name}"
+        )
+    logging.debug(f"get_metrics_series: {scope}/{object_name}, since_hours={since_hours}, tier={tier}, found {len(rows)} records")
     return rows
 
 
@@ -1617,6 +2688,247 @@ def get_metrics_series(scope: str, object_name: str, *, since_hours: int = 24, l
 # ==============================
 
 
+# ===== СВОДКИ МЕТРИК РЕСУРСОВ =====
+# resource_metrics хранит сырые замеры; триггер раскладывает каждый замер в сводки по минутам,
+# часам и суткам (min/max/сумма/число замеров по каждой метрике). Каждый уровень хранится своё время
+# (настройки monitoring_retention_*), prune_resource_metrics удаляет устаревшие строки.
+# get_metrics_series выбирает самый подробный уровень, который покрывает запрошенный период
+# и укладывается в лимит точек.
+_METRIC_ROLLUP_FIELDS = ("cpu_percent", "mem_percent", "disk_percent", "load1")
+_METRIC_TIERS = {60: "%Y-%m-%d %H:%M:00", 3600: "%Y-%m-%d %H:00:00", 86400: "%Y-%m-%d 00:00:00"}
+_METRIC_RETENTION_SETTINGS = {
+    0: ("monitoring_retention_raw_hours", 48, 1),
+    60: ("monitoring_retention_1m_days", 7, 24),
+    3600: ("monitoring_retention_1h_days", 90, 24),
+    86400: ("monitoring_retention_1d_days", 730, 24),
+}
+_METRIC_PRUNE_CHUNK = 5000
+
+
+def _metrics_retention_hours() -> dict[int, int]:
+    """Срок хранения каждого уровня в часах; 0 — хранить без ограничения."""
+    result = {}
+    for tier, (key, default, hours_per_unit) in _METRIC_RETENTION_SETTINGS.items():
+        try:
+            value = int(str(get_setting(key) or default).strip())
+        except (TypeError, ValueError):
+            value = default
+        result[tier] = max(0, value) * hours_per_unit
+    return result
+
+
+def _metric_rollup_upsert_sql(source: str, target: str = "resource_metrics_rollup") -> str:
+    buckets = " ".join(f"WHEN {tier} THEN strftime('{fmt}', m.created_at)" for tier, fmt in _METRIC_TIERS.items())
+    tiers = " UNION ALL ".join(f"SELECT {tier} AS tier" for tier in _METRIC_TIERS)
+    columns = ", ".join(f"{f}_min, {f}_max, {f}_sum, {f}_cnt" for f in _METRIC_ROLLUP_FIELDS)
+    aggregates = ", ".join(f"MIN(m.{f}), MAX(m.{f}), TOTAL(m.{f}), COUNT(m.{f})" for f in _METRIC_ROLLUP_FIELDS)
+    merge = ", ".join(
+        f"{f}_min = MIN(COALESCE({f}_min, excluded.{f}_min), COALESCE(excluded.{f}_min, {f}_min)), "
+        f"{f}_max = MAX(COALESCE({f}_max, excluded.{f}_max), COALESCE(excluded.{f}_max, {f}_max)), "
+        f"{f}_sum = {f}_sum + excluded.{f}_sum, {f}_cnt = {f}_cnt + excluded.{f}_cnt"
+        for f in _METRIC_ROLLUP_FIELDS
+    )
+    return f"""
+        INSERT INTO {target} (tier, scope, object_name, bucket_start, samples, {columns})
+        SELECT t.tier, m.scope, m.object_name, CASE t.tier {buckets} END, COUNT(*), {aggregates}
+        FROM {source} AS m JOIN ({tiers}) AS t
+        WHERE m.created_at IS NOT NULL
+        GROUP BY t.tier, m.scope, m.object_name, 4
+        ON CONFLICT(tier, scope, object_name, bucket_start) DO UPDATE SET samples = samples + excluded.samples, {merge};
+    """
+
+
+def _ensure_resource_metrics_rollups(cursor: sqlite3.Cursor, schema: str = "main", backfill: bool = True) -> None:
+    _ensure_resource_metrics_table(cursor, schema)
+    cursor.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type='table' AND name='resource_metrics_rollup'")
+    created = cursor.fetchone() is None
+    metric_columns = ",\n            ".join(
+        f"{f}_min REAL, {f}_max REAL, {f}_sum REAL NOT NULL DEFAULT 0, {f}_cnt INTEGER NOT NULL DEFAULT 0"
+        for f in _METRIC_ROLLUP_FIELDS
+    )
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.resource_metrics_rollup (
+            tier INTEGER NOT NULL,              -- длительность корзины в секундах: 60 | 3600 | 86400
+            scope TEXT NOT NULL,
+            object_name TEXT NOT NULL,
+            bucket_start TEXT NOT NULL,
+            samples INTEGER NOT NULL DEFAULT 0,
+            {metric_columns},
+            PRIMARY KEY (tier, scope, object_name, bucket_start)
+        ) WITHOUT ROWID
+    """)
+    _ensure_index(cursor, f"{schema}.idx_resource_metrics_rollup_tier_time", "resource_metrics_rollup", "tier, bucket_start")
+    _ensure_index(cursor, f"{schema}.idx_resource_metrics_time", "resource_metrics", "created_at")
+    row_fields = ", ".join(f"NEW.{f} AS {f}" for f in _METRIC_ROLLUP_FIELDS)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {schema}.trg_resource_metrics_rollup_insert
+        AFTER INSERT ON resource_metrics
+        BEGIN
+            {_metric_rollup_upsert_sql(f"(SELECT NEW.scope AS scope, NEW.object_name AS object_name, NEW.created_at AS created_at, {row_fields})")}
+        END
+    """)
+    if created and backfill:
+        cursor.execute(_metric_rollup_upsert_sql(f"{schema}.resource_metrics", f"{schema}.resource_metrics_rollup"))
+        logging.info("Сводки resource_metrics_rollup созданы и заполнены по истории замеров")
+
+
+def prune_resource_metrics() -> dict:
+    """Удаляет сырые замеры и сводки старше срока хранения своего уровня. Возвращает число удалённых строк по уровням."""
+    deleted = {}
+    for tier, hours in _metrics_retention_hours().items():
+        if not hours: continue
+        total = 0
+        if tier == 0:
+            while True:
+                cursor = _exec(
+                    "DELETE FROM resource_metrics WHERE id IN (SELECT id FROM resource_metrics WHERE created_at < datetime('now', ?) LIMIT ?)",
+                    (f'-{hours} hours', _METRIC_PRUNE_CHUNK), "Не удалось очистить сырые метрики"
+                )
+                if not cursor or cursor.rowcount <= 0: break
+                total += cursor.rowcount
+                if cursor.rowcount < _METRIC_PRUNE_CHUNK: break
+        else:
+            cursor = _exec(
+                "DELETE FROM resource_metrics_rollup WHERE tier = ? AND bucket_start < datetime('now', ?)",
+                (tier, f'-{hours} hours'), f"Не удалось очистить сводки метрик уровня {tier}"
+            )
+            total = max(0, cursor.rowcount) if cursor else 0
+        deleted[tier] = total
+    if any(deleted.values()):
+        logging.info(f"Очистка метрик: удалено {deleted}")
+    return deleted
+# ==================================
+
+
+# ===== ОБСЛУЖИВАНИЕ БД =====
+# run_db_maintenance вызывается планировщиком раз в сутки в час db_maintenance_hour (МСК) и укладывается
+# в бюджет db_maintenance_budget_sec: обновление статистики планировщика (ANALYZE / PRAGMA optimize),
+# возврат свободных страниц (incremental_vacuum) и checkpoint WAL с усечением файла.
+# Время ограничивается progress handler'ом — прерванная операция откатывается целиком.
+# Старая база без auto_vacuum переводится в incremental полным VACUUM, если свободно не меньше 20% страниц.
+_MAINTENANCE_ANALYSIS_LIMIT = 1000
+_MAINTENANCE_VACUUM_CHUNK = 2000
+_last_db_maintenance: dict | None = None
+
+
+def _db_schema_files() -> dict[str, Path]:
+    return {"main": Path(DB_FILE), METRICS_SCHEMA: get_metrics_db_file()}
+
+
+def get_db_storage_stats() -> dict:
+    """Размер файлов БД и WAL, число свободных страниц и режим auto_vacuum по каждой базе."""
+    result = {"databases": [], "last_maintenance": _last_db_maintenance}
+    conn = get_db_connection()
+    for schema, path in _db_schema_files().items():
+        try:
+            page_size = conn.execute(f"PRAGMA {schema}.page_size").fetchone()[0]
+            page_count = conn.execute(f"PRAGMA {schema}.page_count").fetchone()[0]
+            freelist = conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+            auto_vacuum = conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0]
+            journal_mode = conn.execute(f"PRAGMA {schema}.journal_mode").fetchone()[0]
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось получить статистику базы {schema}: {e}")
+            continue
+        result["databases"].append({
+            "schema": schema,
+            "file": path.name,
+            "size_bytes": _file_size(path),
+            "wal_bytes": _file_size(path.with_name(path.name + "-wal")),
+            "page_size": page_size,
+            "page_count": page_count,
+            "freelist_pages": freelist,
+            "freelist_percent": round(freelist * 100.0 / page_count, 1) if page_count else 0.0,
+            "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(auto_vacuum, str(auto_vacuum)),
+            "journal_mode": journal_mode,
+        })
+    return result
+
+
+def _maintenance_budget_seconds() -> float:
+    try:
+        return max(1.0, float(str(get_setting("db_maintenance_budget_sec") or 60).strip()))
+    except (TypeError, ValueError):
+        return 60.0
+
+
+def run_db_maintenance(budget_seconds: float | None = None) -> dict:
+    """Обслуживание основной базы и базы метрик в пределах бюджета времени. Возвращает отчёт по шагам."""
+    global _last_db_maintenance
+    budget = budget_seconds if budget_seconds is not None else _maintenance_budget_seconds()
+    started = time.monotonic()
+    deadline = started + budget
+    report = {"started_at": _now_str(), "budget_sec": budget, "steps": [], "interrupted": False}
+
+    def step(schema: str, name: str, sql: str) -> list | None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            report["interrupted"] = True
+            return None
+        step_started = time.monotonic()
+        entry = {"schema": schema, "step": name}
+        rows = None
+        try:
+            conn.execute(f"PRAGMA busy_timeout={int(min(remaining, 5.0) * 1000)}")
+            rows = [list(row) for row in conn.execute(sql).fetchall()]
+        except sqlite3.OperationalError as e:
+            entry["error"] = str(e)
+            if "interrupt" in str(e).lower(): report["interrupted"] = True
+        entry["ms"] = round((time.monotonic() - step_started) * 1000, 1)
+        report["steps"].append(entry)
+        return rows
+
+    conn = _open_db_connection()
+    conn.isolation_level = None
+    conn.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, 10000)
+    try:
+        conn.execute(f"PRAGMA analysis_limit={_MAINTENANCE_ANALYSIS_LIMIT}")
+        for schema in _db_schema_files():
+            has_stats = conn.execute(
+                f"SELECT 1 FROM {schema}.sqlite_master WHERE type='table' AND name='sqlite_stat1'"
+            ).fetchone()
+            if has_stats:
+                step(schema, "optimize", f"PRAGMA {schema}.optimize")
+            else:
+                step(schema, "analyze", f"ANALYZE {schema}")
+
+        for schema in _db_schema_files():
+            auto_vacuum = conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0]
+            if auto_vacuum == 2:
+                freed = 0
+                while conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0] > 0:
+                    before = conn.execute(f"PRAGMA {schema}.page_count").fetchone()[0]
+                    if step(schema, "incremental_vacuum", f"PRAGMA {schema}.incremental_vacuum({_MAINTENANCE_VACUUM_CHUNK})") is None:
+                        break
+                    freed += before - conn.execute(f"PRAGMA {schema}.page_count").fetchone()[0]
+                if freed: logging.info(f"Обслуживание БД: {schema} — возвращено страниц {freed}")
+            elif auto_vacuum == 0:
+                pages = conn.execute(f"PRAGMA {schema}.page_count").fetchone()[0]
+                freelist = conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+                if pages and freelist * 5 >= pages:
+                    conn.execute(f"PRAGMA {schema}.auto_vacuum=INCREMENTAL")
+                    step(schema, "vacuum", f"VACUUM {schema}")
+
+        for schema in _db_schema_files():
+            if conn.execute(f"PRAGMA {schema}.journal_mode").fetchone()[0].lower() != "wal": continue
+            rows = step(schema, "wal_checkpoint", f"PRAGMA {schema}.wal_checkpoint(TRUNCATE)")
+            if rows: report["steps"][-1]["busy"], report["steps"][-1]["wal_pages"] = rows[0][0], rows[0][1]
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка обслуживания БД: {e}")
+        report["error"] = str(e)
+    finally:
+        conn.set_progress_handler(None, 0)
+        conn.close()
+
+    report["elapsed_ms"] = round((time.monotonic() - started) * 1000, 1)
+    _last_db_maintenance = report
+    logging.info(
+        f"Обслуживание БД завершено за {report['elapsed_ms']:.0f} мс (бюджет {budget:.0f} с)"
+        + (", прервано по бюджету" if report["interrupted"] else "")
+    )
+    return report
+# ===========================
+
+
 # ===== CREATE_HOST =====
 def create_host(name: str, url: str, user: str, passwd: str, inbound: int, subscription_url: str | None = None):
     name = normalize_host_name(name)
@@ -1846,7 +3158,7 @@ def update_host_name(old_name: str, new_name: str) -> bool:
         return False
 
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("PRAGMA foreign_keys=OFF")
             cursor.execute(
@@ -1866,7 +3178,6 @@ def update_host_name(old_name: str, new_name: str) -> bool:
                 (new_n, old_n)
             )
             conn.commit()
-            cursor.execute("PRAGMA foreign_keys=ON")
             return True
     except sqlite3.Error as e: logging.error(f"Не удалось переименовать хост '{old_name}' -> '{new_name}': {e}"); return False
 
@@ -1875,7 +3186,7 @@ def update_host_name(old_name: str, new_name: str) -> bool:
 def delete_host(host_name: str):
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE TRIM(host_name) = TRIM(?)", (host_name,))
             cursor.execute("DELETE FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name,))
@@ -1891,8 +3202,7 @@ def delete_host(host_name: str):
 def get_host(host_name: str) -> dict | None:
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name,))
             result = cursor.fetchone(); return dict(result) if result else None
@@ -1900,6 +3210,90 @@ def get_host(host_name: str) -> dict | None:
 # ==================
 
 
+# ===== КЭШ ХОСТОВ =====
+# Снимок xui_hosts в памяти процесса: конфигурация Remnawave нужна перед каждым запросом к панели.
+# Любая запись в xui_hosts увеличивает xui_hosts_version (триггеры), поэтому правки из панели,
+# прямые UPDATE и восстановление из бэкапа замечаются без явной инвалидации. Версия перечитывается,
+# только если соединение само что-то записало (total_changes) или базу изменил другой коннект (data_version).
+_hosts_cache: tuple[int, dict[str, dict]] | None = None
+_hosts_cache_lock = threading.Lock()
+
+
+def _read_hosts_version(conn: sqlite3.Connection) -> int | None:
+    try:
+        row = conn.execute("SELECT version FROM xui_hosts_version WHERE id = 1").fetchone()
+        return int(row[0]) if row else None
+    except sqlite3.Error:
+        return None
+
+
+def _hosts_marker(conn: sqlite3.Connection) -> tuple[int, int]:
+    return conn.total_changes, conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+def _remember_hosts_marker(conn: sqlite3.Connection, marker: tuple[int, int]) -> None:
+    _db_local.hosts_marker = marker
+    _db_local.hosts_marker_conn = conn
+
+
+def _load_hosts_index(conn: sqlite3.Connection) -> dict[str, dict] | None:
+    global _hosts_cache
+    with _hosts_cache_lock:
+        marker = _hosts_marker(conn)
+        version = _read_hosts_version(conn)
+        rows = conn.execute("SELECT * FROM xui_hosts ORDER BY rowid").fetchall()
+        index: dict[str, dict] = {}
+        for row in rows:
+            host = dict(row)
+            for value in (host.get("host_name"), host.get("squad_uuid")):
+                key = str(value or "").strip(" ")
+                if key:
+                    index.setdefault(key, host)
+        # Без таблицы версий (база до миграции) снимок не кэшируется
+        _hosts_cache = (version, index) if version is not None else None
+        _remember_hosts_marker(conn, marker)
+        return index
+
+
+def _get_hosts_index() -> dict[str, dict] | None:
+    try:
+        conn = get_db_connection()
+        cache = _hosts_cache
+        if cache is not None:
+            marker = _hosts_marker(conn)
+            if getattr(_db_local, "hosts_marker_conn", None) is conn and getattr(_db_local, "hosts_marker", None) == marker:
+                return cache[1]
+            if _read_hosts_version(conn) == cache[0]:
+                _remember_hosts_marker(conn, marker)
+                return cache[1]
+        return _load_hosts_index(conn)
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось загрузить список хостов: {e}")
+        return None
+
+
+def get_host_cached(identifier: str) -> dict | None:
+    """Хост по имени или squad_uuid из кэша; возвращает копию строки xui_hosts."""
+    ident = (identifier or "").strip()
+    if not ident:
+        return None
+    index = _get_hosts_index()
+    if index is None:
+        return None
+    for candidate in (ident, normalize_host_name(ident)):
+        host = index.get(candidate)
+        if host is not None:
+            return dict(host)
+    return None
+
+
+def invalidate_hosts_cache() -> None:
+    global _hosts_cache
+    with _hosts_cache_lock:
+        _hosts_cache = None
+# ======================
+
+
 # ===== TOGGLE_HOST_VISIBILITY =====
 # Переключение видимости хоста (поле see)
 def toggle_host_visibility(host_name: str, visible: int) -> bool:
@@ -2032,15 +3426,15 @@ def insert_host_speedtest(
     error: str | None = None
 ) -> int | None:
     host_name_n = normalize_host_name(host_name)
-    cursor = _exec(
-        """
+    return _append_row(
+        "host_speedtests",
+        [("""
         INSERT INTO host_speedtests (host_name, method, ping_ms, jitter_ms, download_mbps, upload_mbps, server_name, server_id, ok, error)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
-        (host_name_n, method, ping_ms, jitter_ms, download_mbps, upload_mbps, server_name, server_id, 1 if ok else 0, error),
+        (host_name_n, method, ping_ms, jitter_ms, download_mbps, upload_mbps, server_name, server_id, 1 if ok else 0, error))],
         f"Не удалось сохранить запись speedtest для '{host_name}'"
     )
-    return cursor.lastrowid if cursor else None
 
 
 
@@ -2196,7 +3590,7 @@ def rename_ssh_target(old_target_name: str, new_target_name: str) -> bool:
     if row_new: logging.warning(f"rename_ssh_target: новое имя уже занято '{new_name}'"); return False
     
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE speedtest_ssh_targets SET target_name = ? WHERE TRIM(target_name) = TRIM(?)",
@@ -2213,6 +3607,38 @@ def rename_ssh_target(old_target_name: str, new_target_name: str) -> bool:
 
 
 
+# ===== СВОДКА ТРАНЗАКЦИЙ =====
+# Общие условия для чтения transaction_rollups (см. _ensure_transaction_rollups_table)
+_TX_ROLLUP_PAID = "status IN ('paid', 'completed', 'success', 'succeeded') AND LOWER(payment_method) NOT IN ('balance', 'admin', 'referral')"
+_TX_ROLLUP_INCOME_ACTIONS = "action IN ('new', 'extend', 'topup', 'subscription')"
+_TX_ROLLUP_TODAY = "day = date('now', '+3 hours')"
+
+
+def _rollup_total(where: str, column: str = "amount_sum", params: tuple = ()) -> float:
+    val = _fetch_val(
+        f"SELECT COALESCE(SUM({column}), 0) FROM transaction_rollups WHERE {where}",
+        params, 0.0, "Не удалось получить данные из сводки транзакций"
+    )
+    return float(val or 0)
+
+
+# ===== REBUILD_TRANSACTION_ROLLUPS =====
+# Полная пересборка transaction_rollups и user_purchase_stats по истории transactions
+# (после ручных правок таблицы, изменения длительности тарифов и т.п.)
+def rebuild_transaction_rollups() -> int:
+    try:
+        conn = get_db_connection()
+        with conn:
+            cursor = conn.cursor()
+            _rebuild_transaction_rollups(cursor)
+            _rebuild_user_purchase_stats(cursor)
+            rows = cursor.execute("SELECT COUNT(*) FROM transaction_rollups").fetchone()[0]
+        logging.info(f"Сводка транзакций пересобрана: {rows} строк")
+        return int(rows)
+    except sqlite3.Error as e: logging.error(f"Не удалось пересобрать сводку транзакций: {e}"); return 0
+# =============================
+
+
 # ===== GET_ADMIN_STATS =====
 # Получение статистики для админ-панели
 # Возвращает: total_users, total_keys, active_keys, total_income, today_new_users, today_income, today_issued_keys
@@ -2220,46 +3646,14 @@ def get_admin_stats() -> dict:
     stats = {}
     stats["total_users"] = _get_count_stat("SELECT COUNT(*) as c FROM users")
     stats["total_keys"] = _get_count_stat("SELECT COUNT(*) as c FROM vpn_keys")
-    stats["active_keys"] = _get_count_stat("SELECT COUNT(*) as c FROM vpn_keys WHERE expire_at IS NOT NULL AND datetime(expire_at) > CURRENT_TIMESTAMP")
-    stats["total_income"] = float(_get_count_stat("""
-        SELECT COALESCE(SUM(amount_rub), 0) as s FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN ('paid','completed','success','succeeded')
-          AND LOWER(COALESCE(payment_method, '')) NOT IN ('balance', 'admin', 'referral')
-    """))
+    stats["active_keys"] = int(_fetch_val("SELECT COUNT(*) FROM vpn_keys WHERE expire_at_ms > ?", (_now_ms(),), 0, "Не удалось получить количество активных ключей") or 0)
+    today = _TX_ROLLUP_TODAY
+    stats["total_income"] = _rollup_total(_TX_ROLLUP_PAID)
     stats["today_new_users"] = _get_count_stat("SELECT COUNT(*) as c FROM users WHERE date(registration_date) = date('now', '+3 hours')")
-    stats["today_income"] = float(_get_count_stat("""
-        SELECT COALESCE(SUM(amount_rub), 0) as s FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN ('paid','completed','success','succeeded')
-          AND date(created_date) = date('now', '+3 hours') 
-          AND LOWER(COALESCE(payment_method, '')) NOT IN ('balance', 'admin', 'referral')
-    """))
-    stats["today_topups"] = float(_get_count_stat("""
-        SELECT COALESCE(SUM(amount_rub), 0) as s FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN ('paid','completed','success','succeeded')
-          AND date(created_date) = date('now', '+3 hours')
-          AND LOWER(COALESCE(payment_method, '')) NOT IN ('balance', 'admin', 'referral')
-          AND (
-              LOWER(COALESCE(json_extract(metadata, '$.action'), '')) IN ('topup', 'top_up')
-              OR LOWER(COALESCE(json_extract(metadata, '$.reason'), '')) = 'external_balance_top_up'
-          )
-    """))
-    stats["today_subscription_purchases"] = float(_get_count_stat("""
-        SELECT COALESCE(SUM(amount_rub), 0) as s FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN ('paid','completed','success','succeeded')
-          AND date(created_date) = date('now', '+3 hours')
-          AND LOWER(COALESCE(payment_method, '')) NOT IN ('balance', 'admin', 'referral')
-          AND (
-              LOWER(COALESCE(json_extract(metadata, '$.action'), '')) IN ('new', 'extend')
-              OR LOWER(COALESCE(json_extract(metadata, '$.reason'), '')) = 'subscription_purchase_or_extend'
-          )
-    """))
-    stats["today_bought_keys"] = _get_count_stat("""
-        SELECT COUNT(*) as c FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN ('paid','completed','success','succeeded')
-          AND date(created_date) = date('now', '+3 hours')
-          AND LOWER(COALESCE(payment_method, '')) NOT IN ('balance', 'admin', 'referral')
-          AND LOWER(COALESCE(json_extract(metadata, '$.action'), '')) = 'new'
-    """)
+    stats["today_income"] = _rollup_total(f"{_TX_ROLLUP_PAID} AND {today}")
+    stats["today_topups"] = _rollup_total(f"{_TX_ROLLUP_PAID} AND {today} AND action = 'topup'")
+    stats["today_subscription_purchases"] = _rollup_total(f"{_TX_ROLLUP_PAID} AND {today} AND action IN ('new', 'extend', 'subscription')")
+    stats["today_bought_keys"] = int(_rollup_total(f"{_TX_ROLLUP_PAID} AND {today} AND action = 'new'", "tx_count"))
     stats["today_trials"] = _get_count_stat("""
         SELECT COUNT(*) as c FROM vpn_keys
         WHERE COALESCE(key_email, '') LIKE 'trial_%'
@@ -2276,6 +3670,82 @@ def get_all_keys() -> list[dict]:
 # =========================
 
 
+# ===== GET_KEYS_PAGINATED =====
+# Без NULL в условии: иначе NOT (...) для ключа без key_email даёт NULL, и ключ не попадает ни в один список
+_GIFT_KEY_CONDITION = "(COALESCE(k.user_id, 0) = 0 OR COALESCE(k.key_email, k.email, '') LIKE 'gift%')"
+
+
+def get_keys_paginated(
+    page: int = 1,
+    per_page: int = 20,
+    q: str | None = None,
+    filter_mode: str = "general",
+    cursor: str | None = None,
+) -> tuple[list[dict], int, str | None]:
+    """Ключи для админки (новые сверху) с именем владельца, общее количество и курсор следующей страницы.
+
+    filter_mode='gift' — подарочные ключи, иначе — пользовательские. Поиск q идёт по admin_search:
+    id ключа и владельца, хост, email, UUID, ссылка подписки, а также username владельца.
+    """
+    page = max(1, int(page or 1))
+    per_page = max(1, int(per_page or 20))
+    q = (q or "").strip()
+    filter_mode = "gift" if filter_mode == "gift" else "general"
+    scope = ("keys", per_page, filter_mode, q)
+    keys = ("k.key_id",)
+
+    where = [_GIFT_KEY_CONDITION if filter_mode == "gift" else f"NOT {_GIFT_KEY_CONDITION}"]
+    params: list = []
+    if q:
+        match = _admin_search_match(q)
+        if match:
+            match_sql, match_params = match
+            where.append(f"(k.key_id IN ({_admin_search_ids_sql(match_sql, 'vpn_keys')}) OR k.user_id IN ({_admin_search_ids_sql(match_sql, 'users')}))")
+            params.extend(match_params * 2)
+        else:
+            where.append(_admin_search_like("vpn_keys", "k"))
+            params.append(f"%{q}%")
+    total = _cached_total(("keys", filter_mode, q), f"SELECT COUNT(*) FROM vpn_keys k WHERE {' AND '.join(where)}", tuple(params))
+
+    rows, last_values = _fetch_keyset_page(
+        "SELECT k.*, u.username, {page_keys} FROM vpn_keys k LEFT JOIN users u ON u.telegram_id = k.user_id",
+        "vpn_keys k", where, params,
+        keys, page, per_page, _decode_page_cursor(cursor, scope, page, len(keys)),
+        "Не удалось получить страницу ключей",
+    )
+    return [_normalize_key_row(row) for row in rows], total, _next_page_cursor(scope, page, per_page, total, rows, last_values)
+# ==============================
+
+
+# ===== ВЫБОРКИ КЛЮЧЕЙ ПО СРОКУ ДЕЙСТВИЯ =====
+# Диапазонные запросы по expire_at_ms (idx_vpn_keys_expire_at_ms), границы — epoch ms
+def get_keys_expiring_between(start_ms: int, end_ms: int) -> list[dict]:
+    rows = _fetch_list(
+        "SELECT * FROM vpn_keys WHERE expire_at_ms >= ? AND expire_at_ms < ? ORDER BY expire_at_ms",
+        (int(start_ms), int(end_ms)),
+        "Не удалось получить истекающие ключи"
+    )
+    return [_normalize_key_row(row) for row in rows]
+
+
+def get_keys_expired_before(cutoff_ms: int, host_name: str | None = None) -> list[dict]:
+    query = "SELECT * FROM vpn_keys WHERE expire_at_ms < ?"
+    params: tuple = (int(cutoff_ms),)
+    if host_name is not None:
+        query += " AND TRIM(host_name) = TRIM(?)"
+        params += (normalize_host_name(host_name),)
+    rows = _fetch_list(query + " ORDER BY expire_at_ms", params, "Не удалось получить истёкшие ключи")
+    return [_normalize_key_row(row) for row in rows]
+
+
+def count_keys_expired_before(cutoff_ms: int) -> int:
+    return int(_fetch_val(
+        "SELECT COUNT(*) FROM vpn_keys WHERE expire_at_ms < ?",
+        (int(cutoff_ms),), 0, "Не удалось посчитать истёкшие ключи"
+    ) or 0)
+# ============================================
+
+
 # ===== GET_KEYS_FOR_USER =====
 def get_keys_for_user(user_id: int) -> list[dict]:
     return get_user_keys(user_id)
@@ -2320,62 +3790,148 @@ def create_gift_key(user_id: int, host_name: str, key_email: str, months: int, r
 # ===========================
 
 
+# ===== КЭШ НАСТРОЕК =====
+# bot_settings держится в памяти процесса. update_setting обновляет кэш сразу (write-through),
+# а изменения из других процессов замечаются по PRAGMA data_version + bot_settings_version:
+# пока data_version соединения не изменился, чтение настроек не обращается к таблицам.
+_settings_cache: dict[str, str | None] | None = None
+_settings_cache_version: int | None = None
+_settings_cache_lock = threading.Lock()
+
+
+def _read_settings_version(conn: sqlite3.Connection) -> int | None:
+    try:
+        row = conn.execute("SELECT version FROM bot_settings_version WHERE id = 1").fetchone()
+        return int(row[0]) if row else None
+    except sqlite3.Error:
+        return None
+
+
+def _settings_changed_elsewhere(conn: sqlite3.Connection) -> bool:
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    if getattr(_db_local, "data_version", None) == data_version and getattr(_db_local, "data_version_conn", None) is conn:
+        return False
+    _db_local.data_version = data_version
+    _db_local.data_version_conn = conn
+    version = _read_settings_version(conn)
+    return version is None or version != _settings_cache_version
+
+
+def _load_settings(conn: sqlite3.Connection) -> dict[str, str | None]:
+    global _settings_cache, _settings_cache_version
+    with _settings_cache_lock:
+        version = _read_settings_version(conn)
+        rows = conn.execute("SELECT key, value FROM bot_settings").fetchall()
+        _settings_cache = {row["key"]: row["value"] for row in rows}
+        _settings_cache_version = version
+        return _settings_cache
+
+
+def _get_settings_map() -> dict[str, str | None]:
+    try:
+        conn = get_db_connection()
+        cache = _settings_cache
+        if cache is None or _settings_changed_elsewhere(conn):
+            cache = _load_settings(conn)
+        return cache
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось загрузить настройки: {e}")
+        return _settings_cache or {}
+
+
+def invalidate_settings_cache() -> None:
+    global _settings_cache, _settings_cache_version
+    with _settings_cache_lock:
+        _settings_cache = None
+        _settings_cache_version = None
+# =========================
+
+
 # ===== GET_SETTING =====
 def get_setting(key: str, default: str | None = None) -> str | None:
-    row = _fetch_row("SELECT value FROM bot_settings WHERE key = ?", (key,), f"Не удалось получить настройку '{key}'")
-    return row["value"] if row else default
+    settings = _get_settings_map()
+    return settings[key] if key in settings else default
 
 # =======================
 
 
 # ===== GET_ADMIN_IDS =====
-def get_admin_ids() -> set[int]:
+# Разобранный набор ID админов кэшируется по сырым значениям настроек:
+# пока admin_telegram_id / admin_telegram_ids не изменились, повторный разбор не выполняется.
+_admin_ids_cache: tuple[tuple[str | None, str | None], frozenset[int]] | None = None
+
+
+def _parse_admin_ids(single: str | None, multi_raw: str | None) -> frozenset[int]:
     ids: set[int] = set()
-    try:
-        single = get_setting("admin_telegram_id")
-        if single:
-            try:
-                ids.add(int(single))
-            except Exception:
-                pass
-        multi_raw = get_setting("admin_telegram_ids")
-        if multi_raw:
-            s = (multi_raw or "").strip()
+    if single:
+        try:
+            ids.add(int(single))
+        except Exception:
+            pass
+    if multi_raw:
+        s = (multi_raw or "").strip()
 
+        try:
+            arr = json.loads(s)
+            if isinstance(arr, list):
+                for v in arr:
+                    try:
+                        ids.add(int(v))
+                    except Exception:
+                        pass
+                return frozenset(ids)
+        except Exception:
+            pass
+
+        parts = [p for p in re.split(r"[\s,]+", s) if p]
+        for p in parts:
             try:
-                arr = json.loads(s)
-                if isinstance(arr, list):
-                    for v in arr:
-                        try:
-                            ids.add(int(v))
-                        except Exception:
-                            pass
-                    return ids
+                ids.add(int(p))
             except Exception:
                 pass
+    return frozenset(ids)
+
 
-            parts = [p for p in re.split(r"[\s,]+", s) if p]
-            for p in parts:
-                try:
-                    ids.add(int(p))
-                except Exception:
-                    pass
+def _get_admin_id_set() -> frozenset[int]:
+    global _admin_ids_cache
+    try:
+        raw = (get_setting("admin_telegram_id"), get_setting("admin_telegram_ids"))
+        cached = _admin_ids_cache
+        if cached is not None and cached[0] == raw:
+            return cached[1]
+        ids = _parse_admin_ids(*raw)
+        _admin_ids_cache = (raw, ids)
+        return ids
     except Exception as e:
         logging.warning(f"Ошибка get_admin_ids: {e}")
-    return ids
+        return frozenset()
+
+
+def get_admin_ids() -> set[int]:
+    return set(_get_admin_id_set())
 # =========================
 
 
 # ===== IS_ADMIN =====
 def is_admin(user_id: int) -> bool:
     try:
-        return int(user_id) in get_admin_ids()
+        return int(user_id) in _get_admin_id_set()
     except Exception: return False
 
 
 # ====================
 
 
+# ===== GET_ADMIN_USERS =====
+# Пользователи-админы, зарегистрированные в боте (без обхода всей таблицы users)
+def get_admin_users() -> list[dict]:
+    ids = sorted(_get_admin_id_set())
+    if not ids: return []
+    placeholders = ",".join("?" for _ in ids)
+    return _fetch_list(f"SELECT * FROM users WHERE telegram_id IN ({placeholders})", tuple(ids), "Не удалось получить список админов")
+# ===========================
+
+
 # ===== CREATE_PAYLOAD_PENDING =====
 def create_payload_pending(payment_id: str, user_id: int, amount_rub: float | None, metadata: dict | None) -> bool:
     print(f"[DEBUG] create_payload_pending called: payment_id={payment_id}, user_id={user_id}, amount_rub={amount_rub}, metadata={metadata}")
@@ -2502,20 +4058,36 @@ def detach_referrals_from_user(user_id: int) -> int:
 
 # ===== GET_ALL_SETTINGS =====
 def get_all_settings() -> dict:
-    rows = _fetch_list("SELECT key, value FROM bot_settings", (), "Не удалось получить все настройки")
-    return {row['key']: row['value'] for row in rows}
+    return dict(_get_settings_map())
 
 # ============================
 
 
 # ===== UPDATE_SETTING =====
 def update_setting(key: str, value: str):
+    global _settings_cache, _settings_cache_version, _query_stats_config
+    conn = get_db_connection()
+    previous_version = _read_settings_version(conn)
     cursor = _exec(
         "INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)",
         (key, value),
         f"Не удалось обновить настройку '{key}'"
     )
-    if cursor: logging.info(f"Настройка '{key}' обновлена.")
+    if cursor:
+        logging.info(f"Настройка '{key}' обновлена.")
+        with _settings_cache_lock:
+            current_version = _read_settings_version(conn)
+            if _settings_cache is not None and previous_version is not None and previous_version == _settings_cache_version and current_version == previous_version + 1:
+                _settings_cache[key] = value
+                _settings_cache_version = current_version
+            else:
+                _settings_cache = None
+    if cursor and key == "enable_wal_mode":
+        _apply_journal_mode(get_db_connection(), str(value) == "1")
+        reset_db_connections()
+    if cursor and key in ("db_query_stats_enabled", "db_slow_query_ms"):
+        _query_stats_config = None
+        reset_db_connections()
 # ==========================
 
 
@@ -2539,7 +4111,7 @@ def get_button_configs(menu_type: str, include_inactive: bool = False) -> list[d
         try:
             count = _get_count_stat("SELECT COUNT(*) as c FROM button_configs")
             if count == 0:
-                with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+                with get_db_connection() as conn:
                     cursor = conn.cursor()
                     _ensure_default_button_configs(cursor)
                     conn.commit()
@@ -2647,7 +4219,7 @@ def update_button_config(button_id: int, text: str = None, callback_data: str =
 def reorder_button_configs(menu_type: str, button_orders: list[dict]) -> bool:
     try:
         logging.info(f"Reordering {len(button_orders)} buttons for {menu_type}")
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db_connection() as conn:
             cursor = conn.cursor()
             for order_data in button_orders:
                 button_id = order_data.get('button_id')
@@ -2695,7 +4267,7 @@ def reorder_button_configs(menu_type: str, button_orders: list[dict]) -> bool:
 # ===== UPDATE_EXISTING_MY_KEYS_BUTTON =====
 def update_existing_my_keys_button():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE button_configs SET button_id = 'my_keys' WHERE button_id = 'keys'")
             conn.commit()
@@ -2823,56 +4395,152 @@ def get_balance(user_id: int) -> float:
     row = _fetch_row("SELECT balance FROM users WHERE telegram_id = ?", (user_id,), f"Не удалось получить баланс для пользователя {user_id}")
     return row["balance"] if row else 0.0
 
-def adjust_user_balance(user_id: int, delta: float) -> bool:
-    cursor = _exec(
-        "UPDATE users SET balance = COALESCE(balance, 0) + ? WHERE telegram_id = ?",
-        (float(delta), user_id),
-        f"Не удалось изменить баланс для пользователя {user_id}"
-    )
-    return cursor is not None and cursor.rowcount > 0
 
-def set_balance(user_id: int, value: float) -> bool:
-    cursor = _exec(
-        "UPDATE users SET balance = ? WHERE telegram_id = ?",
-        (value, user_id),
-        f"Не удалось установить баланс для пользователя {user_id}"
-    )
-    return cursor is not None and cursor.rowcount > 0
+# ===== БАЛАНС И ЖУРНАЛ ОПЕРАЦИЙ =====
+# Каждое изменение users.balance записывается в balance_ledger (только добавление строк) в той же
+# транзакции, что и сам UPDATE ... RETURNING. Баланс читается и меняется одним выражением, поэтому
+# параллельные вебхук и действие в боте не затирают друг друга, а вызывающий сразу получает новый баланс.
+def _ensure_balance_ledger(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='balance_ledger'")
+    created = cursor.fetchone() is None
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            delta REAL NOT NULL,
+            balance_after REAL NOT NULL,
+            reason TEXT,
+            ref TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    _ensure_index(cursor, "idx_balance_ledger_user", "balance_ledger", "user_id, id")
+    if created:
+        cursor.execute("""
+            INSERT INTO balance_ledger (user_id, delta, balance_after, reason)
+            SELECT telegram_id, balance, balance, 'opening' FROM users WHERE COALESCE(balance, 0) != 0
+        """)
+        logging.info(f"Журнал баланса создан, начальных остатков: {cursor.rowcount}")
+
+
+def change_balance(user_id: int, delta: float, reason: str, ref: str | None = None, require_funds: bool = False) -> float | None:
+    """Меняет баланс на delta и пишет строку журнала. Возвращает новый баланс или None,
+    если пользователь не найден, средств недостаточно (require_funds) или произошла ошибка БД."""
+    delta = float(delta)
+    sql = "UPDATE users SET balance = COALESCE(balance, 0) + ? WHERE telegram_id = ?"
+    params: tuple = (delta, int(user_id))
+    if require_funds:
+        sql += " AND COALESCE(balance, 0) >= ?"
+        params += (-delta,)
+    try:
+        conn = get_db_connection()
+        with conn:
+            row = conn.execute(sql + " RETURNING balance", params).fetchone()
+            if row is None: return None
+            new_balance = float(row[0])
+            conn.execute(
+                "INSERT INTO balance_ledger (user_id, delta, balance_after, reason, ref) VALUES (?, ?, ?, ?, ?)",
+                (int(user_id), delta, new_balance, reason, ref)
+            )
+        return new_balance
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось изменить баланс пользователя {user_id} на {delta:+.2f} ({reason}): {e}")
+        return None
 
-def add_to_balance(user_id: int, amount: float) -> bool:
-    logging.info(f"💳 Добавляем {amount:.2f} RUB к балансу пользователя {user_id}")
-    
-    # Check if user exists first to match original logic logging
-    row = _fetch_row("SELECT telegram_id, balance FROM users WHERE telegram_id = ?", (int(user_id),), "")
-    if not row: logging.error(f"❌ Пользователь {user_id} не найден в базе данных"); return False
 
-    old_balance = row["balance"] or 0.0
-    
-    cursor = _exec(
-        "UPDATE users SET balance = COALESCE(balance, 0) + ? WHERE telegram_id = ?",
-        (float(amount), int(user_id)),
-        f"Ошибка базы данных при пополнении баланса для пользователя {user_id}"
-    )
-    
-    if cursor and cursor.rowcount > 0:
-        new_balance = old_balance + float(amount)
-        logging.info(f"✅ Баланс обновлен: пользователь {user_id} | {old_balance:.2f} → {new_balance:.2f} RUB (+{amount:.2f})")
+def adjust_user_balance(user_id: int, delta: float, reason: str = "adjust") -> bool:
+    return change_balance(user_id, delta, reason) is not None
+
+def set_balance(user_id: int, value: float, reason: str = "admin_set") -> bool:
+    try:
+        conn = get_db_connection()
+        with conn:
+            cursor = conn.execute(
+                """
+                INSERT INTO balance_ledger (user_id, delta, balance_after, reason)
+                SELECT telegram_id, ? - COALESCE(balance, 0), ?, ? FROM users WHERE telegram_id = ?
+                """,
+                (float(value), float(value), reason, user_id)
+            )
+            if cursor.rowcount <= 0: return False
+            conn.execute("UPDATE users SET balance = ? WHERE telegram_id = ?", (float(value), user_id))
         return True
-    
-    logging.error(f"❌ Не удалось обновить баланс для пользователя {user_id}: строки не затронуты")
-    return False
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось установить баланс для пользователя {user_id}: {e}")
+        return False
+
+def add_to_balance(user_id: int, amount: float, reason: str = "credit", ref: str | None = None) -> bool:
+    logging.info(f"💳 Добавляем {amount:.2f} RUB к балансу пользователя {user_id}")
+    new_balance = change_balance(user_id, amount, reason, ref)
+    if new_balance is None:
+        logging.error(f"❌ Не удалось пополнить баланс пользователя {user_id}: пользователь не найден или ошибка БД")
+        return False
+    logging.info(f"✅ Баланс обновлен: пользователь {user_id} | {new_balance - float(amount):.2f} → {new_balance:.2f} RUB (+{amount:.2f})")
+    return True
 
-def deduct_from_balance(user_id: int, amount: float) -> bool:
+def deduct_from_balance(user_id: int, amount: float, reason: str = "debit", ref: str | None = None) -> bool:
     if amount <= 0: return True
-        
-    cursor = _exec(
-        "UPDATE users SET balance = balance - ? WHERE telegram_id = ? AND balance >= ?",
-        (amount, user_id, amount),
-        f"Не удалось списать с баланса для пользователя {user_id}"
+    return change_balance(user_id, -float(amount), reason, ref, require_funds=True) is not None
+
+
+def refund_payment(user_id: int, amount: float, ref: str) -> bool:
+    """Возвращает сумму платежа ref на баланс, если возврата по нему ещё не было (строка журнала
+    с reason='refund' и тем же ref). True — возврат выполнен сейчас или раньше."""
+    try:
+        conn = get_db_connection()
+        with conn:
+            row = conn.execute(
+                """
+                UPDATE users SET balance = COALESCE(balance, 0) + ? WHERE telegram_id = ?
+                AND NOT EXISTS (SELECT 1 FROM balance_ledger WHERE ref = ? AND reason = 'refund')
+                RETURNING balance
+                """,
+                (float(amount), int(user_id), str(ref))
+            ).fetchone()
+            if row is None:
+                return bool(conn.execute(
+                    "SELECT 1 FROM balance_ledger WHERE ref = ? AND reason = 'refund' LIMIT 1", (str(ref),)
+                ).fetchone())
+            conn.execute(
+                "INSERT INTO balance_ledger (user_id, delta, balance_after, reason, ref) VALUES (?, ?, ?, 'refund', ?)",
+                (int(user_id), float(amount), float(row[0]), str(ref))
+            )
+        logging.info(f"Возврат {float(amount):.2f} RUB пользователю {user_id} по платежу {ref}")
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось вернуть платёж {ref} пользователю {user_id}: {e}")
+        return False
+
+
+def reconcile_balance_ledger(fix: bool = False) -> list[dict]:
+    """Сверяет users.balance с суммой журнала. Возвращает расхождения; при fix=True дописывает
+    в журнал корректирующие строки (reason='reconcile'), чтобы сумма совпала с текущим балансом."""
+    mismatches = _fetch_list(
+        """
+        SELECT u.telegram_id AS user_id, COALESCE(u.balance, 0) AS balance, COALESCE(l.total, 0) AS ledger_balance
+        FROM users u
+        LEFT JOIN (SELECT user_id, SUM(delta) AS total FROM balance_ledger GROUP BY user_id) l ON l.user_id = u.telegram_id
+        WHERE ABS(COALESCE(u.balance, 0) - COALESCE(l.total, 0)) > 0.005
+        """,
+        (), "Не удалось сверить журнал баланса"
+    )
+    if mismatches:
+        logging.warning(f"Сверка баланса: расхождений {len(mismatches)}")
+    if fix:
+        for m in mismatches:
+            _exec(
+                "INSERT INTO balance_ledger (user_id, delta, balance_after, reason) VALUES (?, ?, ?, 'reconcile')",
+                (m["user_id"], m["balance"] - m["ledger_balance"], m["balance"]),
+                f"Не удалось записать корректировку баланса для пользователя {m['user_id']}"
+            )
+    return mismatches
+
+
+def get_balance_ledger(user_id: int, limit: int = 50) -> list[dict]:
+    return _fetch_list(
+        "SELECT * FROM balance_ledger WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+        (user_id, limit), f"Не удалось получить журнал баланса пользователя {user_id}"
     )
-    if cursor and cursor.rowcount > 0: return True
-        
-    return False
 # ============================
 
 
@@ -2969,7 +4637,7 @@ def link_telegram_to_email_user(old_telegram_id: int, new_telegram_id: int, new_
     existing = get_user(new_telegram_id)
         
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db_connection() as conn:
             cursor = conn.cursor()
             if existing:
                 cursor.execute("UPDATE vpn_keys SET user_id = ? WHERE user_id = ?", (new_telegram_id, old_telegram_id))
@@ -2978,6 +4646,7 @@ def link_telegram_to_email_user(old_telegram_id: int, new_telegram_id: int, new_
                 cursor.execute("UPDATE support_tickets SET user_id = ? WHERE user_id = ?", (new_telegram_id, old_telegram_id))
                 cursor.execute("UPDATE seller_users SET user_id = ? WHERE user_id = ?", (new_telegram_id, old_telegram_id))
                 cursor.execute("UPDATE users SET referred_by = ? WHERE referred_by = ?", (new_telegram_id, old_telegram_id))
+                cursor.execute("UPDATE balance_ledger SET user_id = ? WHERE user_id = ?", (new_telegram_id, old_telegram_id))
                 
                 old_bal = old_user.get('balance', 0)
                 old_ref_bal = old_user.get('referral_balance', 0)
@@ -3009,6 +4678,7 @@ def link_telegram_to_email_user(old_telegram_id: int, new_telegram_id: int, new_
                 cursor.execute("UPDATE support_tickets SET user_id = ? WHERE user_id = ?", (new_telegram_id, old_telegram_id))
                 cursor.execute("UPDATE seller_users SET user_id = ? WHERE user_id = ?", (new_telegram_id, old_telegram_id))
                 cursor.execute("UPDATE users SET referred_by = ? WHERE referred_by = ?", (new_telegram_id, old_telegram_id))
+                cursor.execute("UPDATE balance_ledger SET user_id = ? WHERE user_id = ?", (new_telegram_id, old_telegram_id))
             
             conn.commit()
             return True
@@ -3054,17 +4724,7 @@ def get_total_keys_count() -> int:
 
 # ===== GET_TOTAL_SPENT_SUM =====
 def get_total_spent_sum() -> float:
-    row = _fetch_row(
-        """
-        SELECT COALESCE(SUM(amount_rub), 0.0) as s
-        FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN ('paid', 'completed', 'success', 'succeeded')
-          AND LOWER(COALESCE(payment_method, '')) NOT IN ('balance', 'admin', 'referral')
-        """,
-        (),
-        "Не удалось получить общую сумму расходов"
-    )
-    return row["s"] if row else 0.0
+    return _rollup_total(_TX_ROLLUP_PAID)
 # =============================
 
 
@@ -3077,19 +4737,7 @@ def get_total_spent_by_method(payment_method: str) -> float:
     }
     methods = method_aliases.get(method_norm, (method_norm,))
     placeholders = ','.join('?' for _ in methods)
-    val = _fetch_val(
-        f"""
-        SELECT COALESCE(SUM(amount_rub), 0.0)
-        FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN ('paid', 'completed', 'success', 'succeeded')
-          AND LOWER(COALESCE(payment_method, '')) IN ({placeholders})
-          AND LOWER(COALESCE(payment_method, '')) NOT IN ('balance', 'admin', 'referral')
-        """,
-        methods,
-        0.0,
-        f"Не удалось получить доход по методу {payment_method}"
-    )
-    return float(val) if val is not None else 0.0
+    return _rollup_total(f"{_TX_ROLLUP_PAID} AND LOWER(payment_method) IN ({placeholders})", params=methods)
 # ===================================
 
 
@@ -3097,151 +4745,52 @@ def get_total_spent_by_method(payment_method: str) -> float:
 def get_today_income_by_currency() -> dict:
     rub_methods = ('yookassa', 'platega', 'platega payform')
     crypto_methods = ('telegram stars', 'cryptobot', 'heleket', 'ton connect', 'platega crypto')
-    income_filter = """
-          AND (
-              LOWER(COALESCE(json_extract(metadata, '$.action'), '')) IN ('new', 'extend', 'topup', 'top_up')
-              OR LOWER(COALESCE(json_extract(metadata, '$.reason'), '')) IN ('subscription_purchase_or_extend', 'external_balance_top_up')
-          )
-    """
-    rub = _fetch_val(
-        f"""
-        SELECT COALESCE(SUM(amount_rub), 0.0)
-        FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN ('paid', 'completed', 'success', 'succeeded')
-          AND date(created_date) = date('now', '+3 hours')
-          AND LOWER(COALESCE(payment_method, '')) IN ({','.join('?' for _ in rub_methods)})
-          {income_filter}
-        """,
-        rub_methods, 0.0, "Не удалось получить рублёвый доход за сегодня"
-    )
-    yesterday_rub = _fetch_val(
-        f"""
-        SELECT COALESCE(SUM(amount_rub), 0.0)
-        FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN ('paid', 'completed', 'success', 'succeeded')
-          AND date(created_date) = date('now', '+3 hours', '-1 day')
-          AND LOWER(COALESCE(payment_method, '')) IN ({','.join('?' for _ in rub_methods)})
-          {income_filter}
-        """,
-        rub_methods, 0.0, "Не удалось получить рублёвый доход за вчера"
-    )
-    crypto = _fetch_val(
-        f"""
-        SELECT COALESCE(SUM(amount_rub), 0.0)
-        FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN ('paid', 'completed', 'success', 'succeeded')
-          AND date(created_date) = date('now', '+3 hours')
-          AND LOWER(COALESCE(payment_method, '')) IN ({','.join('?' for _ in crypto_methods)})
-          {income_filter}
-        """,
-        crypto_methods, 0.0, "Не удалось получить крипто доход за сегодня"
-    )
-    return {"rub": float(rub or 0), "yesterday_rub": float(yesterday_rub or 0), "crypto": float(crypto or 0)}
+
+    def day_income(methods: tuple[str, ...], day_offset: str) -> float:
+        return _rollup_total(
+            f"""
+            status IN ('paid', 'completed', 'success', 'succeeded')
+              AND day = date('now', '+3 hours', ?)
+              AND LOWER(payment_method) IN ({','.join('?' for _ in methods)})
+              AND {_TX_ROLLUP_INCOME_ACTIONS}
+            """,
+            params=(day_offset, *methods)
+        )
+
+    rub = day_income(rub_methods, '+0 day')
+    yesterday_rub = day_income(rub_methods, '-1 day')
+    crypto = day_income(crypto_methods, '+0 day')
+    return {"rub": rub, "yesterday_rub": yesterday_rub, "crypto": crypto}
 # ========================================
 
 
 # ===== GET_ADMIN_FINANCIAL_STATS =====
 def get_admin_financial_stats() -> dict:
     paid_statuses = "('paid', 'completed', 'success', 'succeeded')"
-    excluded_methods = "('balance', 'admin', 'referral')"
-    income_action_filter = """
-          AND (
-              LOWER(COALESCE(json_extract(metadata, '$.action'), '')) IN ('new', 'extend', 'topup', 'top_up')
-              OR LOWER(COALESCE(json_extract(metadata, '$.reason'), '')) IN ('subscription_purchase_or_extend', 'external_balance_top_up')
-          )
-    """
+    income_filter = f"{_TX_ROLLUP_PAID} AND {_TX_ROLLUP_INCOME_ACTIONS}"
 
     admin_stats = get_admin_stats()
-    user_groups = get_dashboard_user_groups()
+    user_groups = get_dashboard_user_group_counts()
 
     def income_sum(date_filter: str = "") -> float:
-        return float(_fetch_val(
-            f"""
-            SELECT COALESCE(SUM(amount_rub), 0.0)
-            FROM transactions
-            WHERE LOWER(COALESCE(status, '')) IN {paid_statuses}
-              AND LOWER(COALESCE(payment_method, '')) NOT IN {excluded_methods}
-              {date_filter}
-              {income_action_filter}
-            """,
-            (),
-            0.0,
-            "Не удалось получить финансовую сумму для админской сводки",
-        ) or 0)
+        return _rollup_total(f"{income_filter} {date_filter}")
 
     def referral_income_sum(date_filter: str = "") -> float:
-        return float(_fetch_val(
-            f"""
-            SELECT COALESCE(SUM(amount_rub), 0.0)
-            FROM transactions
-            WHERE LOWER(COALESCE(status, '')) IN {paid_statuses}
-              AND LOWER(COALESCE(payment_method, '')) = 'referral'
-              {date_filter}
-            """,
-            (),
-            0.0,
-            "Не удалось получить доход партнеров для админской сводки",
-        ) or 0)
+        return _rollup_total(f"status IN {paid_statuses} AND LOWER(payment_method) = 'referral' {date_filter}")
 
+    today_filter = f"AND {_TX_ROLLUP_TODAY}"
+    month_filter = "AND day >= date('now', '+3 hours', 'start of month') AND day < date('now', '+3 hours', 'start of month', '+1 month')"
     total_income = income_sum()
-    today_income = income_sum("AND date(created_date) = date('now', '+3 hours')")
-    yesterday_income = income_sum("AND date(created_date) = date('now', '+3 hours', '-1 day')")
-    week_income = income_sum("AND date(created_date) >= date('now', '+3 hours', '-6 day')")
-    month_income = income_sum("AND strftime('%Y-%m', created_date) = strftime('%Y-%m', datetime('now', '+3 hours'))")
-    last_month_income = income_sum("AND strftime('%Y-%m', created_date) = strftime('%Y-%m', datetime('now', '+3 hours', '-1 month'))")
-    year_income = income_sum("AND strftime('%Y', created_date) = strftime('%Y', datetime('now', '+3 hours'))")
-    today_topups = _fetch_val(
-        f"""
-        SELECT COALESCE(SUM(amount_rub), 0.0)
-        FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN {paid_statuses}
-          AND date(created_date) = date('now', '+3 hours')
-          AND LOWER(COALESCE(payment_method, '')) NOT IN {excluded_methods}
-          AND (
-              LOWER(COALESCE(json_extract(metadata, '$.action'), '')) IN ('topup', 'top_up')
-              OR LOWER(COALESCE(json_extract(metadata, '$.reason'), '')) = 'external_balance_top_up'
-          )
-        """,
-        (),
-        0.0,
-        "Не удалось получить пополнения за сегодня для финансовой сводки",
-    )
-    today_subscriptions = _fetch_val(
-        f"""
-        SELECT COALESCE(SUM(amount_rub), 0.0)
-        FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN {paid_statuses}
-          AND date(created_date) = date('now', '+3 hours')
-          AND LOWER(COALESCE(payment_method, '')) NOT IN {excluded_methods}
-          AND (
-              LOWER(COALESCE(json_extract(metadata, '$.action'), '')) IN ('new', 'extend')
-              OR LOWER(COALESCE(json_extract(metadata, '$.reason'), '')) = 'subscription_purchase_or_extend'
-          )
-        """,
-        (),
-        0.0,
-        "Не удалось получить покупки подписок за сегодня для финансовой сводки",
-    )
-    pending_amount = _fetch_val(
-        """
-        SELECT COALESCE(SUM(amount_rub), 0.0)
-        FROM transactions
-        WHERE LOWER(COALESCE(status, '')) = 'pending'
-        """,
-        (),
-        0.0,
-        "Не удалось получить сумму ожидающих платежей",
-    )
-    pending_count = _fetch_val(
-        """
-        SELECT COUNT(*)
-        FROM transactions
-        WHERE LOWER(COALESCE(status, '')) = 'pending'
-        """,
-        (),
-        0,
-        "Не удалось получить количество ожидающих платежей",
-    )
+    today_income = income_sum(today_filter)
+    yesterday_income = income_sum("AND day = date('now', '+3 hours', '-1 day')")
+    week_income = income_sum("AND day >= date('now', '+3 hours', '-6 day')")
+    month_income = income_sum(month_filter)
+    last_month_income = income_sum("AND day >= date('now', '+3 hours', 'start of month', '-1 month') AND day < date('now', '+3 hours', 'start of month')")
+    year_income = income_sum("AND day >= date('now', '+3 hours', 'start of year') AND day < date('now', '+3 hours', 'start of year', '+1 year')")
+    today_topups = _rollup_total(f"{_TX_ROLLUP_PAID} {today_filter} AND action = 'topup'")
+    today_subscriptions = _rollup_total(f"{_TX_ROLLUP_PAID} {today_filter} AND action IN ('new', 'extend', 'subscription')")
+    pending_amount = _rollup_total("status = 'pending'")
+    pending_count = _rollup_total("status = 'pending'", "tx_count")
     user_balance_total = _fetch_val(
         """
         SELECT COALESCE(SUM(balance), 0.0)
@@ -3297,7 +4846,7 @@ def get_admin_financial_stats() -> dict:
         0.0,
         "Не удалось получить общий заработок партнеров",
     )
-    partners_earned_month = referral_income_sum("AND strftime('%Y-%m', created_date) = strftime('%Y-%m', datetime('now', '+3 hours'))")
+    partners_earned_month = referral_income_sum(month_filter)
     top_partner = _fetch_row(
         """
         SELECT u.telegram_id, u.username, COUNT(*) AS referrals_count
@@ -3315,19 +4864,19 @@ def get_admin_financial_stats() -> dict:
         f"""
         SELECT u.telegram_id, u.username,
                COALESCE(SUM(COALESCE(
-                   CAST(json_extract(t.metadata, '$.months') AS INTEGER),
-                   (SELECT p.months FROM plans p WHERE p.plan_id = CAST(json_extract(t.metadata, '$.plan_id') AS INTEGER)),
+                   t.meta_months,
+                   (SELECT p.months FROM plans p WHERE p.plan_id = t.meta_plan_id),
                    0
                )), 0) AS months_total
         FROM users u
         JOIN transactions t ON t.user_id = u.telegram_id
-        WHERE LOWER(COALESCE(t.status, '')) IN {paid_statuses}
-          AND LOWER(COALESCE(t.payment_method, '')) NOT IN ('admin', 'referral')
+        WHERE t.status_norm IN {paid_statuses}
+          AND t.method_norm NOT IN ('admin', 'referral')
           AND (
-              LOWER(COALESCE(json_extract(t.metadata, '$.action'), '')) IN ('new', 'extend')
-              OR LOWER(COALESCE(json_extract(t.metadata, '$.reason'), '')) = 'subscription_purchase_or_extend'
-              OR json_extract(t.metadata, '$.plan_id') IS NOT NULL
-              OR json_extract(t.metadata, '$.key_id') IS NOT NULL
+              t.meta_action IN ('new', 'extend')
+              OR t.meta_reason = 'subscription_purchase_or_extend'
+              OR t.meta_plan_id IS NOT NULL
+              OR t.meta_key_id IS NOT NULL
           )
         GROUP BY u.telegram_id, u.username
         ORDER BY months_total DESC, u.telegram_id ASC
@@ -3338,12 +4887,10 @@ def get_admin_financial_stats() -> dict:
     )
     payment_rows = _fetch_list(
         f"""
-        SELECT LOWER(COALESCE(payment_method, '')) AS method, COALESCE(SUM(amount_rub), 0.0) AS total
-        FROM transactions
-        WHERE LOWER(COALESCE(status, '')) IN {paid_statuses}
-          AND LOWER(COALESCE(payment_method, '')) NOT IN {excluded_methods}
-          {income_action_filter}
-        GROUP BY LOWER(COALESCE(payment_method, ''))
+        SELECT LOWER(payment_method) AS method, COALESCE(SUM(amount_sum), 0.0) AS total
+        FROM transaction_rollups
+        WHERE {income_filter}
+        GROUP BY LOWER(payment_method)
         ORDER BY total DESC, method ASC
         """,
         (),
@@ -3381,11 +4928,11 @@ def get_admin_financial_stats() -> dict:
         "total_keys": int(admin_stats.get("total_keys", 0) or 0),
         "active_keys": int(admin_stats.get("active_keys", 0) or 0),
         "total_income": float(total_income or 0),
-        "no_purchases": len(user_groups.get("no_purchases", [])),
-        "inactive_buyers": len(user_groups.get("inactive_buyers", [])),
-        "trials": len(user_groups.get("trials", [])),
-        "active_buyers": len(user_groups.get("active_buyers", [])),
-        "active_keys_total": len(user_groups.get("active_keys", [])),
+        "no_purchases": user_groups["no_purchases"],
+        "inactive_buyers": user_groups["inactive_buyers"],
+        "trials": user_groups["trials"],
+        "active_buyers": user_groups["active_buyers"],
+        "active_keys_total": user_groups["active_keys"],
         "trial_used_total": int(trial_used_total or 0),
         "today_income": float(today_income or 0),
         "yesterday_income": float(yesterday_income or 0),
@@ -3435,15 +4982,16 @@ def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float,
 # ===== LOG_TRANSACTION_SIMPLE =====
 def log_transaction_simple(user_id: int, amount: float, method: str, description: str) -> bool:
     logging.info(f"📝 Логирование транзакции: user={user_id}, amount={amount}, method={method}")
-    cursor = _exec(
-        """
+    row_id = _append_row(
+        "transactions",
+        [("""
         INSERT INTO transactions (user_id, amount_rub, payment_method, status, description, created_date)
         VALUES (?, ?, ?, 'paid', ?, ?)
         """,
-        (user_id, amount, method, description, get_msk_time().replace(tzinfo=None).replace(microsecond=0)),
+        (user_id, amount, method, description, get_msk_time().replace(tzinfo=None).replace(microsecond=0)))],
         f"Не удалось залогировать транзакцию для пользователя {user_id}"
     )
-    if cursor: logging.info(f"✅ Транзакция успешно сохранена для пользователя {user_id}"); return True
+    if row_id or _write_mode("transactions") == "deferred": logging.info(f"✅ Транзакция успешно сохранена для пользователя {user_id}"); return True
     return False
 # ==================================
 
@@ -3468,11 +5016,12 @@ def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dic
 
 # ===== LOG_TRANSACTION =====
 def log_transaction(username: str, transaction_id: str | None, payment_id: str | None, user_id: int, status: str, amount_rub: float, amount_currency: float | None, currency_name: str | None, payment_method: str, metadata: str):
-    _exec(
-        """INSERT INTO transactions
+    _append_row(
+        "transactions",
+        [("""INSERT INTO transactions
            (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, created_date)
            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, get_msk_time().replace(tzinfo=None).replace(microsecond=0)),
+        (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, get_msk_time().replace(tzinfo=None).replace(microsecond=0)))],
         f"Не удалось залогировать транзакцию для пользователя {user_id}"
     )
 # ===========================
@@ -3481,17 +5030,181 @@ def log_transaction(username: str, transaction_id: str | None, payment_id: str |
 def check_transaction_exists(payment_id: str) -> bool:
     row = _fetch_row("SELECT 1 as ex FROM transactions WHERE payment_id = ? LIMIT 1", (payment_id,), f"Не удалось проверить транзакцию {payment_id}")
     return bool(row)
+# ====================================
+
+
+# ===== ЗАХВАТ ПЛАТЕЖЕЙ =====
+# Первый обработчик платежа вставляет строку payment_claims с его payment_id; повторные вебхуки
+# получают конфликт по первичному ключу и отклоняются до любых сетевых вызовов.
+# Статус: processing -> done | failed. Неудачный платёж автоматически не освобождается: при ошибке выдачи
+# ключа деньги уже возвращены на баланс, и повторная обработка выдала бы их второй раз.
+# Если обработку отменили или она упала до первого изменения (баланса или ключа на панели), захват снимается
+# через release_payment_claim, и платёж можно обработать заново.
+def _ensure_payment_claims_table(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='payment_claims'")
+    created = cursor.fetchone() is None
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS payment_claims (
+            payment_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            action TEXT,
+            status TEXT NOT NULL DEFAULT 'processing',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    if created:
+        cursor.execute("""
+            INSERT OR IGNORE INTO payment_claims (payment_id, user_id, action, status, created_at, updated_at)
+            SELECT payment_id, user_id, CASE WHEN json_valid(metadata) THEN json_extract(metadata, '$.action') END, 'done', created_date, created_date
+            FROM transactions
+            WHERE payment_id IS NOT NULL AND payment_id != '' AND LOWER(COALESCE(status, '')) != 'pending'
+        """)
+        logging.info(f"Таблица payment_claims создана, уже обработанных платежей: {cursor.rowcount}")
+
+
+def claim_payment(payment_id: str, user_id: int | None = None, action: str | None = None) -> bool | None:
+    """True — платёж захвачен этим вызовом, False — уже обрабатывается или обработан, None — ошибка БД."""
+    try:
+        user_id = int(user_id) if user_id not in (None, '') else None
+    except (TypeError, ValueError):
+        user_id = None
+    cursor = _exec(
+        "INSERT INTO payment_claims (payment_id, user_id, action) VALUES (?, ?, ?) ON CONFLICT(payment_id) DO NOTHING",
+        (str(payment_id), user_id, action),
+        f"Не удалось захватить платёж {payment_id}"
+    )
+    if cursor is None: return None
+    return cursor.rowcount == 1
+
+
+def finish_payment_claim(payment_id: str, status: str) -> None:
+    _exec(
+        "UPDATE payment_claims SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE payment_id = ?",
+        (status, str(payment_id)),
+        f"Не удалось обновить статус платежа {payment_id}"
+    )
 
-def get_paginated_transactions(page: int = 1, per_page: int = 15) -> tuple[list[dict], int]:
-    offset = (page - 1) * per_page
-    transactions = []
-    total = 0
 
-    r_count = _fetch_row("SELECT COUNT(*) as c FROM transactions", (), "Не удалось получить кол-во транзакций")
-    total = r_count["c"] if r_count else 0
+def release_payment_claim(payment_id: str) -> bool:
+    cursor = _exec(
+        "DELETE FROM payment_claims WHERE payment_id = ? AND status = 'processing'",
+        (str(payment_id),),
+        f"Не удалось снять захват платежа {payment_id}"
+    )
+    return cursor is not None and cursor.rowcount == 1
+
+
+def get_payment_claim(payment_id: str) -> dict | None:
+    return _fetch_row("SELECT * FROM payment_claims WHERE payment_id = ?", (str(payment_id),), f"Не удалось получить платёж {payment_id}")
+# ===========================
+
+
+# ===== КУРСОРНАЯ ПАГИНАЦИЯ =====
+# Админские списки листаются по ключу сортировки (keyset): курсор хранит значения ключа последней
+# строки страницы, следующая страница читается диапазоном по индексу без OFFSET.
+# Курсор привязан к списку, фильтру и номеру страницы, на которую ведёт, — чужой или устаревший курсор
+# игнорируется. Переход на произвольный номер страницы идёт через OFFSET по индексу (подзапрос выбирает
+# только первичные ключи), строки таблицы читаются лишь для самой страницы.
+# Общие количества для номеров страниц кэшируются на _PAGE_TOTAL_TTL секунд.
+_PAGE_TOTAL_TTL = 30.0
+_page_totals: dict[tuple, tuple[float, int]] = {}
+_page_totals_lock = threading.Lock()
+
+
+def _encode_page_cursor(scope: tuple, page: int, values: list) -> str:
+    raw = json.dumps([list(scope), page, values], ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_page_cursor(token: str | None, scope: tuple, page: int, size: int) -> list | None:
+    if not token: return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        c_scope, c_page, values = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if c_scope != list(scope) or c_page != page or not isinstance(values, list) or len(values) != size: return None
+    return values
+
+
+def _cached_total(key: tuple, query: str, params: tuple = ()) -> int:
+    now = time.monotonic()
+    cached = _page_totals.get(key)
+    if cached and now - cached[0] < _PAGE_TOTAL_TTL: return cached[1]
+    total = int(_fetch_val(query, params, 0, f"Не удалось подсчитать записи для {key[0]}") or 0)
+    with _page_totals_lock:
+        if len(_page_totals) > 256: _page_totals.clear()
+        _page_totals[key] = (now, total)
+    return total
+
+
+def invalidate_page_totals(prefix: str | None = None) -> None:
+    with _page_totals_lock:
+        if prefix is None: _page_totals.clear(); return
+        for key in [k for k in _page_totals if k[0] == prefix]: _page_totals.pop(key, None)
+
+
+def _fetch_keyset_page(
+    select_sql: str,
+    table: str,
+    where: list[str],
+    params: list,
+    keys: tuple[str, ...],
+    page: int,
+    per_page: int,
+    after: list | None,
+    error_msg: str,
+) -> tuple[list[dict], list | None]:
+    """Страница списка, упорядоченного по keys DESC (последний ключ — первичный ключ таблицы).
+
+    Возвращает строки и значения ключа последней строки (для курсора следующей страницы).
+    """
+    key_cols = ", ".join(f"{k} AS _page_key_{i}" for i, k in enumerate(keys))
+    order_sql = ", ".join(f"{k} DESC" for k in keys)
+    conditions = list(where)
+    query_params = list(params)
+    if after is not None:
+        conditions.append(f"({', '.join(keys)}) < ({', '.join('?' * len(keys))})")
+        query_params.extend(after)
+        limit_sql = " LIMIT ?"
+        query_params.append(per_page)
+    else:
+        pk = keys[-1]
+        inner_where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        conditions = [f"{pk} IN (SELECT {pk} FROM {table}{inner_where} ORDER BY {order_sql} LIMIT ? OFFSET ?)"]
+        query_params.extend([per_page, (page - 1) * per_page])
+        limit_sql = ""
+    where_sql = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = select_sql.replace("{page_keys}", key_cols) + where_sql + f" ORDER BY {order_sql}" + limit_sql
+    rows = _fetch_list(query, tuple(query_params), error_msg)
+    last_values = None
+    for row in rows:
+        last_values = [row.pop(f"_page_key_{i}") for i in range(len(keys))]
+    return rows, last_values
+
+
+def _next_page_cursor(scope: tuple, page: int, per_page: int, total: int, rows: list, last_values: list | None) -> str | None:
+    if last_values is None or len(rows) < per_page or page * per_page >= total: return None
+    return _encode_page_cursor(scope, page + 1, last_values)
+# ================================
+
 
-    query = "SELECT * FROM transactions ORDER BY created_date DESC LIMIT ? OFFSET ?"
-    rows = _fetch_list(query, (per_page, offset), "Не удалось получить страницу транзакций")
+# ===== GET_PAGINATED_TRANSACTIONS =====
+def get_paginated_transactions(page: int = 1, per_page: int = 15, cursor: str | None = None) -> tuple[list[dict], int, str | None]:
+    """Страница транзакций (новые сверху), общее количество и курсор следующей страницы."""
+    page = max(1, int(page or 1))
+    per_page = max(1, int(per_page or 15))
+    scope = ("transactions", per_page)
+    keys = ("tx.created_date", "tx.transaction_id")
+    transactions = []
+
+    total = _cached_total(("transactions",), "SELECT COALESCE(SUM(tx_count), 0) FROM transaction_rollups")
+    rows, last_values = _fetch_keyset_page(
+        "SELECT tx.*, {page_keys} FROM transactions tx", "transactions tx", [], [],
+        keys, page, per_page, _decode_page_cursor(cursor, scope, page, len(keys)),
+        "Не удалось получить страницу транзакций",
+    )
 
     for row in rows:
         transaction_dict = dict(row)
@@ -3513,7 +5226,7 @@ def get_paginated_transactions(page: int = 1, per_page: int = 15) -> tuple[list[
         
         transactions.append(transaction_dict)
     
-    return transactions, total
+    return transactions, total, _next_page_cursor(scope, page, per_page, total, rows, last_values)
 # ==========================================
 
 
@@ -3576,7 +5289,7 @@ def _apply_key_updates(key_id: int, updates: dict[str, Any]) -> bool:
     values = list(updates.values())
     values.append(key_id)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 f"UPDATE vpn_keys SET {columns} WHERE key_id = ?",
@@ -3588,6 +5301,32 @@ def _apply_key_updates(key_id: int, updates: dict[str, Any]) -> bool:
 # ==============================
 
 
+# ===== _KEY_FIELD_UPDATES =====
+def _key_field_updates(fields: dict[str, Any]) -> dict[str, Any]:
+    updates: dict[str, Any] = {
+        column: fields[column]
+        for column in (
+            "user_id", "squad_uuid", "remnawave_user_uuid", "short_uuid", "subscription_url",
+            "traffic_limit_bytes", "tag", "description", "comment_key",
+        )
+        if fields.get(column) is not None
+    }
+    if fields.get("host_name") is not None:
+        updates["host_name"] = normalize_host_name(fields["host_name"])
+    if fields.get("email") is not None:
+        normalized = _normalize_email(fields["email"]) or fields["email"].strip()
+        updates["email"] = normalized
+        updates["key_email"] = normalized
+    if fields.get("expire_at_ms") is not None:
+        updates["expire_at"] = _to_datetime_str(fields["expire_at_ms"]) or _now_str()
+    if fields.get("traffic_limit_strategy") is not None:
+        updates["traffic_limit_strategy"] = fields["traffic_limit_strategy"] or "NO_RESET"
+    if fields.get("is_pinned") is not None:
+        updates["is_pinned"] = 1 if fields["is_pinned"] else 0
+    return updates
+# ===============================
+
+
 # ===== UPDATE_KEY_FIELDS =====
 def update_key_fields(
     key_id: int,
@@ -3607,42 +5346,55 @@ def update_key_fields(
     comment_key: str | None = None,
     is_pinned: bool | None = None,
 ) -> bool:
-    updates: dict[str, Any] = {}
-    if user_id is not None:
-        updates["user_id"] = user_id
-    if host_name is not None:
-        updates["host_name"] = normalize_host_name(host_name)
-    if squad_uuid is not None:
-        updates["squad_uuid"] = squad_uuid
-    if remnawave_user_uuid is not None:
-        updates["remnawave_user_uuid"] = remnawave_user_uuid
-    if short_uuid is not None:
-        updates["short_uuid"] = short_uuid
-    if email is not None:
-        normalized = _normalize_email(email) or email.strip()
-        updates["email"] = normalized
-        updates["key_email"] = normalized
-    if subscription_url is not None:
-        updates["subscription_url"] = subscription_url
-    if expire_at_ms is not None:
-        expire_str = _to_datetime_str(expire_at_ms) or _now_str()
-        updates["expire_at"] = expire_str
-    if traffic_limit_bytes is not None:
-        updates["traffic_limit_bytes"] = traffic_limit_bytes
-    if traffic_limit_strategy is not None:
-        updates["traffic_limit_strategy"] = traffic_limit_strategy or "NO_RESET"
-    if tag is not None:
-        updates["tag"] = tag
-    if description is not None:
-        updates["description"] = description
-    if comment_key is not None:
-        updates["comment_key"] = comment_key
-    if is_pinned is not None:
-        updates["is_pinned"] = 1 if is_pinned else 0
-    return _apply_key_updates(key_id, updates)
+    fields = dict(locals())
+    fields.pop("key_id")
+    return _apply_key_updates(key_id, _key_field_updates(fields))
 # ===========================
 
 
+# ===== BULK_UPDATE_KEYS =====
+def bulk_update_keys(patches: list[tuple[int, dict[str, Any]]], delete_emails: list[str] | tuple = ()) -> dict:
+    """Применяет пачку изменений ключей одной транзакцией.
+
+    patches — пары (key_id, поля как у update_key_fields), delete_emails — email ключей на удаление.
+    Подряд идущие изменения одного набора колонок уходят одним executemany.
+    Возвращает {'updated': ..., 'deleted': ..., 'elapsed_ms': ...}.
+    """
+    started = time.perf_counter()
+    now = _now_str()
+    groups: list[tuple[str, str, list[tuple]]] = []
+    for key_id, fields in patches:
+        updates = _key_field_updates(fields)
+        if not updates: continue
+        updates["updated_at"] = now
+        sql = f"UPDATE vpn_keys SET {', '.join(f'{column} = ?' for column in updates)} WHERE key_id = ?"
+        params = (*updates.values(), key_id)
+        if groups and groups[-1][1] == sql: groups[-1][2].append(params)
+        else: groups.append(("updated", sql, [params]))
+    lookups = dict.fromkeys(_normalize_email(email) or email.strip() for email in delete_emails if email)
+    if lookups:
+        groups.append(("deleted", "DELETE FROM vpn_keys WHERE email = ? OR key_email = ?", [(lookup, lookup) for lookup in lookups]))
+
+    result = {"updated": 0, "deleted": 0, "elapsed_ms": 0.0}
+    if groups:
+        conn = get_db_connection()
+        try:
+            with conn:
+                for kind, sql, rows in groups: result[kind] += max(conn.executemany(sql, rows).rowcount, 0)
+        except sqlite3.Error as e:
+            logging.warning(f"Пакетное обновление ключей не удалось, применяю по одному: {e}")
+            result["updated"] = result["deleted"] = 0
+            for kind, sql, rows in groups:
+                for params in rows:
+                    try:
+                        with conn: result[kind] += max(conn.execute(sql, params).rowcount, 0)
+                    except sqlite3.Error as row_error:
+                        logging.error(f"Не удалось обновить ключ {params[-1]}: {row_error}")
+    result["elapsed_ms"] = (time.perf_counter() - started) * 1000
+    return result
+# ============================
+
+
 # ===== DELETE_KEY_BY_EMAIL =====
 def delete_key_by_email(email: str) -> bool:
     lookup = _normalize_email(email) or email.strip()
@@ -3683,7 +5435,7 @@ def get_key_by_subscription_url(subscription_url: str) -> dict | None:
     lookup = (subscription_url or "").strip()
     if not lookup:
         return None
-    with sqlite3.connect(DB_FILE, timeout=30.0) as conn:
+    with get_db_connection() as conn:
         columns = {row[1] for row in conn.execute("PRAGMA table_info(vpn_keys)")}
     has_connection_string = "connection_string" in columns
     row = _fetch_row(
@@ -3819,20 +5571,9 @@ def get_daily_stats_for_charts(days: int = 30) -> dict:
         params.append(f'-{days} days')
         if days == 1: group_fmt = "%Y-%m-%d %H:00"
     
-    def get_data(table, date_col, is_count=True):
-        nonlocal group_fmt
+    def get_data(table, date_col):
         where_clause = f"WHERE {date_col} {time_filter}" if time_filter else ""
-        
-        if is_count:
-            query = f"SELECT STRFTIME('{group_fmt}', {date_col}) AS period, COUNT(*) as cnt FROM {table} {where_clause} GROUP BY period ORDER BY period"
-        else:
-            income_filter = "LOWER(COALESCE(status, '')) IN ('paid', 'completed', 'success') AND LOWER(COALESCE(payment_method, '')) NOT IN ('balance', 'admin', 'referral')"
-            if where_clause:
-                where_clause += f" AND {income_filter}"
-            else:
-                where_clause = f"WHERE {income_filter}"
-            query = f"SELECT STRFTIME('{group_fmt}', {date_col}) AS period, payment_method, SUM(amount_rub) as total FROM {table} {where_clause} GROUP BY period, payment_method ORDER BY period"
-        
+        query = f"SELECT STRFTIME('{group_fmt}', {date_col}) AS period, COUNT(*) as cnt FROM {table} {where_clause} GROUP BY period ORDER BY period"
         return _fetch_list(query, tuple(params), "Не удалось получить данные статистики по дням")
 
     for row in get_data("users", "registration_date"):
@@ -3841,48 +5582,49 @@ def get_daily_stats_for_charts(days: int = 30) -> dict:
     for row in get_data("vpn_keys", "COALESCE(created_at, updated_at, CURRENT_TIMESTAMP)"):
         stats['keys'][row['period']] = row['cnt']
 
-    for row in get_data("transactions", "created_date", is_count=False):
+    # Финансы берутся из transaction_rollups: граница периода округляется до часа
+    tx_where = "status IN ('paid', 'completed', 'success') AND LOWER(payment_method) NOT IN ('balance', 'admin', 'referral')"
+    tx_params = []
+    if days > 0:
+        tx_where += " AND (day, hour) >= (date('now', '+3 hours', ?), CAST(strftime('%H', 'now', '+3 hours', ?) AS INTEGER))"
+        tx_params += [f'-{days} days', f'-{days} days']
+    period_expr = "day || printf(' %02d:00', hour)" if group_fmt == "%Y-%m-%d %H:00" else "day"
+    income_rows = _fetch_list(
+        f"""
+        SELECT {period_expr} AS period, payment_method, SUM(amount_sum) AS total
+        FROM transaction_rollups
+        WHERE {tx_where}
+        GROUP BY period, payment_method
+        ORDER BY period
+        """,
+        tuple(tx_params),
+        "Не удалось получить данные статистики по дням"
+    )
+    for row in income_rows:
         period = row['period']
         method = row['payment_method']
         amount = row['total']
         if period not in stats['income']:
             stats['income'][period] = {}
         stats['income'][period][method or 'Other'] = float(amount) if amount else 0.0
-    
-    tx_where = "WHERE LOWER(COALESCE(status, '')) IN ('paid', 'completed', 'success')"
-    tx_params = []
-    if days > 0:
-        tx_where += " AND created_date >= datetime('now', '+3 hours', ?)"
-        tx_params.append(f'-{days} days')
-    rows = _fetch_list(
+
+    row = _fetch_row(
         f"""
-        SELECT amount_rub, payment_method, metadata
-        FROM transactions
-        {tx_where}
+        SELECT
+            COALESCE(SUM(CASE WHEN action = 'topup' THEN amount_abs_sum END), 0.0) AS topups_amount,
+            COALESCE(SUM(CASE WHEN action = 'topup' THEN tx_count END), 0) AS topups_count,
+            COALESCE(SUM(CASE WHEN action != 'topup' THEN amount_abs_sum END), 0.0) AS subscriptions_amount,
+            COALESCE(SUM(CASE WHEN action != 'topup' THEN tx_count END), 0) AS subscriptions_count
+        FROM transaction_rollups
+        WHERE {tx_where}
         """,
         tuple(tx_params),
         "Не удалось получить финансовую статистику"
-    )
-    for row in rows:
-        amount = float(row['amount_rub'] or 0.0)
-        payment_method = str(row['payment_method'] or '').strip().lower()
-        try:
-            metadata = json.loads(row['metadata'] or '{}')
-            if not isinstance(metadata, dict):
-                metadata = {}
-        except Exception:
-            metadata = {}
-        action = str(metadata.get('action') or '').strip().lower()
-        reason = str(metadata.get('reason') or '').strip().lower()
-        is_income_method = payment_method not in ('balance', 'admin', 'referral')
-        is_topup = action in ('topup', 'top_up') or reason == 'external_balance_top_up'
-        is_subscription = action in ('new', 'extend') or reason == 'subscription_purchase_or_extend' or any(metadata.get(k) for k in ('plan_id', 'key_id', 'host_name', 'host', 'customer_email')) or is_income_method
-        if is_topup and is_income_method:
-            stats['finance']['topups']['amount'] += abs(amount)
-            stats['finance']['topups']['count'] += 1
-        elif is_subscription and is_income_method:
-            stats['finance']['subscriptions']['amount'] += abs(amount)
-            stats['finance']['subscriptions']['count'] += 1
+    ) or {}
+    stats['finance']['topups']['amount'] = float(row.get('topups_amount') or 0.0)
+    stats['finance']['topups']['count'] = int(row.get('topups_count') or 0)
+    stats['finance']['subscriptions']['amount'] = float(row.get('subscriptions_amount') or 0.0)
+    stats['finance']['subscriptions']['count'] = int(row.get('subscriptions_count') or 0)
     stats['finance']['total']['amount'] = stats['finance']['topups']['amount'] + stats['finance']['subscriptions']['amount']
     stats['finance']['total']['count'] = stats['finance']['topups']['count'] + stats['finance']['subscriptions']['count']
     return stats
@@ -3917,42 +5659,41 @@ def get_all_users() -> list[dict]:
 
 
 # ===== GET_USERS_PAGINATED =====
-def get_users_paginated(page: int = 1, per_page: int = 30, q: str | None = None) -> tuple[list[dict], int]:
-    """Вернуть пользователей постранично и общее количество (с учётом фильтра).
+def get_users_paginated(page: int = 1, per_page: int = 30, q: str | None = None, cursor: str | None = None) -> tuple[list[dict], int, str | None]:
+    """Вернуть пользователей постранично, общее количество (с учётом фильтра) и курсор следующей страницы.
 
-    Фильтр q ищет по username (LIKE) и по текстовому представлению telegram_id.
+    Фильтр q ищет по поисковому индексу admin_search: username, telegram_id, а также ключи и платежи пользователя.
     """
     page = max(1, int(page or 1))
     per_page = max(1, int(per_page or 30))
-    offset = (page - 1) * per_page
-    
-    if q:
-        q_like = f"%{q.strip()}%"
-        
-        count_query = """
-            SELECT COUNT(*)
-            FROM users
-            WHERE (username LIKE ?)
-               OR (CAST(telegram_id AS TEXT) LIKE ?)
-        """
-        total = _fetch_val(count_query, (q_like, q_like), 0, "Не удалось подсчитать пользователей с фильтром") or 0
+    q = (q or "").strip()
+    scope = ("users", per_page, q)
+    keys = ("u.list_order", "u.telegram_id")
 
-        data_query = """
-            SELECT *
-            FROM users
-            WHERE (username LIKE ?)
-               OR (CAST(telegram_id AS TEXT) LIKE ?)
-            ORDER BY is_pinned DESC, registration_date DESC
-            LIMIT ? OFFSET ?
-        """
-        users = _fetch_list(data_query, (q_like, q_like, per_page, offset), "Не удалось получить страницу пользователей с фильтром")
+    where, params = [], []
+    if q:
+        match = _admin_search_match(q)
+        if match:
+            match_sql, match_params = match
+            where.append(
+                f"(u.telegram_id IN ({_admin_search_ids_sql(match_sql, 'users')})"
+                f" OR u.telegram_id IN (SELECT user_id FROM vpn_keys WHERE key_id IN ({_admin_search_ids_sql(match_sql, 'vpn_keys')}))"
+                f" OR u.telegram_id IN (SELECT user_id FROM transactions WHERE transaction_id IN ({_admin_search_ids_sql(match_sql, 'transactions')})))"
+            )
+            params.extend(match_params * 3)
+        else:
+            where.append(_admin_search_like("users", "u"))
+            params.append(f"%{q}%")
+        total = _cached_total(("users", q), f"SELECT COUNT(*) FROM users u WHERE {where[0]}", tuple(params))
     else:
-        total = _fetch_val("SELECT COUNT(*) FROM users", (), 0, "Не удалось подсчитать пользователей") or 0
-        
-        data_query = "SELECT * FROM users ORDER BY is_pinned DESC, registration_date DESC LIMIT ? OFFSET ?"
-        users = _fetch_list(data_query, (per_page, offset), "Не удалось получить страницу пользователей")
+        total = _cached_total(("users", ""), "SELECT COUNT(*) FROM users")
 
-    return users, total
+    users, last_values = _fetch_keyset_page(
+        "SELECT u.*, {page_keys} FROM users u", "users u", where, params,
+        keys, page, per_page, _decode_page_cursor(cursor, scope, page, len(keys)),
+        "Не удалось получить страницу пользователей",
+    )
+    return users, total, _next_page_cursor(scope, page, per_page, total, users, last_values)
 
 
     return users, total
@@ -4043,13 +5784,14 @@ def get_or_create_open_ticket(user_id: int, subject: str | None = None) -> tuple
 
 # ===== ADD_SUPPORT_MESSAGE =====
 def add_support_message(ticket_id: int, sender: str, content: str, media: str | None = None) -> int | None:
-    cursor = _exec(
-        "INSERT INTO support_messages (ticket_id, sender, content, media) VALUES (?, ?, ?, ?)",
-        (ticket_id, sender, content, media),
+    return _append_row(
+        "support_messages",
+        [
+            ("INSERT INTO support_messages (ticket_id, sender, content, media) VALUES (?, ?, ?, ?)", (ticket_id, sender, content, media)),
+            ("UPDATE support_tickets SET updated_at = CURRENT_TIMESTAMP WHERE ticket_id = ?", (ticket_id,)),
+        ],
         f"Не удалось добавить сообщение в тикет {ticket_id}"
     )
-    if cursor and cursor.lastrowid: mid = cursor.lastrowid; _exec("UPDATE support_tickets SET updated_at = CURRENT_TIMESTAMP WHERE ticket_id = ?", (ticket_id,), "Не удалось обновить время тикета"); return mid
-    return None
 # =============================
 
 
@@ -4129,6 +5871,7 @@ def set_ticket_status(ticket_id: int, status: str) -> bool:
         (status, ticket_id),
         f"Не удалось установить статус '{status}' для тикета {ticket_id}"
     )
+    invalidate_page_totals("tickets")
     return cursor is not None and cursor.rowcount > 0
 
     return cursor is not None and cursor.rowcount > 0
@@ -4152,6 +5895,7 @@ def update_ticket_subject(ticket_id: int, subject: str) -> bool:
 def delete_ticket(ticket_id: int) -> bool:
     _exec("DELETE FROM support_messages WHERE ticket_id = ?", (ticket_id,), "Не удалось удалить сообщения тикета")
     cursor = _exec("DELETE FROM support_tickets WHERE ticket_id = ?", (ticket_id,), f"Не удалось удалить тикет {ticket_id}")
+    invalidate_page_totals("tickets")
     return cursor is not None and cursor.rowcount > 0
 
     return cursor is not None and cursor.rowcount > 0
@@ -4159,47 +5903,31 @@ def delete_ticket(ticket_id: int) -> bool:
 
 
 # ===== GET_TICKETS_PAGINATED =====
-def get_tickets_paginated(page: int = 1, per_page: int = 20, status: str | None = None) -> tuple[list[dict], int]:
-    offset = (page - 1) * per_page
-    
+def get_tickets_paginated(page: int = 1, per_page: int = 20, status: str | None = None, cursor: str | None = None) -> tuple[list[dict], int, str | None]:
+    """Тикеты в порядке очереди: ждущие ответа, открытые, закрытые; внутри — по времени обновления."""
+    page = max(1, int(page or 1))
+    per_page = max(1, int(per_page or 20))
+    scope = ("tickets", per_page, status or "")
+    keys = ("t.queue_weight", "t.updated_at", "t.ticket_id")
+
     if status:
-        total = _fetch_val("SELECT COUNT(*) FROM support_tickets WHERE status = ?", (status,), 0) or 0
-        where_clause = " WHERE t.status = ?"
-        params = [status]
+        total = _cached_total(("tickets", status), "SELECT COUNT(*) FROM support_tickets WHERE status = ?", (status,))
+        where, params = ["t.status = ?"], [status]
     else:
-        total = _fetch_val("SELECT COUNT(*) FROM support_tickets", (), 0) or 0
-        where_clause = ""
-        params = []
-    
-    base_query = """
-        SELECT t.*, 
-               u.username,
-               (SELECT sender FROM support_messages 
-                WHERE ticket_id = t.ticket_id 
-                ORDER BY created_at DESC LIMIT 1) as last_sender
+        total = _cached_total(("tickets", ""), "SELECT COUNT(*) FROM support_tickets")
+        where, params = [], []
+
+    rows, last_values = _fetch_keyset_page(
+        """
+        SELECT t.*, u.username, {page_keys}
         FROM support_tickets t
         LEFT JOIN users u ON t.user_id = u.telegram_id
-    """
-    
-    order_clause = """
-        ORDER BY 
-        CASE 
-            WHEN t.status = 'open' AND (
-                SELECT sender FROM support_messages 
-                WHERE ticket_id = t.ticket_id 
-                ORDER BY created_at DESC LIMIT 1
-            ) != 'admin' THEN 1
-            WHEN t.status = 'open' THEN 2
-            ELSE 3
-        END ASC,
-        t.updated_at DESC
-    """
-    
-    full_query = base_query + where_clause + order_clause + " LIMIT ? OFFSET ?"
-    params.extend([per_page, offset])
-    
-    rows = _fetch_list(full_query, tuple(params), "Не удалось получить страницу тикетов поддержки")
-    return rows, total
+        """,
+        "support_tickets t", where, params,
+        keys, page, per_page, _decode_page_cursor(cursor, scope, page, len(keys)),
+        "Не удалось получить страницу тикетов поддержки",
+    )
+    return rows, total, _next_page_cursor(scope, page, per_page, total, rows, last_values)
 # ===========================
 
 
@@ -4338,8 +6066,7 @@ def update_other_setting(key: str, value: Any) -> bool:
 
 
 def get_all_other_settings() -> dict:
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
+    with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT key, value FROM other")
         return {row['key']: row['value'] for row in cursor.fetchall()}
@@ -4405,6 +6132,24 @@ def get_auth_token_by_user_id(user_id: int) -> str | None:
     return row["auth_token"] if row else None
 
 # ===== ДАШБОРД: СТАТИСТИКА ГРУПП ПОЛЬЗОВАТЕЛЕЙ =====
+# Факты по пользователю считаются один раз: покупки берутся из user_purchase_stats, ключи
+# агрегируются по владельцу (по покрывающему индексу idx_vpn_keys_user_segments), после чего
+# группы раскладываются за один проход по users.
+_KEY_IS_TRIAL = "COALESCE(key_email, '') LIKE 'trial_%'"
+_KEY_IS_ACTIVE = "(expire_at IS NULL OR expire_at > datetime('now', '+3 hours'))"
+_USER_FACTS_CTE = f"""
+WITH key_facts AS (
+    SELECT user_id,
+           MAX(NOT is_trial) AS has_paid_key,
+           MAX(CASE WHEN is_trial AND is_active THEN key_id END) AS trial_key_id,
+           MAX(CASE WHEN NOT is_trial AND is_active THEN key_id END) AS paid_key_id,
+           SUM(NOT is_trial AND is_active) AS active_paid_keys
+    FROM (SELECT key_id, user_id, {_KEY_IS_TRIAL} AS is_trial, {_KEY_IS_ACTIVE} AS is_active FROM vpn_keys)
+    GROUP BY user_id
+)
+"""
+
+
 def get_dashboard_user_groups() -> dict:
     groups = {
         "no_purchases": [],
@@ -4413,102 +6158,77 @@ def get_dashboard_user_groups() -> dict:
         "active_buyers": [],
         "active_keys": []
     }
-    
-    def purchase_condition(alias: str) -> str:
-        meta_expr = f"CASE WHEN json_valid(COALESCE({alias}.metadata, '{{}}')) THEN COALESCE({alias}.metadata, '{{}}') ELSE '{{}}' END"
-        return f"""
-        LOWER(COALESCE({alias}.status, '')) IN ('paid', 'completed', 'success', 'succeeded')
-        AND LOWER(COALESCE({alias}.payment_method, '')) NOT IN ('admin', 'referral')
-        AND (
-            LOWER(COALESCE(json_extract({meta_expr}, '$.action'), '')) IN ('new', 'extend')
-            OR LOWER(COALESCE(json_extract({meta_expr}, '$.reason'), '')) = 'subscription_purchase_or_extend'
-            OR json_extract({meta_expr}, '$.plan_id') IS NOT NULL
-            OR json_extract({meta_expr}, '$.key_id') IS NOT NULL
-            OR json_extract({meta_expr}, '$.host_name') IS NOT NULL
-            OR json_extract({meta_expr}, '$.host') IS NOT NULL
-            OR json_extract({meta_expr}, '$.customer_email') IS NOT NULL
-        )
-        """
-    
-    # 1. Не купил ключ (нет транзакций 'paid' и нет ключей)
-    q_no = f"""
-    SELECT u.telegram_id, u.username, u.balance,
-           (SELECT COALESCE(SUM(t2.amount_rub), 0) FROM transactions t2 WHERE t2.user_id = u.telegram_id AND {purchase_condition('t2')}) as total_spent
-    FROM users u
-    WHERE NOT EXISTS (SELECT 1 FROM vpn_keys k WHERE k.user_id = u.telegram_id AND COALESCE(k.key_email, '') NOT LIKE 'trial_%')
-      AND NOT EXISTS (SELECT 1 FROM transactions t WHERE t.user_id = u.telegram_id AND {purchase_condition('t')})
-    """
-    groups["no_purchases"] = _fetch_list(q_no, (), "Ошибка получения no_purchases")
-    
-    # 2. Покупали, но сейчас нет активных (истекли или нет ключей, но есть транзакции)
-    q_inactive = f"""
-    SELECT u.telegram_id, u.username, u.balance,
-           (SELECT SUM(COALESCE(
-               CAST(json_extract(t2.metadata, '$.months') AS INTEGER),
-               (SELECT p.months FROM plans p WHERE p.plan_id = CAST(json_extract(t2.metadata, '$.plan_id') AS INTEGER)),
-               0
-           )) FROM transactions t2 WHERE t2.user_id = u.telegram_id AND {purchase_condition('t2')}) as months_bought,
-           (SELECT COALESCE(SUM(t2.amount_rub), 0) FROM transactions t2 WHERE t2.user_id = u.telegram_id AND {purchase_condition('t2')}) as total_spent
-    FROM users u
-    WHERE EXISTS (SELECT 1 FROM transactions t WHERE t.user_id = u.telegram_id AND {purchase_condition('t')})
-      AND NOT EXISTS (
-          SELECT 1 FROM vpn_keys k 
-          WHERE k.user_id = u.telegram_id 
-            AND COALESCE(k.key_email, '') NOT LIKE 'trial_%'
-            AND (k.expire_at IS NULL OR k.expire_at > datetime('now', '+3 hours'))
-      )
-    """
-    groups["inactive_buyers"] = _fetch_list(q_inactive, (), "Ошибка получения inactive_buyers")
-    
-    # 3. Используют триал (есть активный триальный ключ)
-    q_trials = """
-    SELECT u.telegram_id, u.username, u.balance, k.key_id, k.expire_at,
-           (SELECT SUM(COALESCE(
-               CAST(json_extract(t2.metadata, '$.months') AS INTEGER),
-               (SELECT p.months FROM plans p WHERE p.plan_id = CAST(json_extract(t2.metadata, '$.plan_id') AS INTEGER)),
-               0
-           )) FROM transactions t2 WHERE t2.user_id = u.telegram_id AND """ + purchase_condition('t2') + """) as months_bought,
-           (SELECT COALESCE(SUM(t2.amount_rub), 0) FROM transactions t2 WHERE t2.user_id = u.telegram_id AND """ + purchase_condition('t2') + """) as total_spent
-    FROM users u
-    JOIN vpn_keys k ON k.user_id = u.telegram_id
-    WHERE COALESCE(k.key_email, '') LIKE 'trial_%' 
-      AND (k.expire_at IS NULL OR k.expire_at > datetime('now', '+3 hours'))
-    GROUP BY u.telegram_id
-    """
-    groups["trials"] = _fetch_list(q_trials, (), "Ошибка получения trials")
-    
-    # 4. Купили ключ (есть активный нетриальный ключ)
-    q_active_buyers = f"""
-    SELECT u.telegram_id, u.username, u.balance, k.key_id, k.expire_at,
-           (SELECT SUM(COALESCE(
-               CAST(json_extract(t2.metadata, '$.months') AS INTEGER),
-               (SELECT p.months FROM plans p WHERE p.plan_id = CAST(json_extract(t2.metadata, '$.plan_id') AS INTEGER)),
-               0
-           )) FROM transactions t2 WHERE t2.user_id = u.telegram_id AND {purchase_condition('t2')}) as months_bought,
-           (SELECT COALESCE(SUM(t2.amount_rub), 0) FROM transactions t2 WHERE t2.user_id = u.telegram_id AND {purchase_condition('t2')}) as total_spent
-    FROM users u
-    JOIN vpn_keys k ON k.user_id = u.telegram_id
-    WHERE COALESCE(k.key_email, '') NOT LIKE 'trial_%' 
-      AND (k.expire_at IS NULL OR k.expire_at > datetime('now', '+3 hours'))
-    GROUP BY u.telegram_id
-    """
-    groups["active_buyers"] = _fetch_list(q_active_buyers, (), "Ошибка получения active_buyers")
-    
+
+    rows = _fetch_list(
+        f"""
+        {_USER_FACTS_CTE}
+        SELECT u.telegram_id, u.username, u.balance,
+               p.user_id IS NOT NULL AS has_purchase,
+               p.months_bought, COALESCE(p.total_spent, 0) AS total_spent,
+               COALESCE(kf.has_paid_key, 0) AS has_paid_key,
+               kf.trial_key_id, tk.expire_at AS trial_expire_at,
+               kf.paid_key_id, pk.expire_at AS paid_expire_at
+        FROM users u
+        LEFT JOIN user_purchase_stats p ON p.user_id = u.telegram_id
+        LEFT JOIN key_facts kf ON kf.user_id = u.telegram_id
+        LEFT JOIN vpn_keys tk ON tk.key_id = kf.trial_key_id
+        LEFT JOIN vpn_keys pk ON pk.key_id = kf.paid_key_id
+        """,
+        (),
+        "Ошибка получения групп пользователей"
+    )
+    for row in rows:
+        base = {"telegram_id": row["telegram_id"], "username": row["username"], "balance": row["balance"]}
+        bought = {"months_bought": row["months_bought"], "total_spent": row["total_spent"]}
+        # 1. Не купил ключ (нет покупок и нет нетриальных ключей)
+        if not row["has_purchase"] and not row["has_paid_key"]:
+            groups["no_purchases"].append({**base, "total_spent": row["total_spent"]})
+        # 2. Покупали, но сейчас нет активных нетриальных ключей
+        if row["has_purchase"] and row["paid_key_id"] is None:
+            groups["inactive_buyers"].append({**base, **bought})
+        # 3. Используют триал (есть активный триальный ключ)
+        if row["trial_key_id"] is not None:
+            groups["trials"].append({**base, "key_id": row["trial_key_id"], "expire_at": row["trial_expire_at"], **bought})
+        # 4. Купили ключ (есть активный нетриальный ключ)
+        if row["paid_key_id"] is not None:
+            groups["active_buyers"].append({**base, "key_id": row["paid_key_id"], "expire_at": row["paid_expire_at"], **bought})
+
     # 5. Всего активных ключей (действующих)
-    q_active_keys = f"""
-    SELECT k.key_id, k.user_id as telegram_id, k.host_name, k.expire_at, u.username, u.balance,
-           (SELECT SUM(COALESCE(
-               CAST(json_extract(t2.metadata, '$.months') AS INTEGER),
-               (SELECT p.months FROM plans p WHERE p.plan_id = CAST(json_extract(t2.metadata, '$.plan_id') AS INTEGER)),
-               0
-           )) FROM transactions t2 WHERE t2.user_id = u.telegram_id AND {purchase_condition('t2')}) as months_bought,
-           (SELECT COALESCE(SUM(t2.amount_rub), 0) FROM transactions t2 WHERE t2.user_id = u.telegram_id AND {purchase_condition('t2')}) as total_spent
-    FROM vpn_keys k
-    LEFT JOIN users u ON k.user_id = u.telegram_id
-    WHERE (k.expire_at IS NULL OR k.expire_at > datetime('now', '+3 hours'))
-      AND COALESCE(k.key_email, '') NOT LIKE 'trial_%'
-    """
-    groups["active_keys"] = _fetch_list(q_active_keys, (), "Ошибка получения active_keys")
-    
+    groups["active_keys"] = _fetch_list(
+        """
+        SELECT k.key_id, k.user_id as telegram_id, k.host_name, k.expire_at, u.username, u.balance,
+               p.months_bought, COALESCE(p.total_spent, 0) AS total_spent
+        FROM vpn_keys k
+        LEFT JOIN users u ON k.user_id = u.telegram_id
+        LEFT JOIN user_purchase_stats p ON p.user_id = u.telegram_id
+        WHERE (k.expire_at IS NULL OR k.expire_at > datetime('now', '+3 hours'))
+          AND COALESCE(k.key_email, '') NOT LIKE 'trial_%'
+        """,
+        (),
+        "Ошибка получения active_keys"
+    )
     return groups
 # ===================================================
+
+
+# ===== ДАШБОРД: КОЛИЧЕСТВО В ГРУППАХ ПОЛЬЗОВАТЕЛЕЙ =====
+# Те же группы, что и get_dashboard_user_groups, но только количества — без выборки списков
+def get_dashboard_user_group_counts() -> dict:
+    row = _fetch_row(
+        f"""
+        {_USER_FACTS_CTE}
+        SELECT
+            COALESCE(SUM(p.user_id IS NULL AND COALESCE(kf.has_paid_key, 0) = 0), 0) AS no_purchases,
+            COALESCE(SUM(p.user_id IS NOT NULL AND kf.paid_key_id IS NULL), 0) AS inactive_buyers,
+            COALESCE(SUM(kf.trial_key_id IS NOT NULL), 0) AS trials,
+            COALESCE(SUM(kf.paid_key_id IS NOT NULL), 0) AS active_buyers,
+            (SELECT COALESCE(SUM(active_paid_keys), 0) FROM key_facts) AS active_keys
+        FROM users u
+        LEFT JOIN user_purchase_stats p ON p.user_id = u.telegram_id
+        LEFT JOIN key_facts kf ON kf.user_id = u.telegram_id
+        """,
+        (),
+        "Ошибка получения количества в группах пользователей"
+    ) or {}
+    return {name: int(row.get(name) or 0) for name in ("no_purchases", "inactive_buyers", "trials", "active_buyers", "active_keys")}
+# ===================================================
@@ -12,9 +12,7 @@ normalize_host_name = database.normalize_host_name
 
 
 def _connect() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return database.get_db_connection()
 
 
 def _normalize_email(value: str | None) -> str:
@@ -42,28 +40,7 @@ def list_squads(active_only: bool = False) -> list[dict[str, Any]]:
 
 
 def get_squad(identifier: str) -> dict[str, Any] | None:
-    if not identifier:
-        return None
-    ident = identifier.strip()
-    if not ident:
-        return None
-    normalized = normalize_host_name(ident)
-    with _connect() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT *
-            FROM xui_hosts
-            WHERE TRIM(host_name) = TRIM(?)
-               OR TRIM(host_name) = TRIM(?)
-               OR TRIM(squad_uuid) = TRIM(?)
-               OR TRIM(squad_uuid) = TRIM(?)
-            LIMIT 1
-            """,
-            (ident, normalized, ident, normalized),
-        )
-        row = cursor.fetchone()
-        return dict(row) if row else None
+    return database.get_host_cached(identifier)
 
 
 def get_key_by_id(key_id: int) -> dict | None:
@@ -246,7 +223,21 @@ _LEGACY_FORWARDERS = (
     "add_to_referral_balance",
     "add_to_referral_balance_all",
     "adjust_user_balance",
+    "change_balance",
+    "refund_payment",
+    "reconcile_balance_ledger",
+    "get_balance_ledger",
+    "claim_payment",
+    "finish_payment_claim",
+    "release_payment_claim",
+    "get_payment_claim",
+    "bulk_update_keys",
+    "run_db_maintenance",
+    "get_db_storage_stats",
+    "get_query_stats",
+    "reset_query_stats",
     "ban_user",
+    "count_keys_expired_before",
     "create_gift_key",
     "create_host",
     "create_pending_transaction",
@@ -268,10 +259,13 @@ _LEGACY_FORWARDERS = (
     "get_pending_status",
     "get_pending_metadata",
     "get_admin_ids",
+    "get_admin_users",
     "get_admin_stats",
     "get_all_hosts",
     "get_all_keys",
     "get_all_settings",
+    "invalidate_settings_cache",
+    "invalidate_hosts_cache",
     "get_all_tickets_count",
     "get_all_users",
     "get_user_id_by_gift_token",
@@ -280,8 +274,11 @@ _LEGACY_FORWARDERS = (
     "get_support_badge_counts",
     "get_daily_stats_for_charts",
     "get_host",
+    "get_keys_expired_before",
+    "get_keys_expiring_between",
     "get_keys_for_host",
     "get_keys_for_user",
+    "get_keys_paginated",
     "get_latest_speedtest",
     "get_next_key_number",
     "get_open_tickets_count",
@@ -319,6 +316,8 @@ _LEGACY_FORWARDERS = (
     "is_admin",
     "log_transaction",
     "register_user_if_not_exists",
+    "rebuild_transaction_rollups",
+    "rebuild_admin_search_index",
     "run_migration",
     "set_referral_start_bonus_received",
     "set_terms_agreed",
@@ -360,8 +359,14 @@ _LEGACY_FORWARDERS = (
     "update_host_sort_order",
 
     "insert_resource_metric",
+    "flush_write_batches",
+    "stop_write_batcher",
+    "get_write_batch_stats",
     "get_latest_resource_metric",
     "get_metrics_series",
+    "prune_resource_metrics",
+    "clear_monitoring_data",
+    "get_metrics_db_file",
     "get_other_value",
     "set_other_value",
     "get_all_other_settings",
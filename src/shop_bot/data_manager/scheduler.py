@@ -30,10 +30,13 @@ def get_msk_time() -> datetime:
 
 
 SPEEDTEST_INTERVAL_SECONDS = 8 * 3600
+METRICS_PRUNE_INTERVAL_SECONDS = 3600
 _scheduler_start_time = get_msk_time()
 _last_speedtests_run_at: datetime | None = None
 _last_backup_run_at: datetime | None = None
 _last_resource_collect_at: datetime | None = None
+_last_metrics_prune_at: datetime | None = None
+_last_db_maintenance_date = None
 _last_resource_alert_at: dict[tuple[str, str, str], datetime] = {}
 
 def format_time_left(hours: int) -> str:
@@ -109,14 +112,18 @@ def _cleanup_notified_users(all_db_keys: list[dict]):
 
 async def check_expiring_subscriptions(bot: Bot):
     logger.debug("Scheduler: Проверяю истекающие подписки...")
-    current_time = get_msk_time().replace(tzinfo=None)
-    all_keys = rw_repo.get_all_keys()
+    now = get_msk_time()
+    current_time = now.replace(tzinfo=None)
+    now_ms = int(now.timestamp() * 1000)
+    # Уведомления нужны только в окне ближайших max(NOTIFY_BEFORE_HOURS) часов — выбираем его диапазоном по индексу
+    window_ms = (max(NOTIFY_BEFORE_HOURS) + 1) * 3600 * 1000
+    expiring_keys = rw_repo.get_keys_expiring_between(now_ms, now_ms + window_ms)
     
-    _cleanup_notified_users(all_keys)
+    _cleanup_notified_users(expiring_keys)
     
-    for key in all_keys:
+    for key in expiring_keys:
         try:
-            expiry_date = datetime.fromisoformat(key['expiry_date'])
+            expiry_date = datetime.fromtimestamp(key['expire_at_ms'] / 1000, tz=now.tzinfo).replace(tzinfo=None)
             time_left = expiry_date - current_time
 
             if time_left.total_seconds() < 0:
@@ -168,7 +175,10 @@ async def sync_keys_with_panels():
             remote_by_email[raw_email.lower()] = (raw_email, remote_user)
 
         keys_in_db = rw_repo.get_keys_for_host(host_name) or []
-        now = get_msk_time().replace(tzinfo=None)
+        # Изменения по скваду копятся и применяются одной транзакцией в конце
+        key_patches: list[tuple[int, dict]] = []
+        deleted_emails: list[str] = []
+        expired_cutoff_ms = int((get_msk_time() - timedelta(days=5)).timestamp() * 1000)
 
         for db_key in keys_in_db:
             raw_email = (db_key.get('key_email') or db_key.get('email') or '').strip()
@@ -203,8 +213,7 @@ async def sync_keys_with_panels():
                                 except Exception:
                                     pass
                             subscription_url = remnawave_api.extract_subscription_url(rem_user)
-                            rw_repo.update_key_fields(
-                                db_key.get('key_id'),
+                            key_patches.append((db_key.get('key_id'), dict(
                                 email=rem_email,
                                 remnawave_user_uuid=rem_uuid,
                                 expire_at_ms=expire_ms,
@@ -212,20 +221,12 @@ async def sync_keys_with_panels():
                                 short_uuid=rem_user.get('shortUuid') or rem_user.get('short_uuid'),
                                 traffic_limit_bytes=rem_user.get('trafficLimitBytes') or rem_user.get('traffic_limit_bytes'),
                                 traffic_limit_strategy=rem_user.get('trafficLimitStrategy') or rem_user.get('traffic_limit_strategy'),
-                            )
-                            total_affected_records += 1
+                            )))
                             break
 
-            expiry_raw = db_key.get('expiry_date') or db_key.get('expire_at')
-            try:
-                expiry_date = datetime.fromisoformat(str(expiry_raw)) if expiry_raw else None
-            except Exception:
-                try:
-                    expiry_date = datetime.fromisoformat(str(expiry_raw).replace('Z', '+00:00'))
-                except Exception:
-                    expiry_date = None
+            local_ms = db_key.get('expire_at_ms')
 
-            if expiry_date and expiry_date < now - timedelta(days=5):
+            if local_ms is not None and local_ms < expired_cutoff_ms:
                 logger.debug(
                     "Scheduler: Ключ '%s' (host '%s') просрочен более 5 дней. Удаляю пользователя из Remnawave и БД.",
                     raw_email,
@@ -239,8 +240,7 @@ async def sync_keys_with_panels():
                         raw_email,
                         exc,
                     )
-                if rw_repo.delete_key_by_email(raw_email):
-                    total_affected_records += 1
+                deleted_emails.append(raw_email)
                 continue
 
             if remote_user:
@@ -251,7 +251,6 @@ async def sync_keys_with_panels():
                         remote_dt = datetime.fromisoformat(str(expire_value).replace('Z', '+00:00'))
                     except Exception:
                         remote_dt = None
-                local_ms = int(expiry_date.timestamp() * 1000) if expiry_date else None
                 remote_ms = int(remote_dt.timestamp() * 1000) if remote_dt else None
                 subscription_url = remnawave_api.extract_subscription_url(remote_user)
                 local_subscription = db_key.get('subscription_url') or db_key.get('connection_string')
@@ -263,21 +262,23 @@ async def sync_keys_with_panels():
                     needs_update = True
 
                 if needs_update:
-                    if rw_repo.update_key_status_from_server(raw_email, remote_user):
-                        total_affected_records += 1
-                        logger.debug(
-                            "Scheduler: Обновлён ключ '%s' на основе данных Remnawave (host '%s').",
-                            raw_email,
-                            host_name,
-                        )
+                    key_patches.append((db_key.get('key_id'), dict(
+                        remnawave_user_uuid=remote_user.get('uuid') or remote_user.get('id'),
+                        expire_at_ms=remote_ms,
+                        subscription_url=remote_user.get('subscriptionUrl') or remote_user.get('subscription_url'),
+                    )))
+                    logger.debug(
+                        "Scheduler: Ключ '%s' будет обновлён на основе данных Remnawave (host '%s').",
+                        raw_email,
+                        host_name,
+                    )
             else:
                 logger.warning(
                     "Scheduler: Ключ '%s' (host '%s') отсутствует в Remnawave. Помечаю к удалению в локальной БД.",
                     raw_email,
                     host_name,
                 )
-                if rw_repo.update_key_status_from_server(raw_email, None):
-                    total_affected_records += 1
+                deleted_emails.append(raw_email)
 
         if remote_by_email:
             for normalized_email, (remote_email, remote_user) in remote_by_email.items():
@@ -420,8 +421,7 @@ async def sync_keys_with_panels():
                             pass
                     subscription_url = remnawave_api.extract_subscription_url(remote_user)
                     
-                    rw_repo.update_key_fields(
-                        key_id,
+                    key_patches.append((key_id, dict(
                         user_id=user_id,
                         email=remote_email,
                         remnawave_user_uuid=remote_uuid,
@@ -432,8 +432,7 @@ async def sync_keys_with_panels():
                         traffic_limit_strategy=remote_user.get('trafficLimitStrategy') or remote_user.get('traffic_limit_strategy'),
                         host_name=host_name, # Принудительно обновляем хост, если ключ "переехал"
                         squad_uuid=squad_uuid,
-                    )
-                    total_affected_records += 1
+                    )))
                     continue
 
                 # Если ключа нет — СОЗДАЕМ новый
@@ -465,6 +464,17 @@ async def sync_keys_with_panels():
                         host_name,
                     )
 
+        if key_patches or deleted_emails:
+            sync_result = rw_repo.bulk_update_keys(key_patches, deleted_emails)
+            total_affected_records += sync_result['updated'] + sync_result['deleted']
+            logger.info(
+                "Scheduler: Сквад '%s': обновлено ключей %s, удалено %s за %.1f мс.",
+                host_name,
+                sync_result['updated'],
+                sync_result['deleted'],
+                sync_result['elapsed_ms'],
+            )
+
     logger.debug(
         "Scheduler: Синхронизация с Remnawave API завершена. Затронуто записей: %s.",
         total_affected_records,
@@ -488,6 +498,8 @@ async def periodic_subscription_check(bot_controller: BotController):
 
             bot = bot_controller.get_bot_instance() if bot_controller.get_status().get("is_running") else None
             await _maybe_collect_resource_metrics(bot)
+            await _maybe_prune_resource_metrics()
+            await _maybe_run_db_maintenance()
 
             if bot_controller.get_status().get("is_running"):
                 bot = bot_controller.get_bot_instance()
@@ -662,6 +674,37 @@ async def _maybe_collect_resource_metrics(bot: Bot | None):
         logger.error("Scheduler: Ошибка сбора метрик ресурсов", exc_info=True)
 
 
+async def _maybe_prune_resource_metrics():
+    """Раз в час удаляет замеры и сводки метрик старше сроков monitoring_retention_*."""
+    global _last_metrics_prune_at
+    now = get_msk_time()
+    if _last_metrics_prune_at and (now - _last_metrics_prune_at).total_seconds() < METRICS_PRUNE_INTERVAL_SECONDS:
+        return
+    try:
+        await asyncio.to_thread(rw_repo.prune_resource_metrics)
+        _last_metrics_prune_at = now
+    except Exception as e:
+        logger.error(f"Scheduler: Ошибка очистки метрик: {e}", exc_info=True)
+
+
+async def _maybe_run_db_maintenance():
+    """Раз в сутки в час db_maintenance_hour (МСК, по умолчанию 4; -1 — отключено) обслуживает SQLite
+    в пределах db_maintenance_budget_sec секунд."""
+    global _last_db_maintenance_date
+    now = get_msk_time()
+    try:
+        hour = int(str(rw_repo.get_setting("db_maintenance_hour") or "4").strip())
+    except (TypeError, ValueError):
+        hour = 4
+    if hour < 0 or now.hour != hour or _last_db_maintenance_date == now.date():
+        return
+    _last_db_maintenance_date = now.date()
+    try:
+        await asyncio.to_thread(rw_repo.run_db_maintenance)
+    except Exception as e:
+        logger.error(f"Scheduler: Ошибка обслуживания БД: {e}", exc_info=True)
+
+
 async def _maybe_run_daily_backup(bot: Bot):
     """Автобэкап базы и отправка админам. Интервал задаётся в настройках backup_interval_days и backup_interval_unit."""
     global _last_backup_run_at
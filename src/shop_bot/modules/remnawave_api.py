@@ -1,8 +1,14 @@
+import copy
 import json
 import logging
+import os
+import random
+import threading
 import time
 from datetime import datetime, timezone, timedelta
-from typing import Any
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
 from urllib.parse import quote
 import re
 import httpx
@@ -22,6 +28,14 @@ class RemnawaveAPIError(RuntimeError):
     """Base error for Remnawave API interactions."""
 
 
+class RemnawavePanelUnavailable(RemnawaveAPIError):
+    """Panel is switched off by the circuit breaker; the request was not sent."""
+
+    def __init__(self, label: str, retry_in: float):
+        self.retry_in = retry_in
+        super().__init__(f"Remnawave panel{label} is unavailable, retry in {retry_in:.0f}s")
+
+
 def get_msk_time() -> datetime:
     return datetime.now(timezone(timedelta(hours=3)))
 
@@ -138,68 +152,303 @@ def _build_headers(config: dict[str, Any]) -> dict[str, str]:
     return headers
 
 
-async def _request(
+# ===== ПУЛ HTTP-КЛИЕНТОВ =====
+# Один httpx.AsyncClient на базовый URL панели с keep-alive: повторные вызовы не платят за TCP/TLS handshake.
+# Клиент привязан к event loop, в котором создан (веб-панель выполняет корутины через asyncio.run),
+# поэтому пул хранится отдельно для каждого loop; пулы закрытых loop отбрасываются при следующем обращении.
+# Настройки: REMNAWAVE_HTTP_MAX_CONNECTIONS, REMNAWAVE_HTTP_MAX_KEEPALIVE, REMNAWAVE_HTTP_KEEPALIVE_EXPIRY,
+# REMNAWAVE_HTTP_TIMEOUT и REMNAWAVE_HTTP2=1 (нужен пакет h2, без него — HTTP/1.1).
+_HTTP_TIMEOUT = float(os.environ.get("REMNAWAVE_HTTP_TIMEOUT", "30") or 30)
+_HTTP_LIMITS = httpx.Limits(
+    max_connections=int(os.environ.get("REMNAWAVE_HTTP_MAX_CONNECTIONS", "20") or 20),
+    max_keepalive_connections=int(os.environ.get("REMNAWAVE_HTTP_MAX_KEEPALIVE", "10") or 10),
+    keepalive_expiry=float(os.environ.get("REMNAWAVE_HTTP_KEEPALIVE_EXPIRY", "60") or 60),
+)
+_HTTP2_REQUESTED = os.environ.get("REMNAWAVE_HTTP2", "").strip() == "1"
+_clients: dict[asyncio.AbstractEventLoop, dict[str, httpx.AsyncClient]] = {}
+_clients_lock = threading.Lock()
+
+
+def _http2_available() -> bool:
+    if not _HTTP2_REQUESTED:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logger.warning("Remnawave: REMNAWAVE_HTTP2=1, но пакет h2 не установлен — используется HTTP/1.1")
+        return False
+
+
+def _get_client(config: dict[str, Any]) -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        for closed_loop in [item for item in _clients if item is not loop and item.is_closed()]:
+            # Закрыть клиент в завершённом loop уже нельзя — сокеты освободит сборщик мусора
+            _clients.pop(closed_loop, None)
+        loop_clients = _clients.setdefault(loop, {})
+        client = loop_clients.get(config["base_url"])
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                cookies=config["cookies"],
+                timeout=_HTTP_TIMEOUT,
+                limits=_HTTP_LIMITS,
+                http2=_http2_available(),
+            )
+            loop_clients[config["base_url"]] = client
+        return client
+
+
+async def close_http_clients() -> None:
+    """Закрывает пул клиентов текущего event loop (вызывается при остановке приложения)."""
+    with _clients_lock:
+        loop_clients = _clients.pop(asyncio.get_running_loop(), {})
+    for client in loop_clients.values():
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning("Remnawave: ошибка закрытия HTTP-клиента: %s", e)
+
+
+# ===== ПРЕДОХРАНИТЕЛЬ ПАНЕЛЕЙ =====
+# Circuit breaker на каждую панель (base_url). После REMNAWAVE_BREAKER_FAILURES неудачных попыток подряд
+# (ошибка соединения, таймаут, 429/502/503/504) панель считается недоступной: запросы к ней сразу
+# завершаются RemnawavePanelUnavailable, а покупки, страницы и синхронизация не ждут таймаутов.
+# Через REMNAWAVE_BREAKER_OPEN_SECONDS (или Retry-After панели) пропускается один пробный запрос:
+# успех закрывает предохранитель, неудача открывает снова с удвоенной паузой (до REMNAWAVE_BREAKER_MAX_OPEN_SECONDS).
+# Повторы внутри запроса — экспоненциальная пауза с джиттером от REMNAWAVE_RETRY_BASE_DELAY до
+# REMNAWAVE_RETRY_MAX_DELAY; Retry-After длиннее этой паузы не ждём, а открываем предохранитель.
+_BREAKER_FAILURES = int(os.environ.get("REMNAWAVE_BREAKER_FAILURES", "5") or 5)
+_BREAKER_OPEN_SECONDS = float(os.environ.get("REMNAWAVE_BREAKER_OPEN_SECONDS", "30") or 30)
+_BREAKER_MAX_OPEN_SECONDS = float(os.environ.get("REMNAWAVE_BREAKER_MAX_OPEN_SECONDS", "300") or 300)
+_RETRY_ATTEMPTS = int(os.environ.get("REMNAWAVE_RETRY_ATTEMPTS", "3") or 3)
+_RETRY_BASE_DELAY = float(os.environ.get("REMNAWAVE_RETRY_BASE_DELAY", "0.5") or 0.5)
+_RETRY_MAX_DELAY = float(os.environ.get("REMNAWAVE_RETRY_MAX_DELAY", "8") or 8)
+_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+# Без этих кодов панель запрос не обрабатывала — его можно повторить даже для POST/PATCH
+_REJECTED_STATUSES = frozenset({429, 503})
+_IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+
+class _CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.failures = 0
+        self.open_seconds = _BREAKER_OPEN_SECONDS
+        self.opened_until = 0.0
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float | None:
+        """None — запрос можно отправлять, иначе сколько секунд панель ещё считается недоступной."""
+        with self.lock:
+            if self.state == "closed":
+                return None
+            now = time.monotonic()
+            if self.state == "open":
+                if now < self.opened_until:
+                    return self.opened_until - now
+                self.state = "half_open"
+                self.probe_in_flight = False
+                logger.info("Remnawave%s: предохранитель полуоткрыт, пробный запрос", self.name)
+            if self.probe_in_flight:
+                return _RETRY_BASE_DELAY
+            self.probe_in_flight = True
+            return None
+
+    def retry_in(self) -> float | None:
+        with self.lock:
+            if self.state == "closed":
+                return None
+            if self.state == "open":
+                wait = self.opened_until - time.monotonic()
+                return wait if wait > 0 else None
+            return _RETRY_BASE_DELAY if self.probe_in_flight else None
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.state != "closed":
+                logger.info("Remnawave%s: панель снова отвечает, предохранитель закрыт", self.name)
+            self.state = "closed"
+            self.failures = 0
+            self.open_seconds = _BREAKER_OPEN_SECONDS
+            self.probe_in_flight = False
+
+    def record_failure(self, retry_after: float | None = None) -> None:
+        with self.lock:
+            self.probe_in_flight = False
+            if self.state == "half_open":
+                self.open_seconds = min(self.open_seconds * 2, _BREAKER_MAX_OPEN_SECONDS)
+            else:
+                self.failures += 1
+                if self.failures < _BREAKER_FAILURES and (retry_after or 0) <= _RETRY_MAX_DELAY:
+                    return
+            wait = max(self.open_seconds, retry_after or 0)
+            self.state = "open"
+            self.opened_until = time.monotonic() + wait
+            logger.warning(
+                "Remnawave%s: панель недоступна (%d ошибок подряд), запросы отклоняются %.0f с",
+                self.name, self.failures, wait,
+            )
+
+    def release(self) -> None:
+        """Пробный запрос прерван без ответа (отмена задачи) — следующий запрос станет новой пробой."""
+        with self.lock:
+            self.probe_in_flight = False
+
+
+_breakers: dict[str, _CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def _breaker_for(config: dict[str, Any], label: str) -> _CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(config["base_url"])
+        if breaker is None:
+            breaker = _breakers[config["base_url"]] = _CircuitBreaker(label)
+        return breaker
+
+
+def _retry_after_seconds(response: httpx.Response) -> float | None:
+    value = (response.headers.get("Retry-After") or "").strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff_delay(attempt: int) -> float:
+    ceiling = min(_RETRY_MAX_DELAY, _RETRY_BASE_DELAY * (2 ** attempt))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def _format_wait(seconds: float) -> str:
+    seconds = max(1, int(seconds + 0.999))
+    return f"{seconds} с" if seconds < 60 else f"{(seconds + 59) // 60} мин"
+
+
+def host_unavailable_message(host_name: str | None) -> str | None:
+    """Текст для пользователя, если панель хоста сейчас отключена предохранителем, иначе None."""
+    try:
+        config = _load_config_for_host(host_name) if host_name else _load_config()
+    except RemnawaveAPIError:
+        return None
+    breaker = _breakers.get(config["base_url"])
+    retry_in = breaker.retry_in() if breaker else None
+    if retry_in is None:
+        return None
+    server = f"Сервер «{host_name}»" if host_name else "Сервер"
+    return f"{server} временно недоступен. Попробуйте ещё раз через {_format_wait(retry_in)}."
+
+
+def get_breaker_states() -> list[dict[str, Any]]:
+    with _breakers_lock:
+        breakers = list(_breakers.items())
+    states = []
+    for base_url, breaker in breakers:
+        with breaker.lock:
+            states.append({"base_url": base_url, "name": breaker.name, "state": breaker.state, "failures": breaker.failures})
+    return states
+# ==================================
+
+
+async def _send(
+    config: dict[str, Any],
     method: str,
     path: str,
     *,
     json_payload: dict[str, Any] | None = None,
     params: dict[str, Any] | None = None,
     expected_status: tuple[int, ...] = (200,),
+    label: str = "",
 ) -> httpx.Response:
-
-    config = _load_config()
     url = f"{config['base_url']}{path}"
     headers = _build_headers(config)
+    client = _get_client(config)
+    breaker = _breaker_for(config, label)
+    idempotent = method.upper() in _IDEMPOTENT_METHODS
+
+    max_retries = max(1, _RETRY_ATTEMPTS)
+    last_exception = None
+    response = None
+    for attempt in range(max_retries):
+        wait = breaker.acquire()
+        if wait is not None:
+            logger.warning("Remnawave%s: панель недоступна, %s %s отклонён без запроса (ещё %.0f с)", label, method.upper(), path, wait)
+            raise RemnawavePanelUnavailable(label, wait)
+        try:
+            full_url = httpx.URL(url).copy_merge_params(params or {})
+            if attempt == 0:
+                logger.info("➡️ Remnawave%s: %s %s", label, method.upper(), str(full_url))
+            else:
+                logger.info("➡️ Remnawave%s (Attempt %d/%d): %s %s", label, attempt + 1, max_retries, method.upper(), str(full_url))
+        except Exception:
+            pass
 
-    async with httpx.AsyncClient(cookies=config["cookies"], timeout=30.0) as client:
-        max_retries = 3
-        last_exception = None
-        for attempt in range(max_retries):
+        t0 = time.perf_counter()
+        retry_after = None
+        try:
+            response = await client.request(
+                method=method,
+                url=url,
+                headers=headers,
+                json=json_payload,
+                params=params,
+            )
+            dt_ms = int((time.perf_counter() - t0) * 1000)
             try:
-                full_url = httpx.URL(url).copy_merge_params(params or {})
-                if attempt == 0:
-                    logger.info("➡️ Remnawave: %s %s", method.upper(), str(full_url))
-                else:
-                    logger.info("➡️ Remnawave (Attempt %d/%d): %s %s", attempt + 1, max_retries, method.upper(), str(full_url))
+                status = response.status_code
+                ok = "OK" if status in expected_status else "ERROR"
+                logger.info("⬅️ Remnawave%s: %s %s — %s (%d мс)", label, method.upper(), path, f"{status} {ok}", dt_ms)
             except Exception:
                 pass
-            
-            t0 = time.perf_counter()
-            try:
-                response = await client.request(
-                    method=method,
-                    url=url,
-                    headers=headers,
-                    json=json_payload,
-                    params=params,
-                )
-                dt_ms = int((time.perf_counter() - t0) * 1000)
-                try:
-                    status = response.status_code
-                    ok = "OK" if status in expected_status else "ERROR"
-                    logger.info("⬅️ Remnawave: %s %s — %s (%d мс)", method.upper(), path, f"{status} {ok}", dt_ms)
-                except Exception:
-                    pass
 
-                # Успешный запрос или серверный ответ, выходим из цикла retry
+            if response.status_code in expected_status or response.status_code not in _RETRY_STATUSES:
+                # Панель ответила по существу (в том числе ошибкой 4xx/500) — она доступна
+                breaker.record_success()
+                break
+            retry_after = _retry_after_seconds(response)
+            breaker.record_failure(retry_after)
+            last_exception = RemnawaveAPIError(f"HTTP {response.status_code}")
+            if not idempotent and response.status_code not in _REJECTED_STATUSES:
                 break
-                
-            except httpx.ConnectError as e:
-                last_exception = e
-                logger.warning("Remnawave: ошибка соединения %s. Попытка %d из %d...", e, attempt + 1, max_retries)
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2) # Пауза перед следующей попыткой
-                continue
-            except httpx.TimeoutException as e:
-                last_exception = e
-                logger.warning("Remnawave: таймаут %s. Попытка %d из %d...", e, attempt + 1, max_retries)
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2)
-                continue
 
-        if last_exception and 'response' not in locals():
-            logger.error("Remnawave API: исчерпаны попытки подключения: %s", last_exception)
-            raise RemnawaveAPIError(f"Connection failed after {max_retries} attempts: {last_exception}")
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            # Запрос не ушёл в панель — повтор безопасен для любого метода
+            breaker.record_failure()
+            last_exception = e
+            logger.warning("Remnawave%s: ошибка соединения %s. Попытка %d из %d...", label, e, attempt + 1, max_retries)
+        except httpx.TransportError as e:
+            # Запрос мог дойти до панели: повторяем только идемпотентные методы
+            breaker.record_failure()
+            last_exception = e
+            if isinstance(e, httpx.TimeoutException):
+                logger.warning("Remnawave%s: таймаут %s. Попытка %d из %d...", label, type(e).__name__, attempt + 1, max_retries)
+            else:
+                logger.warning("Remnawave%s: %s %s. Попытка %d из %d...", label, type(e).__name__, e, attempt + 1, max_retries)
+            if not idempotent:
+                raise RemnawaveAPIError(f"Request failed without retry ({method.upper()} is not idempotent): {e}") from e
+        except BaseException:
+            breaker.release()
+            raise
+
+        if attempt < max_retries - 1:
+            if retry_after is not None and retry_after > _RETRY_MAX_DELAY:
+                # Панель просит подождать дольше, чем разумно держать пользователя — предохранитель уже открыт
+                raise RemnawavePanelUnavailable(label, retry_after)
+            delay = retry_after if retry_after is not None else _backoff_delay(attempt)
+            await asyncio.sleep(delay)
+            response = None
+
+    if response is None:
+        reason = str(last_exception) or type(last_exception).__name__
+        logger.error("Remnawave%s API: исчерпаны попытки подключения: %s", label, reason)
+        raise RemnawaveAPIError(f"Connection failed after {max_retries} attempts: {reason}")
 
     if response.status_code not in expected_status:
         try:
@@ -210,6 +459,21 @@ async def _request(
         raise RemnawaveAPIError(f"Remnawave API request failed: {response.status_code} {detail}")
 
     return response
+# =============================
+
+
+async def _request(
+    method: str,
+    path: str,
+    *,
+    json_payload: dict[str, Any] | None = None,
+    params: dict[str, Any] | None = None,
+    expected_status: tuple[int, ...] = (200,),
+) -> httpx.Response:
+    return await _send(
+        _load_config(), method, path,
+        json_payload=json_payload, params=params, expected_status=expected_status,
+    )
 
 
 async def _request_for_host(
@@ -221,68 +485,117 @@ async def _request_for_host(
     params: dict[str, Any] | None = None,
     expected_status: tuple[int, ...] = (200,),
 ) -> httpx.Response:
-    config = _load_config_for_host(host_name)
-    url = f"{config['base_url']}{path}"
-    headers = _build_headers(config)
+    return await _send(
+        _load_config_for_host(host_name), method, path,
+        json_payload=json_payload, params=params, expected_status=expected_status, label=f"[{host_name}]",
+    )
 
-    async with httpx.AsyncClient(cookies=config["cookies"], timeout=30.0) as client:
-        max_retries = 3
-        last_exception = None
-        for attempt in range(max_retries):
-            try:
-                full_url = httpx.URL(url).copy_merge_params(params or {})
-                if attempt == 0:
-                    logger.info("➡️ Remnawave[%s]: %s %s", host_name, method.upper(), str(full_url))
-                else:
-                    logger.info("➡️ Remnawave[%s] (Attempt %d/%d): %s %s", host_name, attempt + 1, max_retries, method.upper(), str(full_url))
-            except Exception:
-                pass
-            
-            t0 = time.perf_counter()
-            try:
-                response = await client.request(
-                    method=method,
-                    url=url,
-                    headers=headers,
-                    json=json_payload,
-                    params=params,
-                )
-                dt_ms = int((time.perf_counter() - t0) * 1000)
-                try:
-                    status = response.status_code
-                    ok = "OK" if status in expected_status else "ERROR"
-                    logger.info("⬅️ Remnawave[%s]: %s %s — %s (%d мс)", host_name, method.upper(), path, f"{status} {ok}", dt_ms)
-                except Exception:
-                    pass
 
-                break
-                
-            except httpx.ConnectError as e:
-                last_exception = e
-                logger.warning("Remnawave[%s]: ошибка соединения %s. Попытка %d из %d...", host_name, e, attempt + 1, max_retries)
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2)
-                continue
-            except httpx.TimeoutException as e:
-                last_exception = e
-                logger.warning("Remnawave[%s]: таймаут %s. Попытка %d из %d...", host_name, e, attempt + 1, max_retries)
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2)
-                continue
+# ===== КЭШ ЧТЕНИЙ =====
+# Один и тот же пользователь читается много раз за секунды (перезагрузки веб-приложения, «мои ключи», QR,
+# устройства). Одинаковые одновременные запросы объединяются в один (singleflight), результат живёт
+# REMNAWAVE_CACHE_TTL секунд в LRU на REMNAWAVE_CACHE_MAX_ENTRIES записей (0 — кэш выключен).
+# Наши записи в панель сбрасывают записи пользователя, а пути записи читают панель в обход кэша.
+_CACHE_TTL = float(os.environ.get("REMNAWAVE_CACHE_TTL", "15") or 0)
+_CACHE_MAX_ENTRIES = int(os.environ.get("REMNAWAVE_CACHE_MAX_ENTRIES", "2048") or 0)
+_read_cache: "OrderedDict[tuple[str, str, str], tuple[float, Any]]" = OrderedDict()
+_inflight: dict[tuple[asyncio.AbstractEventLoop, tuple[str, str, str]], asyncio.Future] = {}
+_cache_lock = threading.Lock()
+_cache_generation = 0
+_cache_stats = {"hits": 0, "misses": 0, "coalesced": 0, "invalidated": 0}
+
+
+async def _cached(kind: str, host_name: str | None, ident: Any, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    if _CACHE_TTL <= 0 or _CACHE_MAX_ENTRIES <= 0:
+        return await fetch()
+    key = (kind, host_name or "", str(ident).strip())
+    loop = asyncio.get_running_loop()
+    with _cache_lock:
+        entry = _read_cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            _read_cache.move_to_end(key)
+            _cache_stats["hits"] += 1
+            return copy.deepcopy(entry[1])
+        # Future привязан к loop, поэтому объединяются только запросы одного event loop
+        flight = _inflight.get((loop, key))
+        leader = flight is None
+        if leader:
+            _cache_stats["misses"] += 1
+            flight = loop.create_future()
+            _inflight[(loop, key)] = flight
+            generation = _cache_generation
+        else:
+            _cache_stats["coalesced"] += 1
 
-        if last_exception and 'response' not in locals():
-            logger.error("Remnawave[%s] API: исчерпаны попытки подключения: %s", host_name, last_exception)
-            raise RemnawaveAPIError(f"Connection failed after {max_retries} attempts: {last_exception}")
+    if not leader:
+        return copy.deepcopy(await asyncio.shield(flight))
 
-    if response.status_code not in expected_status:
-        try:
-            detail = response.json()
-        except json.JSONDecodeError:
-            detail = response.text
-        logger.warning("Remnawave API %s %s завершился ошибкой: %s", method, path, detail)
-        raise RemnawaveAPIError(f"Remnawave API request failed: {response.status_code} {detail}")
+    try:
+        value = await fetch()
+    except BaseException as e:
+        with _cache_lock:
+            if _inflight.get((loop, key)) is flight:
+                del _inflight[(loop, key)]
+        if isinstance(e, asyncio.CancelledError):
+            flight.cancel()
+        else:
+            flight.set_exception(e)
+            flight.exception()  # ожидающих может не быть — не даём asyncio ругаться на неполученную ошибку
+        raise
+
+    with _cache_lock:
+        if _inflight.get((loop, key)) is flight:
+            del _inflight[(loop, key)]
+        # Запись в панель во время запроса делает ответ устаревшим — такой результат не кэшируем
+        if generation == _cache_generation:
+            _read_cache[key] = (time.monotonic() + _CACHE_TTL, value)
+            _read_cache.move_to_end(key)
+            while len(_read_cache) > _CACHE_MAX_ENTRIES:
+                _read_cache.popitem(last=False)
+    flight.set_result(value)
+    return copy.deepcopy(value)
+
+
+def _invalidate_user_cache(host_name: str | None, *idents: Any) -> None:
+    """Сбрасывает кэш по email / ID пользователя; без host_name — на всех хостах."""
+    global _cache_generation
+    targets = {str(ident).strip() for ident in idents if ident not in (None, "")}
+    if not targets:
+        return
+
+    def matches(key: tuple[str, str, str]) -> bool:
+        return key[2] in targets and (not host_name or key[1] in (host_name, ""))
+
+    with _cache_lock:
+        _cache_generation += 1
+        stale = [key for key in _read_cache if matches(key)]
+        for key in stale:
+            del _read_cache[key]
+        _cache_stats["invalidated"] += len(stale)
+        for flight_key in [flight_key for flight_key in _inflight if matches(flight_key[1])]:
+            del _inflight[flight_key]
+
+
+def get_cache_stats() -> dict[str, Any]:
+    with _cache_lock:
+        stats = dict(_cache_stats)
+        size = len(_read_cache)
+    lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+    stats.update(
+        size=size,
+        max_entries=_CACHE_MAX_ENTRIES,
+        ttl_seconds=_CACHE_TTL,
+        lookups=lookups,
+        hit_rate=round((stats["hits"] + stats["coalesced"]) * 100 / lookups, 1) if lookups else 0.0,
+    )
+    return stats
 
-    return response
+
+def reset_cache_stats() -> None:
+    with _cache_lock:
+        for name in _cache_stats:
+            _cache_stats[name] = 0
+# ======================
 
 
 def _to_iso(dt: datetime) -> str:
@@ -292,9 +605,15 @@ def _to_iso(dt: datetime) -> str:
     return dt_utc.isoformat().replace("+00:00", "Z")
 
 
-async def get_user_by_email(email: str, *, host_name: str | None = None) -> dict[str, Any] | None:
+async def get_user_by_email(email: str, *, host_name: str | None = None, use_cache: bool = True) -> dict[str, Any] | None:
     if not email:
         return None
+    if not use_cache:
+        return await _fetch_user_by_email(email, host_name)
+    return await _cached("email", host_name, email, lambda: _fetch_user_by_email(email, host_name))
+
+
+async def _fetch_user_by_email(email: str, host_name: str | None) -> dict[str, Any] | None:
     params = {"email": email.strip(), "size": 1}
     if host_name:
         response = await _request_for_host(host_name, "GET", "/api/users/stream", params=params)
@@ -352,6 +671,10 @@ async def get_user_by_id(user_id: int | str, *, host_name: str | None = None) ->
     resolved_id = await _resolve_user_id(user_id, host_name=host_name)
     if resolved_id is None:
         return None
+    return await _cached("user", host_name, resolved_id, lambda: _fetch_user_by_id(resolved_id, host_name))
+
+
+async def _fetch_user_by_id(resolved_id: int, host_name: str | None) -> dict[str, Any] | None:
     encoded_user_id = quote(str(resolved_id))
     if host_name:
         response = await _request_for_host(host_name, "GET", f"/api/users/{encoded_user_id}", expected_status=(200, 404))
@@ -371,6 +694,10 @@ async def get_connected_devices_count(user_id: int | str, *, host_name: str | No
     resolved_id = await _resolve_user_id(user_id, host_name=host_name)
     if resolved_id is None:
         return None
+    return await _cached("devices", host_name, resolved_id, lambda: _fetch_hwid_devices(resolved_id, host_name))
+
+
+async def _fetch_hwid_devices(resolved_id: int, host_name: str | None) -> dict[str, Any] | None:
     encoded_user_id = quote(str(resolved_id))
     path = f"/api/hwid/devices/{encoded_user_id}"
     
@@ -385,7 +712,7 @@ async def get_connected_devices_count(user_id: int | str, *, host_name: str | No
     payload = response.json()
     if isinstance(payload, dict):
         # API returns: {"response": {"total": 2, "devices": [...]}}
-        return payload.get("response")
+        return payload.get("response") if isinstance(payload.get("response"), dict) else payload
     return None
 
 
@@ -393,6 +720,10 @@ async def get_subscription_info(user_id: int | str, *, host_name: str | None = N
     resolved_id = await _resolve_user_id(user_id, host_name=host_name)
     if resolved_id is None:
         return None
+    return await _cached("subscription", host_name, resolved_id, lambda: _fetch_subscription_info(resolved_id, host_name))
+
+
+async def _fetch_subscription_info(resolved_id: int, host_name: str | None) -> dict[str, Any] | None:
     encoded_user_id = quote(str(resolved_id))
     path = f"/api/subscriptions/by-id/{encoded_user_id}"
     
@@ -442,7 +773,7 @@ async def ensure_user(
     effective_hwid_limit = hwid_limit
 
     email = _normalize_email_for_remnawave(email, telegram_id=telegram_id)
-    current = await get_user_by_email(email, host_name=host_name)
+    current = await get_user_by_email(email, host_name=host_name, use_cache=False)
     expire_iso = _to_iso(expire_at)
     traffic_limit_strategy = traffic_limit_strategy or "NO_RESET"
 
@@ -548,7 +879,11 @@ async def ensure_user(
         method = "POST"
         path = "/api/users"
 
-    response = await _request_for_host(host_name, method, path, json_payload=payload, expected_status=(200, 201))
+    try:
+        response = await _request_for_host(host_name, method, path, json_payload=payload, expected_status=(200, 201))
+    finally:
+        # Даже при ошибке запрос мог дойти до панели — закэшированные данные больше не верны
+        _invalidate_user_cache(host_name, email, (current or {}).get("id"))
     data = response.json() or {}
     result = data.get("response") if isinstance(data, dict) else None
     if not result:
@@ -569,41 +904,91 @@ async def ensure_user(
 
 
 
-async def list_users(host_name: str, squad_uuid: str | None = None, size: int | None = 1000) -> list[dict[str, Any]]:
-    all_users = []
-    page = 0
+_LIST_CONCURRENCY = int(os.environ.get("REMNAWAVE_LIST_CONCURRENCY", "4") or 4)
+
+
+def _parse_users_page(response: httpx.Response) -> tuple[list[dict[str, Any]], int | None]:
+    payload = response.json() or {}
+    raw_users: Any = []
+    total = None
+    if isinstance(payload, dict):
+        body = payload.get("response") if isinstance(payload.get("response"), dict) else payload
+        raw_users = body.get("users") or body.get("data") or []
+        total = body.get("total")
+    if not isinstance(raw_users, list):
+        raw_users = []
+    try:
+        total = int(total) if total is not None else None
+    except (TypeError, ValueError):
+        total = None
+    return raw_users, total
+
+
+async def list_users(
+    host_name: str,
+    squad_uuid: str | None = None,
+    size: int | None = 1000,
+    *,
+    concurrency: int | None = None,
+) -> list[dict[str, Any]]:
+    """Все пользователи хоста (при squad_uuid — только этого сквада).
+
+    Первая страница сообщает total, остальные запрашиваются параллельно окном в REMNAWAVE_LIST_CONCURRENCY
+    запросов; после них страницы дочитываются по одной, пока последняя полная (пользователей могли добавить
+    во время чтения или панель не вернула total). Фильтр squadUuid отдаётся панели; ответ дополнительно фильтруется на случай, если панель
+    его не поддерживает. Ошибка любой страницы прерывает весь список: синхронизация удаляет локальные ключи,
+    которых нет в ответе, поэтому неполный список опаснее отсутствующего.
+    """
     actual_size = size or 100
-    
-    while True:
+    window = max(1, concurrency or _LIST_CONCURRENCY)
+    started = time.perf_counter()
+
+    async def fetch_page(page: int) -> tuple[list[dict[str, Any]], int | None]:
         params: dict[str, Any] = {"page": page, "size": actual_size}
         if squad_uuid:
             params["squadUuid"] = squad_uuid
-            
+        response = await _request_for_host(host_name, "GET", "/api/users", params=params, expected_status=(200,))
+        return _parse_users_page(response)
+
+    first_page, total = await fetch_page(0)
+    pages = [first_page]
+    if total is not None and len(first_page) >= actual_size:
+        semaphore = asyncio.Semaphore(window)
+
+        async def fetch_bounded(page: int) -> list[dict[str, Any]]:
+            async with semaphore:
+                return (await fetch_page(page))[0]
+
+        tasks = [asyncio.ensure_future(fetch_bounded(page)) for page in range(1, -(-total // actual_size))]
         try:
-            response = await _request_for_host(host_name, "GET", "/api/users", params=params, expected_status=(200,))
-        except Exception:
-            if page == 0:
-                raise
-            break
-            
-        payload = response.json() or {}
-        raw_users = []
-        if isinstance(payload, dict):
-            body = payload.get("response") if isinstance(payload.get("response"), dict) else payload
-            raw_users = body.get("users") or body.get("data") or []
-            
-        if not isinstance(raw_users, list):
-            raw_users = []
-            
-        if not raw_users:
-            break
-            
-        all_users.extend(raw_users)
-        
-        if len(raw_users) < actual_size:
-            break
-            
-        page += 1
+            pages.extend(await asyncio.gather(*tasks))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+    # Полная последняя страница значит, что пользователи могут быть и дальше: total мог вырасти за время чтения.
+    # Без дочитывания новые пользователи пропали бы из списка, а синхронизация удалила бы их ключи
+    while len(pages[-1]) >= actual_size:
+        users, _ = await fetch_page(len(pages))
+        pages.append(users)
+
+    all_users: list[dict[str, Any]] = []
+    seen: set[str] = set()
+    for page_users in pages:
+        for user in page_users:
+            if not isinstance(user, dict):
+                continue
+            # Пока страницы читаются, пользователи могут сдвинуться между ними — убираем повторы
+            user_key = str(user.get("uuid") or user.get("id") or "")
+            if user_key:
+                if user_key in seen:
+                    continue
+                seen.add(user_key)
+            all_users.append(user)
+    logger.info(
+        "Remnawave[%s]: получено %d пользователей (%d стр. по %d, окно %d) за %.2f с",
+        host_name, len(all_users), len(pages), actual_size, window, time.perf_counter() - started,
+    )
 
     if squad_uuid:
         filtered: list[dict[str, Any]] = []
@@ -631,6 +1016,7 @@ async def delete_user(user_id: int | str) -> bool:
         return False
     encoded_user_id = quote(str(user_id))
     response = await _request("DELETE", f"/api/users/{encoded_user_id}", expected_status=(204, 404))
+    _invalidate_user_cache(None, user_id)
     if response.status_code == 404:
         logger.info("Remnawave: пользователь %s не найден при удалении (возможно, уже удалён)", user_id)
     elif response.status_code == 204:
@@ -644,6 +1030,7 @@ async def delete_user_on_host(host_name: str, user_id: int | str) -> bool:
         return False
     encoded_user_id = quote(str(user_id))
     response = await _request_for_host(host_name, "DELETE", f"/api/users/{encoded_user_id}", expected_status=(204, 404))
+    _invalidate_user_cache(host_name, user_id)
     if response.status_code == 404:
         logger.info("Remnawave[%s]: пользователь %s не найден при удалении (возможно, уже удалён)", host_name, user_id)
     elif response.status_code == 204:
@@ -656,6 +1043,7 @@ async def reset_user_traffic(user_id: int | str) -> bool:
         return False
     encoded_user_id = quote(str(user_id))
     await _request("POST", f"/api/users/{encoded_user_id}/actions/reset-traffic")
+    _invalidate_user_cache(None, user_id)
     return True
 
 
@@ -665,6 +1053,7 @@ async def set_user_status(user_id: int | str, active: bool) -> bool:
     encoded_user_id = quote(str(user_id))
     action = "enable" if active else "disable"
     await _request("POST", f"/api/users/{encoded_user_id}/actions/{action}")
+    _invalidate_user_cache(None, user_id)
     return True
 
 
@@ -741,7 +1130,7 @@ async def create_or_update_key_on_host(
                 days = 1
             
             
-            current_user = await get_user_by_email(email, host_name=host_name)
+            current_user = await get_user_by_email(email, host_name=host_name, use_cache=False)
             
             # Локальные данные как fallback для надежности
             local_key = rw_repo.get_key_by_email(email)
@@ -870,14 +1259,14 @@ async def delete_client_on_host(host_name: str, client_email: str) -> bool:
              pass
              
         # Сначала ищем как есть (вдруг в базе уже нормальный, или API научился принимать)
-        user_payload = await get_user_by_email(client_email, host_name=host_name)
+        user_payload = await get_user_by_email(client_email, host_name=host_name, use_cache=False)
         
         # Если не нашли, пробуем нормализованную версию (актуально для кейса .__. -> u____)
         if not user_payload:
              try:
                  norm_email = _normalize_email_for_remnawave(client_email)
                  if norm_email != client_email:
-                     user_payload = await get_user_by_email(norm_email, host_name=host_name)
+                     user_payload = await get_user_by_email(norm_email, host_name=host_name, use_cache=False)
              except Exception:
                  pass
 
@@ -893,6 +1282,7 @@ async def delete_client_on_host(host_name: str, client_email: str) -> bool:
             return False
         logger.info("Remnawave: удаляю пользователя %s (%s) на '%s'...", client_email, user_id, host_name)
         await delete_user_on_host(host_name, user_id)
+        _invalidate_user_cache(host_name, client_email, user_payload.get('email'))
         logger.info("Remnawave: пользователь %s (%s) успешно удалён на '%s'", client_email, user_id, host_name)
         return True
     except RemnawaveAPIError as exc:
@@ -909,16 +1299,7 @@ async def get_user_devices(user_id: int | str, host_name: str | None = None) ->
         return []
         
     try:
-        if host_name:
-            response = await _request_for_host(host_name, "GET", f"/api/hwid/devices/{quote(str(resolved_id))}", expected_status=(200, 404))
-        else:
-            response = await _request("GET", f"/api/hwid/devices/{quote(str(resolved_id))}", expected_status=(200, 404))
-
-        if response.status_code == 404:
-            return []
-
-        payload = response.json() or {}
-        data = payload.get("response") if isinstance(payload.get("response"), dict) else payload
+        data = await _cached("devices", host_name, resolved_id, lambda: _fetch_hwid_devices(resolved_id, host_name))
         devices = data.get("devices") if isinstance(data, dict) else []
         
         return devices if isinstance(devices, list) else []
@@ -943,10 +1324,13 @@ async def delete_user_device(user_id: int | str, hwid: str, host_name: str | Non
         
         path = "/api/hwid/devices/delete"
         
-        if host_name:
-            response = await _request_for_host(host_name, "POST", path, json_payload=payload, expected_status=(200, 204))
-        else:
-            response = await _request("POST", path, json_payload=payload, expected_status=(200, 204))
+        try:
+            if host_name:
+                response = await _request_for_host(host_name, "POST", path, json_payload=payload, expected_status=(200, 204))
+            else:
+                response = await _request("POST", path, json_payload=payload, expected_status=(200, 204))
+        finally:
+            _invalidate_user_cache(host_name, resolved_id)
             
         if response.status_code in (200, 201, 204):
             return True
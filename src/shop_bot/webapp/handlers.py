@@ -27,6 +27,7 @@ from shop_bot.data_manager.remnawave_repository import (
     update_key, get_key_by_email
 )
 import shop_bot.data_manager.remnawave_repository as rw_repo
+from shop_bot.data_manager import async_repository as arepo
 from shop_bot.data_manager.database import get_seller_user, get_device_tiers, get_host
 from shop_bot.modules import remnawave_api
 from shop_bot.config import get_purchase_success_text
@@ -1042,14 +1043,13 @@ def _render_banned_page(webapp_settings: dict):
 
 
 async def _render_main_page(user_id: int):
-    webapp_settings = get_webapp_settings()
+    webapp_settings, user = await asyncio.gather(arepo.get_webapp_settings(), arepo.get_user(user_id))
     
     # 1. Check if Webapp is enabled
     if not webapp_settings.get("webapp_enable"):
          return HTMLResponse(content="<h1>Webapp is disabled</h1>", status_code=403)
          
     # 2. Check if user is banned
-    user = get_user(user_id)
     if user and user.get('is_banned'):
          return _render_banned_page(webapp_settings)
          
@@ -1067,7 +1067,7 @@ async def _render_main_page(user_id: int):
     subscriptions = []
     
     if user_id:
-        keys = get_user_keys(user_id)
+        keys = await arepo.get_user_keys(user_id)
         # Sort all keys by expiry, soonest first
         try:
             keys.sort(key=lambda k: datetime.strptime(k['expiry_date'], "%Y-%m-%d %H:%M:%S"))
@@ -1287,8 +1287,7 @@ async def index(request: Request, user_id: int | None = None, token: str | None
             else:
                 return HTMLResponse(content="<h1>WebApp theme login.html not found</h1>", status_code=404)
 
-        webapp_settings = get_webapp_settings()
-        user = get_user(user_id)
+        webapp_settings, user = await asyncio.gather(arepo.get_webapp_settings(), arepo.get_user(user_id))
         if user and user.get('is_banned'):
             return _render_banned_page(webapp_settings)
 
@@ -2016,10 +2015,10 @@ async def api_create_payment(req: CreatePaymentRequest):
 
         # --- Balance ---
         elif method_id == "pay_balance":
-            if not deduct_from_balance(user_id, float(final_price)):
+            p_log_id = str(uuid.uuid4())
+            if not deduct_from_balance(user_id, float(final_price), "purchase", p_log_id):
                 return {"ok": False, "error": "Недостаточно средств"}
                 
-            p_log_id = str(uuid.uuid4())
             meta = {
                 "user_id": user_id, "months": months, "price": float(final_price),
                 "action": action_name, "key_id": req.key_id, "host_name": req.host_name,
@@ -2048,8 +2047,8 @@ async def api_create_payment(req: CreatePaymentRequest):
             if not success and not check_transaction_exists(p_log_id):
                 logger.info("Способ 2: Создаем ключ независимо от бота")
                 try:
-                    res = await process_successful_payment(None, meta)
-                    if res is True or check_transaction_exists(p_log_id):
+                    await process_successful_payment(None, meta)
+                    if check_transaction_exists(p_log_id):
                         success = True
                 except Exception as e:
                     logger.error(f"Способ 2 ошибка: {e}")
@@ -2059,6 +2058,9 @@ async def api_create_payment(req: CreatePaymentRequest):
                 
             if not success and not check_transaction_exists(p_log_id):
                 logger.error(f"[WEBAPP] - Критическая ошибка списания с баланса для {user_id}")
+                # Покупка не записана: списание возвращается на баланс (один раз, даже если бот уже вернул его сам)
+                if rw_repo.refund_payment(user_id, float(final_price), p_log_id):
+                    return {"ok": False, "error": "Ошибка обработки платежа. Средства возвращены на баланс."}
                 return {"ok": False, "error": "Ошибка обработки платежа"}
                 
             logger.info(f"[WEBAPP] - Успешная оплата с баланса: User={user_id}, Sum={final_price}")
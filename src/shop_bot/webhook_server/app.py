@@ -59,7 +59,7 @@ from shop_bot.data_manager.remnawave_repository import (
     get_closed_tickets_count, get_all_tickets_count, update_host_subscription_url,
     update_host_url, update_host_name, update_host_ssh_settings, get_latest_speedtest, get_speedtests,
     update_host_description, update_host_traffic_settings,
-    get_all_keys, get_keys_for_user, delete_key_by_id, update_key_comment,
+    get_keys_for_user, delete_key_by_id, update_key_comment,
     get_balance, adjust_user_balance, get_referrals_for_user, detach_referrals_from_user, log_transaction,
 
     get_users_paginated, get_keys_counts_for_users,
@@ -646,13 +646,13 @@ def create_webhook_app(bot_controller_instance):
 
         try:
             if not hide_payments:
-                from shop_bot.data_manager.database import get_dashboard_user_groups
-                groups = get_dashboard_user_groups()
-                stats["no_purchases_count"] = len(groups["no_purchases"])
-                stats["inactive_buyers_count"] = len(groups["inactive_buyers"])
-                stats["trials_count"] = len(groups["trials"])
-                stats["active_buyers_count"] = len(groups["active_buyers"])
-                stats["active_keys_count"] = len(groups["active_keys"])
+                from shop_bot.data_manager.database import get_dashboard_user_group_counts
+                counts = get_dashboard_user_group_counts()
+                stats["no_purchases_count"] = counts["no_purchases"]
+                stats["inactive_buyers_count"] = counts["inactive_buyers"]
+                stats["trials_count"] = counts["trials"]
+                stats["active_buyers_count"] = counts["active_buyers"]
+                stats["active_keys_count"] = counts["active_keys"]
             else:
                 stats["no_purchases_count"] = 0
                 stats["inactive_buyers_count"] = 0
@@ -675,14 +675,17 @@ def create_webhook_app(bot_controller_instance):
     def dashboard_transactions_partial():
         page = request.args.get('page', 1, type=int)
         per_page = 8
-        transactions, total_transactions = get_paginated_transactions(page=page, per_page=per_page)
+        transactions, total_transactions, next_cursor = get_paginated_transactions(
+            page=page, per_page=per_page, cursor=request.args.get('cursor')
+        )
         total_pages = ceil(total_transactions / per_page)
         
         if request.args.get('ajax_pagination') or request.args.get('lazy_load'):
             return jsonify({
                 "html": render_template('partials/dashboard_transactions.html', transactions=transactions),
                 "current_page": page,
-                "total_pages": total_pages
+                "total_pages": total_pages,
+                "next_cursor": next_cursor
             })
             
         return render_template('partials/dashboard_transactions.html', transactions=transactions)
@@ -749,8 +752,19 @@ def create_webhook_app(bot_controller_instance):
         except Exception:
             hosts = []
             ssh_targets = []
+        try:
+            db_stats = rw_repo.get_db_storage_stats()
+        except Exception as e:
+            logger.error(f"Error fetching DB storage stats: {e}")
+            db_stats = None
+        order_by = request.args.get('sql_order', 'total')
+        query_stats = rw_repo.get_query_stats(limit=15, order_by=order_by)
+        remnawave_cache = remnawave_api.get_cache_stats()
         common_data = get_common_template_data()
-        return render_template('monitor.html', hosts=hosts, ssh_targets=ssh_targets, **common_data)
+        return render_template(
+            'monitor.html', hosts=hosts, ssh_targets=ssh_targets, db_stats=db_stats,
+            query_stats=query_stats, sql_order=order_by, remnawave_cache=remnawave_cache, **common_data
+        )
 
     @flask_app.route('/monitor/local.json')
     @login_required
@@ -794,28 +808,27 @@ def create_webhook_app(bot_controller_instance):
         except Exception as e:
             return jsonify({"ok": False, "error": str(e)}), 500
 
+    @flask_app.route('/monitor/query-stats', methods=['POST'])
+    @login_required
+    def monitor_query_stats():
+        """Включение, выключение и сброс статистики SQL-запросов"""
+        action = request.form.get('action')
+        if action in ('enable', 'disable'):
+            update_setting('db_query_stats_enabled', 'true' if action == 'enable' else 'false')
+            rw_repo.reset_query_stats()
+            flash('Статистика SQL-запросов включена.' if action == 'enable' else 'Статистика SQL-запросов выключена.', 'success')
+        elif action == 'reset':
+            rw_repo.reset_query_stats()
+            flash('Статистика SQL-запросов сброшена.', 'success')
+        return redirect(url_for('monitor_page') + '#query-stats')
+
     @flask_app.route('/monitor/clear-metrics', methods=['POST'])
     @login_required
     def monitor_clear_metrics():
-        """Удаление всех старых замеров из resource_metrics и host_speedtests"""
+        """Удаление всех старых замеров из resource_metrics (вместе со сводками) и host_speedtests"""
         try:
-            from shop_bot.data_manager.database import DB_FILE
-            import sqlite3
-            
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            
-            cursor.execute("DELETE FROM resource_metrics")
-            deleted_metrics = cursor.rowcount
-            
-            cursor.execute("DELETE FROM host_speedtests")
-            deleted_speedtests = cursor.rowcount
-            
-            conn.commit()
-            
-            cursor.execute("VACUUM")
-            
-            conn.close()
+            rw_repo.flush_write_batches()
+            deleted_metrics, deleted_speedtests = rw_repo.clear_monitoring_data()
             
             logger.info(f"Cleared metrics: {deleted_metrics} resources, {deleted_speedtests} speedtests. VACUUM executed.")
             return jsonify({
@@ -835,8 +848,11 @@ def create_webhook_app(bot_controller_instance):
         page = request.args.get('page', 1, type=int)
         is_mobile = request.args.get('mobile') == '1'
         per_page = 12
-        tickets, total = get_tickets_paginated(page=page, per_page=per_page, status=status)
+        tickets, total, next_cursor = get_tickets_paginated(
+            page=page, per_page=per_page, status=status, cursor=request.args.get('cursor')
+        )
         total_pages = ceil(total / per_page) if per_page else 1
+        next_href = f"/support?status={status or ''}&page={page+1}" + (f"&cursor={next_cursor}" if next_cursor else "")
         
          
         if is_mobile:
@@ -887,7 +903,7 @@ def create_webhook_app(bot_controller_instance):
                     pagination_html += f'<a href="/support?status={status or ""}&page={page-1}" class="ajax-pagination w-10 h-10 rounded-full bg-white/5 border border-white/10 flex items-center justify-center text-white/40"><span class="material-symbols-outlined">chevron_left</span></a>'
                 pagination_html += f'<span class="text-sm font-black text-white">{page} / {total_pages}</span>'
                 if page < total_pages:
-                    pagination_html += f'<a href="/support?status={status or ""}&page={page+1}" class="ajax-pagination w-10 h-10 rounded-full bg-white/5 border border-white/10 flex items-center justify-center text-white/40"><span class="material-symbols-outlined">chevron_right</span></a>'
+                    pagination_html += f'<a href="{next_href}" class="ajax-pagination w-10 h-10 rounded-full bg-white/5 border border-white/10 flex items-center justify-center text-white/40"><span class="material-symbols-outlined">chevron_right</span></a>'
                 pagination_html += '</div>'
             table_html += pagination_html
         else:
@@ -898,7 +914,7 @@ def create_webhook_app(bot_controller_instance):
                 if page > 1:
                     pagination_html += f'<a href="/support?status={status or ""}&page={page-1}" class="ajax-pagination px-4 py-2 rounded-xl bg-white/5 border border-white/10 text-white/60 text-xs font-bold hover:bg-white/10 transition-all uppercase tracking-widest">Назад</a>'
                 if page < total_pages:
-                    pagination_html += f'<a href="/support?status={status or ""}&page={page+1}" class="ajax-pagination px-4 py-2 rounded-xl bg-primary text-background-dark text-xs font-bold hover:bg-primary/90 transition-all uppercase tracking-widest">Вперед</a>'
+                    pagination_html += f'<a href="{next_href}" class="ajax-pagination px-4 py-2 rounded-xl bg-primary text-background-dark text-xs font-bold hover:bg-primary/90 transition-all uppercase tracking-widest">Вперед</a>'
                 pagination_html += '</div>'
             
         return jsonify({
@@ -941,7 +957,7 @@ def create_webhook_app(bot_controller_instance):
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 25, type=int)
         q = (request.args.get('q') or '').strip()
-        users, total = get_users_paginated(page=page, per_page=per_page, q=q or None)
+        users, total, _ = get_users_paginated(page=page, per_page=per_page, q=q or None, cursor=request.args.get('cursor'))
         user_ids = [u['telegram_id'] for u in users]
         try:
             keys_counts = get_keys_counts_for_users(user_ids)
@@ -1000,10 +1016,10 @@ def create_webhook_app(bot_controller_instance):
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 25, type=int)
         q = (request.args.get('q') or '').strip()
-        _, total = get_users_paginated(page=page, per_page=per_page, q=q or None)
+        _, total, next_cursor = get_users_paginated(page=page, per_page=per_page, q=q or None, cursor=request.args.get('cursor'))
         from math import ceil
         total_pages = ceil(total / per_page) if per_page else 1
-        return render_template('partials/users_pagination.html', current_page=page, total_pages=total_pages, q=q)
+        return render_template('partials/users_pagination.html', current_page=page, total_pages=total_pages, q=q, next_cursor=next_cursor)
 
     @flask_app.route('/users/<int:user_id>/balance/adjust', methods=['POST'])
     @login_required
@@ -1019,7 +1035,7 @@ def create_webhook_app(bot_controller_instance):
             return redirect(url_for('users_page'))
 
         old_balance = get_balance(user_id)
-        ok = adjust_user_balance(user_id, delta)
+        ok = adjust_user_balance(user_id, delta, "admin_adjust")
         if ok:
             try:
                 new_balance = get_balance(user_id)
@@ -1468,41 +1484,6 @@ def create_webhook_app(bot_controller_instance):
             logger.error(f"Failed to toggle trial for user {user_id}: {e}")
             return jsonify({"ok": False, "error": str(e)}), 500
 
-    def _get_filtered_keys(q, filter_mode):
-        all_keys = []
-        try:
-            all_keys = get_all_keys()
-        except Exception:
-            all_keys = []
-        try:
-            users_by_id = {str(u.get('telegram_id')): u.get('username') for u in get_all_users() if u.get('telegram_id')}
-            for key in all_keys:
-                user_id = key.get('user_id')
-                if user_id is not None:
-                    key['username'] = users_by_id.get(str(user_id))
-        except Exception:
-            pass
-        
-        if filter_mode == 'gift':
-            keys = [k for k in all_keys if (k.get('user_id') or 0) == 0 or str(k.get('key_email') or '').lower().startswith('gift')]
-        else:
-            keys = [k for k in all_keys if (k.get('user_id') or 0) != 0 and not str(k.get('key_email') or '').lower().startswith('gift')]
-
-        q = (q or '').strip().lower()
-        if q:
-            def match(k):
-                return (
-                    q in str(k.get('key_id', '')).lower() or
-                    q in str(k.get('user_id', '')).lower() or
-                    q in str(k.get('host_name', '')).lower() or
-                    q in str(k.get('key_email', '')).lower() or
-                    q in str(k.get('remnawave_user_uuid', '')).lower() or
-                    q in str(k.get('subscription_url', '')).lower() or
-                    q in str(k.get('access_url', '')).lower()
-                )
-            keys = [k for k in keys if match(k)]
-        return keys
-
     @flask_app.route('/admin/keys')
     @login_required
     def admin_keys_page():
@@ -1514,14 +1495,7 @@ def create_webhook_app(bot_controller_instance):
         current_page = 1
         expired_count = 0 
         try:
-            all_keys = get_all_keys()
-            now = get_msk_time().replace(tzinfo=timezone(timedelta(hours=3))).timestamp() * 1000
-            expired_keys = [
-                k for k in all_keys 
-                if k.get('expire_at') and 
-                datetime.strptime(str(k.get('expire_at')), "%Y-%m-%d %H:%M:%S").timestamp() * 1000 <= now
-            ]
-            expired_count = len(expired_keys)
+            expired_count = rw_repo.count_keys_expired_before(int(get_msk_time().timestamp() * 1000))
         except Exception as e:
             logger.error(f"Failed to calculate expired_count: {e}")
             expired_count = 0
@@ -1546,16 +1520,11 @@ def create_webhook_app(bot_controller_instance):
     def admin_keys_table_partial():
         filter_mode = request.args.get('filter', 'general')
         q = request.args.get('q', '')
-        keys = _get_filtered_keys(q, filter_mode)
-            
         page = request.args.get('page', 1, type=int)
         per_page = 20
-        total_items = len(keys)
-        
-        start = (page - 1) * per_page
-        end = start + per_page
-        paginated_keys = keys[start:end]
-            
+        paginated_keys, _, _ = rw_repo.get_keys_paginated(
+            page=page, per_page=per_page, q=q, filter_mode=filter_mode, cursor=request.args.get('cursor')
+        )
         return render_template('partials/admin_keys_table.html', keys=paginated_keys)
 
     @flask_app.route('/admin/keys/pagination.partial')
@@ -1563,14 +1532,14 @@ def create_webhook_app(bot_controller_instance):
     def admin_keys_pagination_partial():
         filter_mode = request.args.get('filter', 'general')
         q = request.args.get('q', '')
-        keys = _get_filtered_keys(q, filter_mode)
-            
         page = request.args.get('page', 1, type=int)
         per_page = 20
-        total_items = len(keys)
+        _, total_items, next_cursor = rw_repo.get_keys_paginated(
+            page=page, per_page=per_page, q=q, filter_mode=filter_mode, cursor=request.args.get('cursor')
+        )
         total_pages = ceil(total_items / per_page) if per_page else 1
         
-        return render_template('partials/admin_keys_pagination.html', current_page=page, total_pages=total_pages, q=q, current_filter=filter_mode)
+        return render_template('partials/admin_keys_pagination.html', current_page=page, total_pages=total_pages, q=q, current_filter=filter_mode, next_cursor=next_cursor)
 
     @flask_app.route('/admin/hosts/<host_name>/plans')
     @login_required
@@ -2108,40 +2077,9 @@ def create_webhook_app(bot_controller_instance):
     def sweep_expired_keys_route():
         removed = 0
         failed = 0
-        now = get_msk_time().replace(tzinfo=None)
-        keys = get_all_keys()
+        now_ms = int(get_msk_time().timestamp() * 1000)
+        keys = rw_repo.get_keys_expired_before(now_ms + 1)
         for k in keys:
-            exp = k.get('expiry_date')
-            exp_dt = None
-            try:
-                if isinstance(exp, str):
-                    s = exp.strip()
-                    if s:
-                        try:
-
-                            exp_dt = datetime.fromisoformat(s)
-                        except Exception:
-                            try:
-                                exp_dt = datetime.fromisoformat(s.replace('Z', '+00:00'))
-                            except Exception:
-
-                                try:
-                                    exp_dt = datetime.strptime(s, '%Y-%m-%d %H:%M:%S')
-                                except Exception:
-                                    exp_dt = None
-                else:
-                    exp_dt = exp
-            except Exception:
-                exp_dt = None
-
-            try:
-                if exp_dt is not None and getattr(exp_dt, 'tzinfo', None) is not None:
-                    exp_dt = exp_dt.astimezone(timezone(timedelta(hours=3))).replace(tzinfo=None)
-            except Exception:
-                pass
-            if not exp_dt or exp_dt > now:
-                continue
-
             try:
                 try:
 
@@ -2561,7 +2499,7 @@ def create_webhook_app(bot_controller_instance):
     @login_required
     def delete_all_tickets_route():
         try:
-            tickets, total = get_tickets_paginated(page=1, per_page=10000, status='')
+            tickets, total, _ = get_tickets_paginated(page=1, per_page=10000, status='')
             deleted = 0
             bot = _support_bot_controller.get_bot_instance()
             loop = current_app.config.get('EVENT_LOOP')